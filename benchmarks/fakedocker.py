@@ -0,0 +1,124 @@
+'''
+The stand-in of `docker` executable for benchmarks, the subset of the commands used by DockerCLI is supported.
+The behaviour is configured by JSON file in $FAKE_DOCKER_CONFIG:
+
+    {
+        "latency": {"exec": 0.01, "*": 0.0},    # the delay of the command, seconds, * - other commands
+        "images": 10000,                        # the number of images on the synthetic host
+        "containers": 10000,                    # the number of containers on the synthetic host
+        "exec_output": 1048576                  # the size of `docker exec` output, bytes, 0 - echo the command
+    }
+
+The container `bench` of the image `bench:latest` always exists.
+'''
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import json
+import time
+import signal
+import hashlib
+
+CHUNK_SIZE = 64 * 1024
+
+
+def load_config():
+    path = os.environ.get('FAKE_DOCKER_CONFIG')
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as config:
+        return json.load(config)
+
+
+def object_id(name):
+    return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+
+def write(data):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(data)
+    out.flush()
+
+
+def images(config, args):
+    lines = []
+    for pos in range(config.get('images', 0)):
+        lines.append(json.dumps({'ID': object_id('image%d' % pos)[:12], 'Repository': 'image%d' % pos,
+                                 'Tag': 'latest', 'Size': '4MB', 'CreatedAt': '2017-01-01 00:00:00 +0000 UTC'}))
+    lines.append(json.dumps({'ID': object_id('bench')[:12], 'Repository': 'bench', 'Tag': 'latest',
+                             'Size': '4MB', 'CreatedAt': '2017-01-01 00:00:00 +0000 UTC'}))
+    write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def ps(config, args):
+    lines = []
+    names = ['c%d' % pos for pos in range(config.get('containers', 0))] + ['bench']
+    for name in names:
+        lines.append(json.dumps({'ID': object_id(name)[:12], 'Names': name, 'Image': 'bench:latest',
+                                 'Labels': '', 'Command': '"/bin/sh -c ..."', 'Status': 'Up 1 second',
+                                 'CreatedAt': '2017-01-01 00:00:00 +0000 UTC', 'Size': '0B'}))
+    write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def events(config, args):
+    # the stream has no events, it's closed by the client
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    while True:
+        time.sleep(60)
+
+
+def execute(config, args):
+    size = config.get('exec_output', 0)
+    if not size:
+        write((' '.join(args[1:]) + '\n').encode('utf-8'))
+        return
+    line = b'x' * 79 + b'\n'
+    chunk = line * (CHUNK_SIZE // len(line))
+    while size > 0:
+        write(chunk[:size])
+        size -= len(chunk)
+
+
+def inspect(config, args):
+    write(b'{}\n')
+
+
+def run(config, args):
+    write((object_id(str(time.time())) + '\n').encode('utf-8'))
+
+
+def remove(config, args):
+    write(('\n'.join(a for a in args if not a.startswith('-')) + '\n').encode('utf-8'))
+
+
+def commit(config, args):
+    write(('sha256:%s\n' % object_id(str(time.time()))).encode('utf-8'))
+
+
+def cp(config, args):
+    if args and args[0] == '-':
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        while stdin.read(CHUNK_SIZE):
+            pass
+
+
+COMMANDS = {
+    'images': images, 'ps': ps, 'events': events, 'exec': execute, 'inspect': inspect, 'run': run,
+    'rm': remove, 'stop': remove, 'commit': commit, 'cp': cp,
+}
+
+
+def main(argv):
+    config = load_config()
+    command, args = (argv[0], argv[1:]) if argv else ('', [])
+    latency = config.get('latency', {})
+    delay = latency.get(command, latency.get('*', 0))
+    if delay:
+        time.sleep(delay)
+    if command in COMMANDS:
+        COMMANDS[command](config, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
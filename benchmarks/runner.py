@@ -0,0 +1,322 @@
+'''
+The benchmarks of the builder: DockerCLI, ContainerContext, DataLoader, Logger and facts parsing run
+against the fake `docker` executable on PATH, see fakedocker.py
+
+Usage:
+
+    $ PYTHONPATH=src python benchmarks/runner.py
+    $ PYTHONPATH=src python benchmarks/runner.py --filter cli. --save-baseline
+    $ PYTHONPATH=src python benchmarks/runner.py --latency exec=0.005 --quick
+
+The results are compared with the baseline of the same Python version, the exit code is 1 if
+ops/sec dropped or p99 latency grew by more than the tolerance
+'''
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import logging
+import argparse
+import resource
+import tempfile
+import platform
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+DEFAULT_TOLERANCE = 0.25
+
+# the wrapper of fakedocker.py placed on PATH as `docker`
+DOCKER_WRAPPER = '''#!/bin/sh
+exec "%s" "%s" "$@"
+'''
+
+BENCHMARKS = []
+
+
+def benchmark(name, iterations, **config):
+    '''
+    Register the benchmark: the function gets the fake docker config and returns the operation to measure
+
+    :param name: benchmark name
+    :param iterations: the number of operations
+    :param config: the config of the fake docker, see fakedocker.py
+    '''
+    def register(setup):
+        BENCHMARKS.append((name, iterations, config, setup))
+        return setup
+    return register
+
+
+class FakeDocker(object):
+    def __init__(self, latency=None):
+        self._dir = tempfile.mkdtemp(prefix='builder-bench-')
+        self._latency = dict(latency or {})
+        self.config_path = os.path.join(self._dir, 'config.json')
+        self._environ = dict((k, os.environ.get(k)) for k in ('PATH', 'FAKE_DOCKER_CONFIG', 'BUILDER_DOCKER_BACKEND'))
+        docker = os.path.join(self._dir, 'docker')
+        with open(docker, 'w') as wrapper:
+            wrapper.write(DOCKER_WRAPPER % (sys.executable, os.path.join(BENCHMARKS_DIR, 'fakedocker.py')))
+        os.chmod(docker, 0o755)
+        os.environ['PATH'] = '%s:%s' % (self._dir, os.environ.get('PATH', ''))
+        os.environ['FAKE_DOCKER_CONFIG'] = self.config_path
+        os.environ['BUILDER_DOCKER_BACKEND'] = 'cli'
+
+    def configure(self, **config):
+        config = dict(config, latency=dict(config.get('latency', {}), **self._latency))
+        with open(self.config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+    def close(self):
+        for key, value in self._environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self._dir)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss():
+    '''
+    :return: peak RSS of the process, MB
+    '''
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def measure(operation, iterations):
+    latencies = []
+    started = time.time()
+    for _ in range(iterations):
+        op_started = time.time()
+        operation()
+        latencies.append(time.time() - op_started)
+    elapsed = time.time() - started
+    return {
+        u'iterations': iterations,
+        u'ops_per_sec': round(iterations / elapsed, 2) if elapsed else None,
+        u'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        u'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        u'peak_rss_mb': peak_rss(),
+    }
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# benchmarks
+
+@benchmark(u'cli.exec', 50)
+def bench_exec(config):
+    from builder.docker import DockerCLI
+    cli = DockerCLI()
+    return lambda: cli.execute('bench', 'echo', 'hello')
+
+
+@benchmark(u'cli.exec.large_output', 5, exec_output=16 * 1024 * 1024)
+def bench_exec_large(config):
+    from builder.docker import DockerCLI
+    cli = DockerCLI()
+    return lambda: cli.execute('bench', 'cat', '/large')
+
+
+# the same output as cli.exec.large_output, the streamed and buffered exec are comparable
+@benchmark(u'cli.exec_stream.large_output', 5, exec_output=16 * 1024 * 1024)
+def bench_exec_stream_large(config):
+    from builder.docker import DockerCLI
+    cli = DockerCLI()
+
+    def operation():
+        for _ in cli.exec_stream('bench', 'cat', '/large'):
+            pass
+    return operation
+
+
+@benchmark(u'cli.find_images.10k', 5, images=10000)
+def bench_find_images(config):
+    from builder.docker import DockerCLI
+    cli = DockerCLI()
+    return lambda: cli.find_images()
+
+
+@benchmark(u'cli.find_containers.10k', 5, containers=10000)
+def bench_find_containers(config):
+    from builder.docker import DockerCLI
+    cli = DockerCLI()
+    return lambda: cli.find_containers()
+
+
+@benchmark(u'cli.inspect', 50)
+def bench_inspect(config):
+    from builder.docker import DockerCLI
+    cli = DockerCLI()
+    return lambda: cli.inspect('bench', '.Config')
+
+
+@benchmark(u'context.cmd', 50, images=1000, containers=1000)
+def bench_context_cmd(config):
+    from builder.container import ContainerContext
+    ctxt = ContainerContext('bench')
+    return lambda: ctxt.cmd('echo hello')
+
+
+@benchmark(u'context.batch', 20)
+def bench_context_batch(config):
+    from builder.container import ContainerContext
+    ctxt = ContainerContext('bench')
+
+    def operation():
+        with ctxt.batch():
+            for pos in range(20):
+                ctxt.cmd('echo %d' % pos)
+    return operation
+
+
+@benchmark(u'dataloader.load.json', 200)
+def bench_dataloader_json(config):
+    from builder.dataloader import DataLoader
+    data = json.dumps({u'targets': [{u'source_image_name': u'alpine:3.5', u'target_image_name': u'app:%d' % pos,
+                                     u'build_module': u'build', u'vars': {u'version': pos}} for pos in range(100)]})
+    return lambda: DataLoader().load(data)
+
+
+@benchmark(u'dataloader.load.yaml', 20)
+def bench_dataloader_yaml(config):
+    from builder.dataloader import DataLoader
+    data = u'targets:\n' + u''.join(u'- source_image_name: alpine:3.5\n  target_image_name: app:%d\n'
+                                    u'  build_module: build\n  vars: { version: %d }\n' % (pos, pos)
+                                    for pos in range(100))
+    return lambda: DataLoader().load(data)
+
+
+@benchmark(u'logger.info', 10000)
+def bench_logger(config):
+    from builder.log import Logger
+    logger = Logger(u'builder.bench')
+    return lambda: logger.info(**{u'msg': u'Execute command in the container', u'container.name': u'bench',
+                                  u'command.args': [u'echo', u'hello']})
+
+
+@benchmark(u'facts.parse', 200)
+def bench_facts(config):
+    from builder.utils import facts
+    # the facts of the host
+    output = subprocess.check_output(['/bin/sh', '-c', facts.facts_script()]).decode('utf-8', 'replace')
+    return lambda: facts.parse_facts(output)
+
+
+# ----------------------------------------------------------------------------------------------------------------
+
+def python_key():
+    return u'%s-%s' % (platform.python_implementation().lower(), u'.'.join(platform.python_version_tuple()[:2]))
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline:
+        return json.load(baseline).get(python_key(), {})
+
+
+def save_baseline(path, results):
+    baselines = dict()
+    if os.path.exists(path):
+        with open(path) as baseline:
+            baselines = json.load(baseline)
+    baselines.setdefault(python_key(), {}).update(results)
+    with open(path, 'w') as baseline:
+        json.dump(baselines, baseline, indent=2, sort_keys=True, separators=(',', ': '))
+
+
+def regressions(result, baseline, tolerance):
+    '''
+    :return: the list of regressions of the result against the baseline
+    '''
+    found = []
+    if baseline.get(u'ops_per_sec') and result[u'ops_per_sec'] < baseline[u'ops_per_sec'] * (1 - tolerance):
+        found.append(u'ops/sec %.2f < %.2f' % (result[u'ops_per_sec'], baseline[u'ops_per_sec']))
+    if baseline.get(u'p99_ms') and result[u'p99_ms'] > baseline[u'p99_ms'] * (1 + tolerance):
+        found.append(u'p99 %.3f ms > %.3f ms' % (result[u'p99_ms'], baseline[u'p99_ms']))
+    return found
+
+
+def run(names=None, latency=None, quick=False):
+    '''
+    Run the benchmarks
+
+    :param names: the name prefixes of benchmarks to run, default: all
+    :param latency: the dict of fake docker latencies: command -> seconds
+    :param quick: run 1/5 of iterations
+    :return: the dict: benchmark name -> result, the skipped benchmarks have `skipped` reason
+    '''
+    from builder.inventory import close_inventories
+
+    fake = FakeDocker(latency=latency)
+    results = dict()
+    try:
+        for name, iterations, config, setup in BENCHMARKS:
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            fake.configure(**config)
+            try:
+                operation = setup(config)
+            except ImportError as err:
+                results[name] = {u'skipped': u'{}'.format(err)}
+                continue
+            try:
+                results[name] = measure(operation, max(1, iterations // 5) if quick else iterations)
+            finally:
+                close_inventories()
+    finally:
+        fake.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run the benchmarks of the builder against the fake docker')
+    parser.add_argument('-f', '--filter', dest='filter', action='append',
+                        help='run the benchmarks with the name prefix, like cli. or facts')
+    parser.add_argument('--latency', dest='latency', action='append', default=[],
+                        help='the latency of the fake docker command, format: command=seconds, * - all commands')
+    parser.add_argument('--quick', action='store_true', help='run 1/5 of iterations')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='the baseline file, default: %s' % os.path.relpath(DEFAULT_BASELINE))
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true',
+                        help='store the results as the baseline of the Python version')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='the allowed slowdown against the baseline, default: %s' % DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    # the log lines are formatted, but not written
+    logging.basicConfig(level=logging.INFO, stream=open(os.devnull, 'w'))
+    latency = dict((k, float(v)) for k, _, v in (l.partition('=') for l in args.latency))
+    results = run(names=args.filter, latency=latency, quick=args.quick)
+
+    baseline = load_baseline(args.baseline)
+    failed = False
+    print(u'%-32s %10s %10s %10s %10s  %s' % (u'BENCHMARK', u'OPS/SEC', u'P50, ms', u'P99, ms', u'RSS, MB', u''))
+    for name in sorted(results):
+        result = results[name]
+        if u'skipped' in result:
+            print(u'%-32s skipped, %s' % (name, result[u'skipped']))
+            continue
+        found = regressions(result, baseline.get(name, {}), args.tolerance)
+        failed = failed or bool(found)
+        print(u'%-32s %10.2f %10.3f %10.3f %10.1f  %s' % (name, result[u'ops_per_sec'], result[u'p50_ms'],
+                                                          result[u'p99_ms'], result[u'peak_rss_mb'],
+                                                          u'REGRESSION: ' + u', '.join(found) if found else u''))
+    if args.save_baseline:
+        save_baseline(args.baseline, dict((k, v) for k, v in results.items() if u'skipped' not in v))
+    return 1 if failed and not args.save_baseline else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
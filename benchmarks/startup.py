@@ -0,0 +1,141 @@
+'''
+The cold start of the command line entry point: the wall time of `python src <command>` against the empty
+entry point and, on Python 3.7+, the import time of the modules by `-X importtime`
+
+Usage:
+
+    $ python benchmarks/startup.py
+    $ python benchmarks/startup.py --runs 20 --budget-ms 40
+
+The exit code is 1 if the startup of `--version` exceeds the budget: the import time of the entry point
+where `-X importtime` is supported, the wall time over the empty entry point otherwise
+'''
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src')
+
+# the commands of the entry point, the budget is checked for the first one
+COMMANDS = (('--version',), ('--help',), ('halt', '--help'))
+
+DEFAULT_RUNS = 10
+DEFAULT_BUDGET_MS = 50.0
+
+# `import time: self [us] | cumulative | imported package`, the nesting is the indent of the name
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def importtime_supported(python=sys.executable):
+    # -X importtime is Python 3.7+, Python 2 rejects -X options
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([python, '-X', 'importtime', '-c', 'pass'], stdout=devnull, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate()
+    return proc.returncode == 0 and b'import time:' in stderr
+
+
+def parse_importtime(output):
+    '''
+    :param output: stderr of `python -X importtime`
+    :return: the list of imports: (module, self time, us, cumulative time, us, nesting level)
+    '''
+    imports = []
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            # the top level imports have one space before the name, every level adds two spaces
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return imports
+
+
+def import_time(entry_point, argv, baseline=(), python=sys.executable):
+    '''
+    :param entry_point: the directory with __main__.py
+    :param argv: the command line arguments
+    :param baseline: the modules imported by the interpreter itself, they are not counted
+    :return: the tuple (import time of the entry point, ms; the list of imported modules (module, self time, ms))
+    '''
+    proc = subprocess.Popen([python, '-X', 'importtime', entry_point] + list(argv),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    imports = [i for i in parse_importtime(stderr.decode('utf-8', 'replace')) if i[0] not in baseline]
+    total_us = sum(cumulative for _, _, cumulative, level in imports if level == 0)
+    return total_us / 1000.0, [(name, self_us / 1000.0) for name, self_us, _, _ in imports]
+
+
+def wall_time(entry_point, argv, runs, python=sys.executable):
+    '''
+    :return: the median wall time of the command, ms
+    '''
+    durations = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            subprocess.call([python, entry_point] + list(argv), stdout=devnull, stderr=devnull)
+            durations.append((time.time() - started) * 1000)
+    return sorted(durations)[len(durations) // 2]
+
+
+def run(runs=DEFAULT_RUNS, entry_point=SOURCE_DIR):
+    '''
+    :param runs: the number of runs per command
+    :param entry_point: the directory with __main__.py of the builder
+    :return: the dict: command -> the result (wall_ms, overhead_ms and, with -X importtime, import_ms, imports)
+    '''
+    empty = tempfile.mkdtemp(prefix='builder-startup-')
+    try:
+        open(os.path.join(empty, '__main__.py'), 'w').close()
+        interpreter_ms = wall_time(empty, [], runs)
+        supported = importtime_supported()
+        baseline = set(name for name, _ in import_time(empty, [])[1]) if supported else set()
+    finally:
+        shutil.rmtree(empty)
+
+    results = dict()
+    for argv in COMMANDS:
+        wall_ms = wall_time(entry_point, argv, runs)
+        result = {u'wall_ms': round(wall_ms, 1), u'overhead_ms': round(wall_ms - interpreter_ms, 1)}
+        if supported:
+            import_ms, imports = import_time(entry_point, argv, baseline)
+            result[u'import_ms'] = round(import_ms, 1)
+            result[u'imports'] = sorted(imports, key=lambda item: -item[1])
+        results[u' '.join(argv)] = result
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='measure the cold start of the builder entry point')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                        help='the number of runs per command, default: %d' % DEFAULT_RUNS)
+    parser.add_argument('--budget-ms', dest='budget_ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='the startup budget of `%s`, ms, default: %s' % (' '.join(COMMANDS[0]),
+                                                                              DEFAULT_BUDGET_MS))
+    parser.add_argument('--top', type=int, default=5, help='the number of the slowest imports to show')
+    args = parser.parse_args(argv)
+
+    results = run(runs=max(1, args.runs))
+    print(u'%-20s %10s %12s %10s  %s' % (u'COMMAND', u'WALL, ms', u'OVERHEAD, ms', u'IMPORT, ms', u'SLOWEST IMPORTS'))
+    for argv in COMMANDS:
+        result = results[u' '.join(argv)]
+        slowest = u', '.join(u'%s %.1f' % item for item in result.get(u'imports', [])[:args.top])
+        print(u'%-20s %10.1f %12.1f %10s  %s' % (u' '.join(argv), result[u'wall_ms'], result[u'overhead_ms'],
+                                                 result.get(u'import_ms', u'-'), slowest))
+
+    checked = results[u' '.join(COMMANDS[0])]
+    startup_ms = checked.get(u'import_ms', checked[u'overhead_ms'])
+    if startup_ms > args.budget_ms:
+        print(u'OVER BUDGET: %s takes %.1f ms > %.1f ms' % (u' '.join(COMMANDS[0]), startup_ms, args.budget_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
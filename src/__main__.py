@@ -1,6 +1,72 @@
 from __future__ import (absolute_import, division, print_function)
 
+import os
 import sys
+
+# the bundle is extracted once to $BUILDER_EXTRACT_DIR/<build id>-<python version> and imported from there,
+# the bytecode of the interpreter is compiled on extraction and cached on disk, see BUILD_ID and `make compile`
+EXTRACT_DIR_ENV = 'BUILDER_EXTRACT_DIR'
+
+
+def compile_bytecode(path):
+    '''
+    Compile the modules of the directory, the modules of other Python versions are skipped
+    '''
+    import py_compile
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith('.py'):
+                try:
+                    py_compile.compile(os.path.join(root, name), doraise=True)
+                except py_compile.PyCompileError:
+                    pass
+
+
+def extracted_bundle(bundle, extract_dir):
+    '''
+    :param bundle: the path of the zip bundle
+    :param extract_dir: the directory of extracted bundles
+    :return: the path of extracted bundle, None if the bundle cannot be extracted
+    '''
+    try:
+        build_id = __loader__.get_data(os.path.join(bundle, 'BUILD_ID')).decode('ascii').strip()
+    except (NameError, AttributeError, IOError, OSError):
+        return None
+    path = os.path.join(extract_dir, '%s-py%d%d' % ((build_id,) + sys.version_info[:2]))
+    if os.path.isdir(path):
+        return path
+
+    import shutil
+    import zipfile
+    import tempfile
+
+    try:
+        if not os.path.isdir(extract_dir):
+            os.makedirs(extract_dir)
+        # the bundle is extracted to the temporary directory and renamed, the concurrent runs see
+        # the complete directory or nothing
+        tmp_path = tempfile.mkdtemp(prefix='.%s.' % build_id, dir=extract_dir)
+        try:
+            archive = zipfile.ZipFile(bundle)
+            try:
+                archive.extractall(tmp_path)
+            finally:
+                archive.close()
+            compile_bytecode(tmp_path)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+    except (IOError, OSError, zipfile.BadZipfile):
+        # the bundle was extracted by the concurrent run or the bundle is imported as is
+        return path if os.path.isdir(path) else None
+    return path
+
+
+if os.environ.get(EXTRACT_DIR_ENV) and os.path.isfile(sys.path[0]):
+    sys.path[0] = extracted_bundle(sys.path[0], os.environ[EXTRACT_DIR_ENV]) or sys.path[0]
+
 from builder.utils import clean_syspath
 
 sys.path = clean_syspath()
@@ -1 +1,22 @@
 BUILDER_VERSION = '0.1.0'
+
+# the choices and defaults of the global options are defined here, so the command line entry point
+# parses them without importing the modules of the options
+
+# the backends of docker client, see builder.docker.docker_client()
+DOCKER_BACKENDS = ('cli', 'api')
+
+# the formats of the trace file, see builder.trace
+TRACE_CHROME = u'chrome'
+TRACE_OTLP = u'otlp'
+
+TRACE_FORMATS = (TRACE_CHROME, TRACE_OTLP)
+
+# the stack sampling interval, seconds, see builder.profiler
+DEFAULT_SAMPLING_INTERVAL = 0.005
+
+# replay the docker commands with the recorded wall time or at once, see builder.replay
+LATENCY_REAL = u'real'
+LATENCY_ZERO = u'zero'
+
+LATENCIES = (LATENCY_REAL, LATENCY_ZERO)
@@ -0,0 +1,336 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import stat
+import time
+import fnmatch
+import hashlib
+import tarfile
+import itertools
+import posixpath
+
+from six import text_type, string_types
+
+# the size of the chunks of the archive stream
+CHUNK_SIZE = 64 * 1024
+
+
+class Content(object):
+    '''
+    The in-memory file content copied to the container
+
+        Content(u'nameserver 8.8.8.8\\n', mode=0o644)
+    '''
+    def __init__(self, data, mode=0o644, mtime=None):
+        '''
+        :param data: the content, text is encoded to UTF-8
+        :param mode: file mode
+        :param mtime: modification time, default: now
+        '''
+        self.data = data.encode('utf-8') if isinstance(data, text_type) else data
+        self.mode = mode
+        self.mtime = int(time.time() if mtime is None else mtime)
+
+    def digest(self):
+        '''
+        :return: sha256 hex digest of the mode and the content
+        '''
+        digest = hashlib.sha256(('%o' % self.mode).encode('utf-8'))
+        digest.update(self.data)
+        return digest.hexdigest()
+
+
+def archive_entries(sources):
+    '''
+    :param sources: the list of host paths, (host path, name) or (Content, name) tuples,
+        the host path is named by its base name by default
+    :return: the list of (host path or Content, name) tuples
+    '''
+    entries = []
+    for source in sources:
+        if isinstance(source, string_types):
+            source, name = source, os.path.basename(os.path.normpath(source))
+        else:
+            source, name = source
+        name = posixpath.normpath(name.replace(os.sep, '/')).lstrip('/')
+        if not name or name == '.' or name.startswith('../'):
+            raise ValueError('Invalid name in the archive, %s' % name)
+        entries.append((source, name))
+    return entries
+
+
+def match_patterns(name, patterns):
+    ''' the pattern matches the name in the archive or its base name
+    '''
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(posixpath.basename(name), p) for p in patterns)
+
+
+def _tarinfo(name, st, path, uid, gid):
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = int(st.st_mtime)
+    info.uid = st.st_uid if uid is None else uid
+    info.gid = st.st_gid if gid is None else gid
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type, info.linkname = tarfile.SYMTYPE, os.readlink(path)
+    elif stat.S_ISREG(st.st_mode):
+        info.type, info.size = tarfile.REGTYPE, st.st_size
+    else:
+        # sockets, devices and pipes are not copied
+        return None
+    return info
+
+
+def iter_members(sources, include=None, exclude=None, uid=0, gid=0):
+    '''
+    Walk the sources, the directories are walked recursively
+
+    :param sources: see archive_entries()
+    :param include: glob patterns of the files to copy, default: all files
+    :param exclude: glob patterns of the files and directories to skip
+    :param uid: the owner of the files in the archive, None - keep the host one
+    :param gid: the group of the files in the archive, None - keep the host one
+    :return: the iterator of (TarInfo, host path or Content) tuples
+    '''
+    include, exclude = list(include or []), list(exclude or [])
+    for source, name in archive_entries(sources):
+        if isinstance(source, Content):
+            info = tarfile.TarInfo(name)
+            info.size, info.mode, info.mtime = len(source.data), source.mode, source.mtime
+            info.uid, info.gid = uid or 0, gid or 0
+            yield info, source
+            continue
+
+        st = os.lstat(source)
+        if not stat.S_ISDIR(st.st_mode):
+            # the top-level file is filtered like the files of the walked directories
+            if not match_patterns(name, exclude) and (not include or match_patterns(name, include)):
+                info = _tarinfo(name, st, source, uid, gid)
+                if info:
+                    yield info, source
+            continue
+
+        # with include patterns the directory is added before its first included file,
+        # so no empty directories are copied. The walked directories which were not added yet
+        walked = []
+        for root, dirs, files in os.walk(source):
+            rel = os.path.relpath(root, source)
+            arcroot = name if rel == os.curdir else posixpath.join(name, rel.replace(os.sep, '/'))
+            walked = [(d, i) for d, i in walked if arcroot.startswith(d + '/')]
+            info = _tarinfo(arcroot, os.lstat(root), root, uid, gid)
+            if include:
+                walked.append((arcroot, info))
+            else:
+                yield info, root
+
+            # the symlinks to directories are not followed by os.walk(), they are copied as files
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            dirs[:] = sorted(d for d in dirs
+                             if d not in links and not match_patterns(posixpath.join(arcroot, d), exclude))
+            for filename in sorted(files + links):
+                arcname = posixpath.join(arcroot, filename)
+                if match_patterns(arcname, exclude) or (include and not match_patterns(arcname, include)):
+                    continue
+                path = os.path.join(root, filename)
+                info = _tarinfo(arcname, os.lstat(path), path, uid, gid)
+                if not info:
+                    continue
+                for _, dir_info in walked:
+                    yield dir_info, None
+                walked = []
+                yield info, path
+
+
+def _read_chunks(source, size, chunk_size):
+    ''' read exactly size bytes, the file truncated while reading is padded by zeros
+    '''
+    if isinstance(source, Content):
+        for pos in range(0, size, chunk_size):
+            yield source.data[pos:pos + chunk_size]
+        return
+    with open(source, 'rb') as fileobj:
+        while size > 0:
+            chunk = fileobj.read(min(size, chunk_size))
+            if not chunk:
+                chunk = b'\0' * min(size, chunk_size)
+            size -= len(chunk)
+            yield chunk
+
+
+def _pack(members, chunk_size):
+    '''
+    :param members: the iterator of (TarInfo, the iterator of content chunks) tuples
+    :return: the iterator of archive chunks, the small members are sent by the chunks of several members
+    '''
+    buf, buffered = [], 0
+    for info, content in members:
+        blocks = [info.tobuf(tarfile.GNU_FORMAT, 'utf-8')]
+        if info.isreg():
+            remainder = info.size % tarfile.BLOCKSIZE
+            padding = [b'\0' * (tarfile.BLOCKSIZE - remainder)] if remainder else []
+            blocks = itertools.chain(blocks, content, padding)
+        for block in blocks:
+            buf.append(block)
+            buffered += len(block)
+            if buffered >= chunk_size:
+                yield b''.join(buf)
+                buf, buffered = [], 0
+    buf.append(b'\0' * (2 * tarfile.BLOCKSIZE))
+    yield b''.join(buf)
+
+
+def iter_archive(sources, include=None, exclude=None, uid=0, gid=0, chunk_size=CHUNK_SIZE):
+    '''
+    Build the tar archive on the fly, the files are read while the archive is sent,
+    neither the archive nor the files are kept in memory
+
+    :param sources: see archive_entries()
+    :param include: glob patterns of the files to copy, see iter_members()
+    :param exclude: glob patterns of the files and directories to skip
+    :param uid: the owner of the files in the archive, default: root, None - keep the host one
+    :param gid: the group of the files in the archive, default: root, None - keep the host one
+    :param chunk_size: the size of the chunks
+    :return: the iterator of archive chunks, bytes
+    '''
+    members = iter_members(sources, include=include, exclude=exclude, uid=uid, gid=gid)
+    return _pack(((info, _read_chunks(source, info.size, chunk_size) if info.isreg() else ())
+                  for info, source in members), chunk_size)
+
+
+def filter_archive(fileobj, predicate, chunk_size=CHUNK_SIZE):
+    '''
+    Re-pack the tar stream on the fly, only the members accepted by predicate are kept
+
+    :param fileobj: the file-like object with the archive stream
+    :param predicate: the function which gets TarInfo and returns True if the member is kept
+    :param chunk_size: the size of the chunks
+    :return: the iterator of archive chunks, bytes
+    '''
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+
+    def members():
+        try:
+            for member in tar:
+                if predicate(member):
+                    content = tar.extractfile(member) if member.isreg() else None
+                    yield member, iter(lambda: content.read(chunk_size), b'') if content else ()
+        finally:
+            tar.close()
+    return _pack(members(), chunk_size)
+
+
+class ChunkReader(object):
+    '''
+    The file-like object over the iterator of chunks, to read the archive stream by tarfile
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+def _safe_target(dest, name):
+    '''
+    :return: the host path of the archive member, None if it's outside of the destination directory
+    '''
+    name = posixpath.normpath(name)
+    if name.startswith(('/', '../')) or name in ('.', '..'):
+        return None
+    target = os.path.join(dest, *name.split('/'))
+    parent = os.path.realpath(os.path.dirname(target))
+    if parent != dest and not parent.startswith(dest + os.sep):
+        return None
+    return target
+
+
+def member_target(dest, member):
+    '''
+    Check the archive member which is extracted to the host directory by tarfile
+
+    :param dest: the real path of the host directory
+    :param member: TarInfo
+    :return: the host path of the member
+    :raise tarfile.TarError: if the member is not a file, a directory or a link, if it or the target
+        of its hard link is outside of the destination directory
+    '''
+    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+        raise tarfile.TarError('The archive member is not a file, a directory or a link, %s' % member.name)
+    target = _safe_target(dest, member.name)
+    if not target or (member.islnk() and not _safe_target(dest, member.linkname)):
+        raise tarfile.TarError('The archive member is outside of the destination, %s' % member.name)
+    return target
+
+
+def extract_archive(fileobj, dest, include=None, exclude=None, predicate=None, strip_components=0, store=None):
+    '''
+    Extract the tar stream to the host directory, the members are filtered while the stream is read,
+    the files are written as they are read, nothing is staged
+
+    :param fileobj: the file-like object with the archive stream
+    :param dest: the host directory
+    :param include: glob patterns of the files to extract, default: all files
+    :param exclude: glob patterns of the files and directories to skip
+    :param predicate: the function which gets TarInfo and returns True if the member is extracted
+    :param strip_components: strip the number of leading components from the member names, like tar
+    :param store: ArtifactStore, the files are stored by content and linked to the destination
+    :return: the list of extracted files, the dicts with name, size and digest (with the store only)
+    '''
+    include, exclude = list(include or []), list(exclude or [])
+    dest = os.path.realpath(dest)
+    extracted = []
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    try:
+        for member in tar:
+            parts = member.name.split('/')
+            name = '/'.join(parts[strip_components:])
+            if not name or not (member.isreg() or member.issym() or member.islnk()):
+                continue
+            if any(match_patterns('/'.join(parts[strip_components:i]), exclude)
+                   for i in range(strip_components + 1, len(parts) + 1)):
+                continue
+            if (include and not match_patterns(name, include)) or (predicate and not predicate(member)):
+                continue
+            target = _safe_target(dest, name)
+            if not target:
+                raise tarfile.TarError('The archive member is outside of the destination, %s' % member.name)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if os.path.lexists(target):
+                os.remove(target)
+
+            result = {u'name': name, u'size': member.size}
+            if member.issym():
+                os.symlink(member.linkname, target)
+            elif member.islnk():
+                # the hard link to the file extracted before
+                linked = _safe_target(dest, '/'.join(member.linkname.split('/')[strip_components:]))
+                if not linked or not os.path.isfile(linked):
+                    continue
+                os.link(linked, target)
+            elif store:
+                source = tar.extractfile(member)
+                result[u'digest'] = store.put(iter(lambda: source.read(CHUNK_SIZE), b''), mode=member.mode)
+                store.link(result[u'digest'], target, mode=member.mode)
+            else:
+                source = tar.extractfile(member)
+                with open(target, 'wb') as target_file:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        target_file.write(chunk)
+                os.chmod(target, stat.S_IMODE(member.mode))
+            extracted.append(result)
+    finally:
+        tar.close()
+    return extracted
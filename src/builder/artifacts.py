@@ -0,0 +1,88 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import stat
+import errno
+import shutil
+import hashlib
+import tempfile
+
+
+class ArtifactStore(object):
+    '''
+    The content-addressed store of artifacts on the host: the file is stored once by sha256 of its content,
+    the extracted files are read-only hard links to the stored ones, or copies if the store is
+    on other file system
+
+    Usage:
+
+        store = ArtifactStore('.builder-artifacts')
+        ctxt.extract('/build/out', 'dist/', include=['*.so', 'bin/*'], store=store)
+    '''
+    def __init__(self, root):
+        '''
+        :param root: the directory of the store
+        '''
+        self.root = os.path.abspath(root)
+        self.stored = 0
+        self.deduped = 0
+
+    def path(self, digest):
+        '''
+        :return: the path of the stored file
+        '''
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def put(self, chunks, mode=0o644):
+        '''
+        Store the content, the content is hashed while it's written to the store
+
+        :param chunks: the iterator of content chunks, bytes
+        :param mode: file mode, the stored files are read-only
+        :return: sha256 hex digest of the content
+        '''
+        tmpdir = os.path.join(self.root, 'tmp')
+        if not os.path.isdir(tmpdir):
+            os.makedirs(tmpdir)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmpdir)
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    target.write(chunk)
+            path = self.path(digest.hexdigest())
+            if os.path.exists(path):
+                self.deduped += 1
+                return digest.hexdigest()
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.chmod(tmp_path, stat.S_IMODE(mode) & 0o555)
+            os.rename(tmp_path, path)
+            self.stored += 1
+            return digest.hexdigest()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def link(self, digest, target, mode=0o644):
+        '''
+        Make the file from the stored one: the hard link if the stored file has the same execute bits,
+        or the copy
+
+        :param digest: sha256 hex digest of the content
+        :param target: the host path
+        :param mode: file mode
+        '''
+        path = self.path(digest)
+        if os.path.lexists(target):
+            os.remove(target)
+        if stat.S_IMODE(os.stat(path).st_mode) == stat.S_IMODE(mode) & 0o555:
+            try:
+                os.link(path, target)
+                return
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        shutil.copyfile(path, target)
+        os.chmod(target, stat.S_IMODE(mode))
@@ -0,0 +1,135 @@
+from __future__ import (absolute_import, division, print_function)
+
+import time
+import uuid
+
+from six import python_2_unicode_compatible
+from six.moves import shlex_quote
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+
+@python_2_unicode_compatible
+class BatchCommand(object):
+    '''
+    The command recorded in the batch, the result is available after the batch was executed.
+    The string value of the command is its stdout.
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.stdout = u''
+        self.stderr = u''
+        # None if the command was not executed
+        self.exit_code = None
+        self.duration = None
+
+    def __str__(self):
+        return self.stdout
+
+    def __repr__(self):
+        return '<BatchCommand args=%r exit_code=%r duration=%r>' % (self.args, self.exit_code, self.duration)
+
+
+class Batch(object):
+    '''
+    The batch of commands executed by one script in one `docker exec`. The output of every command
+    is framed by the start/end markers, the end marker carries exit code.
+
+    Usage:
+
+        with ctxt.batch() as batch:
+            ctxt.cmd('apk update')
+            ctxt.shell('echo "hosts: files dns" >> /etc/nsswitch.conf')
+        for command in batch.commands:
+            print(command.args, command.exit_code, command.duration, command.stdout)
+    '''
+    def __init__(self, fail_fast=True):
+        '''
+        :param fail_fast: stop the batch on the first failed command, default: True
+        '''
+        self.fail_fast = fail_fast
+        self.commands = []
+        self._marker = u'__builder_batch_%s__' % uuid.uuid4().hex
+
+    def add(self, args):
+        '''
+        :param args: the list of command line arguments
+        :return: BatchCommand
+        '''
+        command = BatchCommand(args)
+        self.commands.append(command)
+        return command
+
+    @property
+    def ok(self):
+        return all(c.exit_code == 0 for c in self.commands)
+
+    def script(self):
+        '''
+        :return: shell script which runs all commands of the batch
+        '''
+        lines = []
+        for idx, command in enumerate(self.commands):
+            lines.append(u"printf '%s start %d\\n'; printf '%s start %d\\n' >&2" %
+                         (self._marker, idx, self._marker, idx))
+            lines.append(u'( %s\n) </dev/null; __rc=$?' % u' '.join(shlex_quote(a) for a in command.args))
+            lines.append(u"printf '\\n%s end %d %%d\\n' $__rc; printf '\\n%s end %d\\n' >&2" %
+                         (self._marker, idx, self._marker, idx))
+            if self.fail_fast:
+                lines.append(u'[ $__rc -eq 0 ] || exit $__rc')
+        lines.append(u'exit 0')
+        return u'\n'.join(lines)
+
+    def parse(self, lines):
+        '''
+        Split the output of the batch script by commands, the duration of command is measured
+        between the arrival of its start and end markers
+
+        :param lines: the iterator of (stream name, line) tuples, see ExecStream
+        '''
+        output = {u'stdout': None, u'stderr': None}
+        started = None
+        for name, line in lines:
+            if line.startswith(self._marker):
+                fields = line.split()
+                command = self.commands[int(fields[2])]
+                if fields[1] == u'start':
+                    output[name] = []
+                    if name == u'stdout':
+                        started = time.time()
+                    continue
+                setattr(command, name, u'\n'.join(output[name]))
+                output[name] = None
+                if name == u'stdout':
+                    command.exit_code = int(fields[3])
+                    command.duration = time.time() - started
+            elif output[name] is not None:
+                output[name].append(line)
+
+    def report(self):
+        '''
+        Report failed command, the same way as failed `docker exec`
+        '''
+        for command in self.commands:
+            if command.exit_code is None:
+                logger.warning(**{u'msg': u'Command was not executed', u'command.args': command.args})
+            elif command.exit_code != 0:
+                logger.error(**{u'msg': u'Command execution failed',
+                                u'command.args': command.args,
+                                u'exit.code': command.exit_code})
+                if command.stdout:
+                    print(command.stdout)
+                if command.stderr:
+                    print(command.stderr)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __repr__(self):
+        return '<Batch commands=%d ok=%s>' % (len(self.commands), self.ok)
+
@@ -0,0 +1,289 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import re
+import sys
+import time
+import multiprocessing
+
+from six import text_type, string_types
+
+from builder import trace
+from builder.log import Logger
+from builder.pool import ContainerPool
+from builder.cache import StepCache
+from builder.squash import squash_container
+from builder.docker import docker_client
+from builder.inventory import get_inventory
+from builder.scheduler import Scheduler
+from builder.container import ContainerContext
+from builder.dataloader import DataLoader
+
+logger = Logger(__name__)
+
+BUILD_OK = u'ok'
+BUILD_FAILED = u'failed'
+
+# the keys of build target in the manifest, the same as `build` options
+TARGET_REQUIRED_KEYS = (u'source_image_name', u'target_image_name', u'build_module')
+TARGET_OPTIONAL_KEYS = (u'build_modules_path', u'vars', u'volumes', u'container_name')
+
+
+def staging_container_name(image_name):
+    '''
+    :param image_name: image name
+    :return: the name of staging container for the image
+    '''
+    return u'%s-build-container' % re.sub(r'[:/#]', u'', image_name)
+
+
+def add_build_modules_path(paths):
+    '''
+    Add build modules paths to sys.path
+    '''
+    for path in paths or []:
+        abspath = os.path.abspath(path)
+        if abspath in sys.path:
+            continue
+        if os.path.exists(abspath):
+            logger.info(msg=u'Adding the build module path to sys.path', path=abspath)
+            sys.path.append(abspath)
+        else:
+            logger.warning(msg=u'The build module path does not exist', path=abspath)
+
+
+# the loader of variables files shared by the builds of the process, like the builds of the server,
+# the file is parsed once while it's not changed
+vars_loader = DataLoader()
+
+
+def load_vars(items, loader=None):
+    '''
+    Load variables from files or JSON/YAML strings
+
+    :param items: the list of file names, JSON/YAML strings or dicts
+    :param loader: DataLoader, default: vars_loader
+    :return: the dict of variables
+    '''
+    loader = loader or vars_loader
+    result = dict()
+    for item in items or []:
+        if isinstance(item, dict):
+            result.update(item)
+        elif os.path.exists(item):
+            for kvs in loader.load_from_file(item):
+                result.update(kvs)
+        else:
+            data = loader.load(item)
+            if data is None:
+                raise ValueError('Cannot parse variables, %s' % item)
+            for kvs in data:
+                result.update(kvs)
+    return result
+
+
+def build_image(source_image_name, target_image_name, build_module, vars=None, volumes=None,
+                container_name=None, rerun=False, remove_staging=False, session=False, use_cache=True,
+                warm_pool=0, squash=None):
+    '''
+    Build target image: run staging container from source image, execute the build module
+    in the container and commit it to target image
+
+    :param source_image_name: source (base) image name
+    :param target_image_name: target image name
+    :param build_module: the name of build module
+    :param vars: the dict of variables, passed to BuildModule.run()
+    :param volumes: the list of volumes, format: host-path:container-path
+    :param container_name: staging container name, default: derived from source image name
+    :param rerun: re-run container if exists
+    :param remove_staging: remove staging container after commit
+    :param session: execute commands in one persistent shell session
+    :param use_cache: use the build cache
+    :param warm_pool: the size of the pool of idle base containers, the staging container is checked out
+        from the pool and the pool is refilled in the background. The pool is not used with volumes
+    :param squash: squash the image, SQUASH_ALL or SQUASH_BUILD, see squash_container(). The build cache
+        is not used: the changes of the staging container must be made on top of the source image
+    :return: the dict with build result
+    '''
+    with trace.span(u'build', source=source_image_name, target=target_image_name) as span:
+        started = time.time()
+        result = {
+            u'target': target_image_name,
+            u'source': source_image_name,
+            u'status': BUILD_FAILED,
+            u'image.id': None,
+            u'error': None,
+        }
+
+        def finish(error=None):
+            result[u'error'] = error
+            result[u'duration'] = round(time.time() - started, 3)
+            span.set(u'status', result[u'status'])
+            return result
+
+        if squash and use_cache:
+            logger.info(**{u'msg': u'The build cache is disabled for the squashed image',
+                           u'image.name': target_image_name})
+            use_cache = False
+
+        docker_cli = docker_client()
+
+        inventory = get_inventory(docker_cli)
+        if not inventory.image(source_image_name):
+            logger.error(**{u'msg': u'Source image does not exist', u'image.name': source_image_name})
+            logger.info(**{u'msg': u'Available images', u'images': inventory.image_names()})
+            return finish(u'Source image does not exist, %s' % source_image_name)
+
+        container_name = container_name or staging_container_name(source_image_name)
+        checked_out = None
+        with trace.span(u'build.container', container=container_name) as container_span:
+            if warm_pool and not volumes:
+                pool = ContainerPool(docker_cli, source_image_name, size=warm_pool)
+                checked_out = pool.checkout(container_name, rerun=rerun)
+                # the pool is refilled in the background, the build does not wait for it, see close_pools()
+                pool.refill()
+            container_span.set(u'pool.hit', bool(checked_out))
+            if not checked_out:
+                docker_cli.run_base_container(image_name=source_image_name,
+                                              container_name=container_name,
+                                              rerun=rerun,
+                                              volumes=volumes)
+        try:
+            module = __import__(build_module, globals(), locals(), ['BuildModule',])
+        except ImportError as err:
+            logger.error(**{u'msg': u'Cannot execute run() from the build module',
+                            u'build.script': build_module,
+                            u'error.msg': text_type(err)})
+            return finish(text_type(err))
+
+        error = None
+        try:
+            cache = StepCache(docker_cli, source_image_name, container_name, volumes=volumes) if use_cache else None
+            ctxt = ContainerContext(container_name, session=session, cache=cache)
+            with trace.span(u'build.module', module=build_module):
+                try:
+                    module.BuildModule(ctxt).run(**(vars or {}))
+                finally:
+                    ctxt.close()
+            if cache:
+                cache.report()
+            with trace.span(u'build.commit', image=target_image_name, squash=squash or u''):
+                if cache and cache.final_image():
+                    if docker_cli.tag(cache.final_image(), target_image_name):
+                        result[u'image.id'] = cache.final_image()
+                elif squash:
+                    squashed = squash_container(docker_cli, container_name, source_image_name, target_image_name,
+                                                mode=squash)
+                    if squashed:
+                        result.update(squashed)
+                else:
+                    result[u'image.id'] = docker_cli.commit(container_name, target_image_name,
+                                                            changes=docker_cli.command_changes(source_image_name)) or None
+            if result[u'image.id']:
+                result[u'status'] = BUILD_OK
+            else:
+                error = u'Cannot commit the container to the image'
+        except AttributeError as err:
+            logger.error(**{u'msg': u'Cannot execute run() from the build script',
+                            u'build.script': build_module,
+                            u'error.msg': text_type(err)})
+            error = text_type(err)
+
+        if remove_staging:
+            # the container was committed, it's killed without waiting for the stop timeout
+            staging_container = inventory.container(container_name)
+            if staging_container:
+                docker_cli.teardown(staging_container[u'id'])
+        return finish(error)
+
+
+def load_manifest(filename, loader=None):
+    '''
+    Load build manifest, YAML/JSON file with the list of targets
+
+        targets:
+        - source_image_name: alpine:3.5
+          target_image_name: ownport/python:alpine-3.5
+          build_module: python_build
+          build_modules_path: [ builds/ ]
+          vars: [ vars/python.yml, { version: 2.7 } ]
+          volumes: [ /tmp/cache:/cache ]
+
+    :param filename: manifest file name
+    :param loader: DataLoader
+    :return: the list of targets
+    '''
+    targets = []
+    for doc in (loader or DataLoader()).load_from_file(filename) or []:
+        if not isinstance(doc, dict) or not isinstance(doc.get(u'targets'), list):
+            raise ValueError('The manifest must contain the list of targets, %s' % filename)
+        targets.extend(doc[u'targets'])
+
+    for target in targets:
+        missing = [k for k in TARGET_REQUIRED_KEYS if not target.get(k)]
+        if missing:
+            raise ValueError('The target has no required keys: %s, %s' % (', '.join(missing), target))
+        unknown = [k for k in target if k not in TARGET_REQUIRED_KEYS + TARGET_OPTIONAL_KEYS]
+        if unknown:
+            raise ValueError('The target has unknown keys: %s, %s' % (', '.join(unknown), target))
+        for key in (u'build_modules_path', u'vars', u'volumes'):
+            if isinstance(target.get(key), (string_types, dict)):
+                target[key] = [target[key]]
+    return targets
+
+
+def build_target(target, **options):
+    '''
+    Build the target of the manifest, the staging container name is derived from target image name
+    to run the builds of the same source image concurrently
+
+    :param target: the target of the manifest
+    :param options: build_image() options
+    :return: the dict with build result
+    '''
+    add_build_modules_path(target.get(u'build_modules_path'))
+    try:
+        _vars = load_vars(target.get(u'vars'))
+    except (ValueError, IOError) as err:
+        logger.error(msg=u'Cannot load variables, %s' % err, target=target[u'target_image_name'])
+        return {u'target': target[u'target_image_name'], u'source': target[u'source_image_name'],
+                u'status': BUILD_FAILED, u'image.id': None, u'error': text_type(err), u'duration': 0.0}
+    return build_image(target[u'source_image_name'], target[u'target_image_name'], target[u'build_module'],
+                       vars=_vars, volumes=target.get(u'volumes'),
+                       container_name=target.get(u'container_name') or
+                       staging_container_name(target[u'target_image_name']),
+                       **options)
+
+
+def build_all(targets, jobs=None, durations=None, **options):
+    '''
+    Build the targets concurrently, the target is started as soon as its parent target
+    (the target which image is the source image of the target) was built
+
+    :param targets: the list of targets, see load_manifest()
+    :param jobs: the number of concurrent builds, default: the number of CPUs
+    :param durations: the dict of build durations from the previous runs, see BuildHistory
+    :param options: build_image() options
+    :return: the list of build results, in topological order
+    '''
+    jobs = jobs or multiprocessing.cpu_count()
+    logger.info(**{u'msg': u'Building targets', u'targets': len(targets), u'jobs': jobs})
+    return Scheduler(targets, lambda target: build_target(target, **options),
+                     jobs=jobs, durations=durations).run()
+
+
+def format_summary(results):
+    '''
+    :param results: the list of build results
+    :return: the summary table of builds
+    '''
+    width = max([len(r[u'target']) for r in results] + [len(u'TARGET')])
+    lines = [u'%-*s  %-6s  %9s  %s' % (width, u'TARGET', u'STATUS', u'TIME, s', u'ERROR')]
+    for r in results:
+        lines.append(u'%-*s  %-6s  %9.3f  %s' % (width, r[u'target'], r[u'status'], r[u'duration'],
+                                                 r[u'error'] or u''))
+    failed = len([r for r in results if r[u'status'] == BUILD_FAILED])
+    skipped = len([r for r in results if r[u'status'] not in (BUILD_OK, BUILD_FAILED)])
+    lines.append(u'%d target(-s), %d failed, %d skipped, %.3f s total build time' % (
+        len(results), failed, skipped, sum(r[u'duration'] for r in results)))
+    return u'\n'.join(lines)
@@ -0,0 +1,193 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import base64
+import hashlib
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+CACHE_KEY_LABEL = u'builder.cache.key'
+CACHE_RESULT_LABEL = u'builder.cache.result'
+
+# the size of the step result in the label, the label is the argument of `docker commit` and the size of
+# one argument is limited by the kernel (128K on Linux). The longer strings of the result keep their tails
+MAX_RESULT_SIZE = 32 * 1024
+TRUNCATED_MARK = u'[truncated %d characters]\n'
+
+
+def hash_path(path):
+    '''
+    Hash the content, names and modes of the file or the directory tree
+
+    :param path: host path
+    :return: sha256 hex digest
+    '''
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                digest.update(os.path.relpath(filename, path).encode('utf-8'))
+                digest.update(hash_path(filename).encode('utf-8'))
+    elif os.path.exists(path):
+        digest.update(('%o' % (os.stat(path).st_mode & 0o7777)).encode('utf-8'))
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _truncate(value, limit):
+    if isinstance(value, type(u'')) and len(value) > limit:
+        return TRUNCATED_MARK % (len(value) - limit) + value[len(value) - limit:]
+    if isinstance(value, (list, tuple)):
+        return [_truncate(v, limit) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _truncate(v, limit)) for k, v in value.items())
+    return value
+
+
+def encode_result(result, size=MAX_RESULT_SIZE):
+    '''
+    :param result: the step result, JSON serializable
+    :param size: the maximum size of the encoded result
+    :return: the result encoded for the label, the strings of the result are truncated to fit the size
+    '''
+    limit = size
+    while True:
+        data = json.dumps(_truncate(result, limit) if limit < size else result).encode('utf-8')
+        encoded = base64.urlsafe_b64encode(data).decode('ascii')
+        if len(encoded) <= size or limit == 0:
+            if limit < size:
+                logger.warning(**{u'msg': u'The step result was truncated for the build cache',
+                                  u'result.size': len(json.dumps(result))})
+            return encoded
+        limit //= 2
+
+
+def decode_result(encoded):
+    '''
+    :return: the step result, see encode_result()
+    '''
+    return json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+
+
+class StepCache(object):
+    '''
+    The build cache, it works like Dockerfile build cache. After each step the staging container
+    is committed to the intermediate image labelled by the step key, the hash of (parent key, step
+    kind, arguments, hashes of copied files). The chain starts from the source image id.
+
+    While the steps are found in the cache they are not executed, the first miss restarts
+    the staging container from the deepest cached image and the build continues from there.
+
+    Usage:
+
+        cache = StepCache(docker_cli, 'alpine:3.5', 'alpine3.5-build-container')
+        stdout = cache.step(u'cmd', ['apk', 'update'], run)
+        ...
+        cache.final_image()     # the image id if all steps were found in the cache
+    '''
+    def __init__(self, cli, source_image_name, container_name, volumes=None):
+        '''
+        :param cli: docker client
+        :param source_image_name: source (base) image name
+        :param container_name: staging container name
+        :param volumes: the volumes of staging container, to restart it from cached image
+        '''
+        self._cli = cli
+        self._container_name = container_name
+        self._volumes = volumes
+        self._key = cli.inspect_image(source_image_name, '.Id') or source_image_name
+        # the cached images are tagged as the target image, they keep the command of the source image
+        self._changes = cli.command_changes(source_image_name)
+        self._image = None
+        self._replaying = True
+        # the state of container is unknown after failed step, the steps are not cached anymore
+        self._tainted = False
+        self._restart_hooks = []
+        self.hits = 0
+        self.misses = 0
+
+    def on_restart(self, hook):
+        '''
+        Register the function called after the staging container was restarted from cached image
+        '''
+        self._restart_hooks.append(hook)
+
+    def fingerprint(self, kind, args, files=()):
+        '''
+        :return: the key of the step which follows the current one
+        '''
+        digest = hashlib.sha256()
+        digest.update(self._key.encode('utf-8'))
+        digest.update(json.dumps([kind, args], sort_keys=True).encode('utf-8'))
+        for path in files:
+            digest.update(hash_path(path).encode('utf-8'))
+        return digest.hexdigest()
+
+    def materialize(self):
+        '''
+        Make the staging container reflect all steps, the following steps are not looked up in the cache.
+        It's required before any operation which reads the state of the container
+        '''
+        if not self._replaying:
+            return
+        self._replaying = False
+        if self._image:
+            logger.info(**{u'msg': u'Restarting staging container from cached image',
+                           u'container.name': self._container_name,
+                           u'image.id': self._image})
+            self._cli.run_base_container(self._image, self._container_name, rerun=True, volumes=self._volumes)
+            for hook in self._restart_hooks:
+                hook()
+
+    def step(self, kind, args, run, files=()):
+        '''
+        Execute the step or take its result from the cache
+
+        :param kind: step kind, like cmd, copy, batch
+        :param args: step arguments, JSON serializable
+        :param run: the function which executes the step and returns the tuple (ok, result),
+            the result of successful step must be JSON serializable
+        :param files: host paths which content is a part of the step
+        :return: the tuple (hit, result)
+        '''
+        key = self.fingerprint(kind, args, files)
+        if self._replaying:
+            image_ids = self._cli.image_ids(u'%s=%s' % (CACHE_KEY_LABEL, key))
+            if image_ids:
+                labels = self._cli.inspect_image(image_ids[0], '.Config.Labels') or {}
+                if CACHE_RESULT_LABEL in labels:
+                    self.hits += 1
+                    self._key, self._image = key, image_ids[0]
+                    logger.info(**{u'msg': u'Cache hit', u'step.kind': kind, u'step.args': args,
+                                   u'image.id': self._image})
+                    return True, decode_result(labels[CACHE_RESULT_LABEL])
+            self.materialize()
+
+        if self._tainted:
+            return False, run()[1]
+
+        self.misses += 1
+        logger.info(**{u'msg': u'Cache miss', u'step.kind': kind, u'step.args': args})
+        ok, result = run()
+        if ok and self._cli.commit(self._container_name, changes=self._changes, labels={
+                CACHE_KEY_LABEL: key, CACHE_RESULT_LABEL: encode_result(result)}):
+            self._key = key
+        else:
+            self._tainted = True
+        return False, result
+
+    def final_image(self):
+        '''
+        :return: the image id if all steps were found in the cache, otherwise None
+        '''
+        return self._image if self._replaying else None
+
+    def report(self):
+        logger.info(**{u'msg': u'Build cache', u'cache.hits': self.hits, u'cache.misses': self.misses})
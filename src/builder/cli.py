@@ -2,22 +2,25 @@ from __future__ import (absolute_import, division, print_function)
 
 import os
 import sys
-import json
 import logging
 import argparse
 
-from builder import BUILDER_VERSION
+from builder import (BUILDER_VERSION, DOCKER_BACKENDS, TRACE_FORMATS, TRACE_CHROME, DEFAULT_SAMPLING_INTERVAL,
+                     LATENCIES, LATENCY_ZERO)
 from builder.log import Logger
-from builder.docker import DockerCLI
-from builder.container import ContainerContext
-from builder.dataloader import DataLoader
+
+# the modules of docker client, build, tracing, profiling and their dependencies (sh, yaml, six) are imported
+# by the commands and the options which use them, so `--help`, `--version` and `halt` start fast
 
 BUILDER_USAGE = '''docker-image-builer <command> [<args>]
 
 The list of commands:
    run              run Docker image           
    build            build Docker image
+   build-all        build Docker images from the build manifest
+   pool             list, fill and drain the pools of idle base containers
    halt             stop and remove container(-s)
+   serve            run the resident builder server, the commands are sent to it by --server
 '''
 
 # Set default logging handler to avoid "No handler found" warnings.
@@ -32,16 +35,55 @@ logger = Logger(__name__)
 
 
 class CLI(object):
-    def __init__(self):
+    def __init__(self, served=False):
+        '''
+        :param served: the command is served by the worker of the builder server, the inventories
+            are kept for the next requests and the pools are refilled in the background
+        '''
         parser = argparse.ArgumentParser(usage=BUILDER_USAGE)
         parser.add_argument('-v', '--version', action='version',
                             version='docker-image-builder-v{}'.format(BUILDER_VERSION))
         parser.add_argument('-l', '--log_level', default='INFO',
                             help='Log level: DEBUG, INFO, WARNING, ERROR, CRITICAL')
+        parser.add_argument('--docker-backend', dest='docker_backend', choices=DOCKER_BACKENDS,
+                            default=os.environ.get('BUILDER_DOCKER_BACKEND', 'cli'),
+                            help='Docker backend: cli (docker client) or api (Engine API over the socket), '
+                                 'default: $BUILDER_DOCKER_BACKEND or cli')
+        parser.add_argument('--trace-file', dest='trace_file',
+                            help='write the timing trace of docker operations and build steps to the file')
+        parser.add_argument('--trace-format', dest='trace_format', choices=TRACE_FORMATS, default=TRACE_CHROME,
+                            help='trace file format: chrome (Chrome trace events, chrome://tracing, Perfetto) '
+                                 'or otlp (OTLP JSON), default: %s' % TRACE_CHROME)
+        parser.add_argument('--metrics-dir', dest='metrics_dir', default=os.environ.get('BUILDER_METRICS_DIR'),
+                            help='write the metrics of docker operations, build stages and the build cache '
+                                 'to the directory of node_exporter textfile collector at exit, '
+                                 'default: $BUILDER_METRICS_DIR')
+        parser.add_argument('--profile', dest='profile',
+                            help='profile the builder by cProfile and write the stats to the file, for pstats')
+        parser.add_argument('--profile-sampling', dest='profile_sampling',
+                            help='sample the stacks of the builder threads and write the collapsed stacks '
+                                 'to the file, for flame graphs')
+        parser.add_argument('--profile-interval', dest='profile_interval', type=float,
+                            default=DEFAULT_SAMPLING_INTERVAL,
+                            help='the sampling interval, seconds, default: %s' % DEFAULT_SAMPLING_INTERVAL)
+        parser.add_argument('--record', dest='record',
+                            help='record the docker commands and Docker Engine API requests: the arguments, '
+                                 'the outputs, the exit code and the wall time, to the directory')
+        parser.add_argument('--replay', dest='replay',
+                            help='replay the docker commands and API requests recorded by --record '
+                                 'instead of running them')
+        parser.add_argument('--replay-latency', dest='replay_latency', choices=LATENCIES, default=LATENCY_ZERO,
+                            help='real (the recorded wall time) or zero, default: %s' % LATENCY_ZERO)
+        parser.add_argument('--server', dest='server', default=os.environ.get('BUILDER_SERVER'),
+                            help='send run, build, build-all, pool and halt commands to the builder server '
+                                 'listening on the unix socket, see serve command, default: $BUILDER_SERVER')
         parser.add_argument('command', help='Subcommand to run')
-        args = parser.parse_args(sys.argv[1:2])
+        parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+        args = parser.parse_args(sys.argv[1:])
 
-        if not hasattr(self, args.command):
+        # the commands like `build-all` are dispatched to the methods like `build_all`
+        command = args.command.replace('-', '_')
+        if command.startswith('_') or not hasattr(self, command):
             print('Unrecognized command: %s' % args.command)
             sys.exit(1)
 
@@ -49,11 +91,77 @@ class CLI(object):
                             handler=NullHandler(),
                             format="%(asctime)s (%(name)s) [%(levelname)s] %(message)s")
 
-        # use dispatch pattern to invoke method with same name
-        getattr(self, args.command)()
+        if args.server and args.command != 'serve':
+            from builder.server import SERVED_COMMANDS, send_request, strip_option
+            if args.command in SERVED_COMMANDS:
+                import socket
+                try:
+                    sys.exit(send_request(args.server, strip_option(sys.argv[1:], '--server')))
+                except socket.error as err:
+                    logger.warning(**{u'msg': u'Builder server is not available, the command runs locally, %s' % err,
+                                      u'server.socket': args.server})
+
+        # the backend is passed via environment to every docker client of the process
+        os.environ['BUILDER_DOCKER_BACKEND'] = args.docker_backend
+        # the docker commands and Docker Engine API requests are recorded or replayed by both backends
+        stop_shim = None
+        if args.record:
+            from builder.replay import start_recording
+            stop_shim = start_recording(args.record)
+        elif args.replay:
+            from builder.replay import start_replay
+            stop_shim = start_replay(args.replay, args.replay_latency)
+
+        registry = None
+        if args.metrics_dir and args.command == 'serve':
+            # the server collects the metrics of the served requests, see serve command
+            os.environ['BUILDER_METRICS_DIR'] = args.metrics_dir
+        elif args.metrics_dir:
+            from builder.metrics import Registry
+            registry = Registry()
+        tracer = None
+        if args.trace_file or registry:
+            from builder import trace
+            tracer = trace.enable(record=bool(args.trace_file))
+            if registry:
+                tracer.listeners.append(registry.observe_span)
+        profilers = []
+        if args.profile or args.profile_sampling:
+            from builder.profiler import Profiler, SamplingProfiler
+            if args.profile:
+                profilers.append((Profiler().start(), args.profile))
+            if args.profile_sampling:
+                profilers.append((SamplingProfiler(interval=args.profile_interval).start(), args.profile_sampling))
+        try:
+            # use dispatch pattern to invoke method with same name
+            getattr(self, command)(args.args)
+        finally:
+            # the refills of the container pools use the inventories, they are waited for
+            pool = sys.modules.get('builder.pool')
+            if pool and not served:
+                pool.close_pools()
+            # the docker events watchers of the inventories are stopped, they exist only if the module was used
+            inventory = sys.modules.get('builder.inventory')
+            if inventory and not served:
+                inventory.close_inventories()
+            for profiler, path in profilers:
+                profiler.stop()
+                # the shares of time spent in the components of the builder and blocked on docker, percents
+                logger.info(**{u'msg': u'Profile was written', u'profile.file': path,
+                               u'profile.breakdown': profiler.write(path)})
+            if tracer:
+                trace.disable()
+            if args.trace_file:
+                tracer.write(args.trace_file, args.trace_format)
+                logger.info(**{u'msg': u'Trace was written', u'trace.file': args.trace_file,
+                               u'trace.format': args.trace_format, u'spans': len(tracer.spans)})
+            if registry:
+                registry.write_textfile(args.metrics_dir)
+            if stop_shim:
+                stop_shim()
 
     @staticmethod
-    def run():
+    def run(argv):
         parser = argparse.ArgumentParser(description='run base image')
         parser.add_argument('-i', '--image_name', dest='image_name', required=True,
                             help="the image name")
@@ -61,20 +169,26 @@ class CLI(object):
                             help="the container name")
         parser.add_argument('--re-run', dest='rerun', action='store_true',
                             help="re-run container if exists, default: False")
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(argv)
+
+        from builder.docker import docker_client
+        from builder.inventory import get_inventory
 
-        docker_cli = DockerCLI()
+        docker_cli = docker_client()
 
-        images_list = ["%s:%s" % (i[u'repository'], i[u'tag']) for i in docker_cli.images_list()]
-        if args.image_name not in images_list:
+        inventory = get_inventory(docker_cli)
+        if not inventory.image(args.image_name):
             logger.error(**{u'msg': u'Image does not exist', u'image.name': args.image_name})
-            logger.info(**{u'msg': u'Available images', u'images': images_list})
+            logger.info(**{u'msg': u'Available images', u'images': inventory.image_names()})
             sys.exit(1)
 
         docker_cli.run_base_container(args.image_name, args.container_name, rerun=args.rerun)
 
     @staticmethod
-    def build():
+    def build(argv):
+        from builder.build import BUILD_OK, add_build_modules_path, load_vars, build_image
+        from builder.squash import SQUASH_ALL, SQUASH_BUILD, SQUASH_MODES
+
         parser = argparse.ArgumentParser(description='build Docker image')
         parser.add_argument('-s', '--source_image_name', dest='source_image_name', required=True,
                             help="source (base) image name")
@@ -90,100 +204,235 @@ class CLI(object):
                             help="remove staging container after commit")
         parser.add_argument('--enable-sh-logging', action='store_true',
                             help='Enable sh module logging, default: disabled')
+        parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                            help="do not use the build cache, default: False")
+        parser.add_argument('--session', dest='session', action='store_true',
+                            help="execute commands in one persistent shell session, default: False")
+        parser.add_argument('--warm-pool', dest='warm_pool', type=int, default=0,
+                            help="check out the staging container from the pool of N idle base containers "
+                                 "and refill the pool in the background, default: 0 (no pool)")
+        parser.add_argument('--squash', dest='squash', nargs='?', const=SQUASH_ALL, choices=SQUASH_MODES,
+                            help="squash the image: '%s' - the whole filesystem to one layer, '%s' - the changes "
+                                 "of the build to one layer on top of the source image, default: %s, "
+                                 "the build cache is not used" % (SQUASH_ALL, SQUASH_BUILD, SQUASH_ALL))
         parser.add_argument('--volume', dest='volume', action='append',
                             help="mount the volume to the container, format: host-path:container-path")
         parser.add_argument('--vars', dest='vars', action='append',
                             help="variables file")
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(argv)
 
         if args.enable_sh_logging:
             logging.getLogger('sh').setLevel('INFO')
         else:
             logging.getLogger('sh').setLevel(logging.WARNING)
 
-        if args.build_modules_path:
-            for path in args.build_modules_path:
-                abspath = os.path.abspath(path)
-                if os.path.exists(abspath):
-                    logger.info(msg=u'Adding the build module path to sys.path', path=abspath)
-                    sys.path.append(abspath)
-                else:
-                    logger.warning(msg=u'The build module path does not exist', path=abspath)
-
-        vars = dict()
-        if args.vars:
-            for _vars in args.vars:
-                if os.path.exists(_vars):
-                    for kvs in DataLoader().load_from_file(_vars):
-                        vars.update(kvs)
-                else:
-                    try:
-                        for kvs in DataLoader().load(_vars):
-                            vars.update(kvs)
-                    except ValueError as err:
-                        logger.error(msg=u'Cannot parse --vars argument. %s' % err,
-                                     vars=_vars)
-                        sys.exit(1)
-
-        docker_cli = DockerCLI()
-
-        images_list = ["%s:%s" % (i[u'repository'], i[u'tag']) for i in docker_cli.images_list()]
-        if args.source_image_name not in images_list:
-            logger.error(**{u'msg': u'Source image does not exist', u'image.name': args.source_image_name})
-            logger.info(**{u'msg': u'Available images', u'images': images_list})
+        add_build_modules_path(args.build_modules_path)
+        try:
+            vars = load_vars(args.vars)
+        except ValueError as err:
+            logger.error(msg=u'Cannot parse --vars argument. %s' % err, vars=args.vars)
+            sys.exit(1)
+
+        result = build_image(args.source_image_name, args.target_image_name, args.build_module,
+                             vars=vars,
+                             volumes=args.volume,
+                             rerun=args.rerun,
+                             remove_staging=args.remove_staging,
+                             session=args.session,
+                             use_cache=not args.no_cache,
+                             warm_pool=args.warm_pool,
+                             squash=args.squash)
+        if result[u'status'] != BUILD_OK:
             sys.exit(1)
 
-        container_name = '%s-build-container' % args.source_image_name.translate(None, ':/#')
-        docker_cli.run_base_container(image_name=args.source_image_name,
-                                      container_name=container_name,
-                                      rerun=args.rerun,
-                                      volumes=args.volume)
+    @staticmethod
+    def build_all(argv):
+        import multiprocessing
+
+        from builder.build import BUILD_OK, load_manifest, build_all, format_summary
+        from builder.scheduler import BuildGraph, BuildHistory
+        from builder.squash import SQUASH_ALL, SQUASH_BUILD, SQUASH_MODES
+
+        parser = argparse.ArgumentParser(prog='build-all', description='build Docker images from the build manifest')
+        parser.add_argument('-m', '--manifest', dest='manifest', required=True,
+                            help="build manifest, YAML/JSON file with the list of targets")
+        parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=multiprocessing.cpu_count(),
+                            help="the number of concurrent builds, default: the number of CPUs")
+        parser.add_argument('--history', dest='history', default='.builder-history.json',
+                            help="the file with build durations of the previous runs, they are used "
+                                 "to start the longest chains of targets first, default: .builder-history.json")
+        parser.add_argument('--re-run', dest='rerun', action='store_true',
+                            help="re-run containers if exist, default: False")
+        parser.add_argument('--remove-staging', dest='remove_staging', action='store_true',
+                            help="remove staging containers after commit")
+        parser.add_argument('--enable-sh-logging', action='store_true',
+                            help='Enable sh module logging, default: disabled')
+        parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                            help="do not use the build cache, default: False")
+        parser.add_argument('--session', dest='session', action='store_true',
+                            help="execute commands in one persistent shell session, default: False")
+        parser.add_argument('--warm-pool', dest='warm_pool', type=int, default=0,
+                            help="check out staging containers from the pools of N idle base containers "
+                                 "and refill the pools in the background, default: 0 (no pool)")
+        parser.add_argument('--squash', dest='squash', nargs='?', const=SQUASH_ALL, choices=SQUASH_MODES,
+                            help="squash the image: '%s' - the whole filesystem to one layer, '%s' - the changes "
+                                 "of the build to one layer on top of the source image, default: %s, "
+                                 "the build cache is not used" % (SQUASH_ALL, SQUASH_BUILD, SQUASH_ALL))
+        args = parser.parse_args(argv)
+
+        if args.enable_sh_logging:
+            logging.getLogger('sh').setLevel('INFO')
+        else:
+            logging.getLogger('sh').setLevel(logging.WARNING)
+
         try:
-            module = __import__(args.build_module, globals(), locals(), ['BuildModule',])
-            try:
-                module.BuildModule(ContainerContext(container_name)).run(**vars)
-                docker_cli.commit(container_name, args.target_image_name)
-            except AttributeError as err:
-                logger.error(**{u'msg': u'Cannot execute run() from the build script',
-                                u'build.script': args.build_module,
-                                u'error.msg': err})
-
-            if args.remove_staging:
-                staging_container_id = [c[u'id'] for c in docker_cli.containers_list()
-                                        if container_name == c[u'names']]
-                docker_cli.stop_containers(*staging_container_id)
-                docker_cli.remove_containers(*staging_container_id)
-        except ImportError as err:
-            logger.error(**{u'msg': u'Cannot execute run() from the build module',
-                            u'build.script': args.build_module,
-                            u'error.msg': err.message})
+            targets = load_manifest(args.manifest)
+            BuildGraph(targets)
+        except (ValueError, IOError) as err:
+            logger.error(msg=u'Cannot load the build manifest. %s' % err, manifest=args.manifest)
+            sys.exit(1)
+
+        history = BuildHistory(args.history)
+        results = build_all(targets, jobs=args.jobs, durations=history.durations,
+                            rerun=args.rerun,
+                            remove_staging=args.remove_staging,
+                            session=args.session,
+                            use_cache=not args.no_cache,
+                            warm_pool=args.warm_pool,
+                            squash=args.squash)
+        history.update(results)
+        history.save()
+        print(format_summary(results))
+        if any(r[u'status'] != BUILD_OK for r in results):
             sys.exit(1)
 
     @staticmethod
-    def halt():
+    def pool(argv):
+        import time
+
+        from builder.docker import docker_client
+        from builder.pool import ContainerPool, pool_containers, DEFAULT_TTL
+
+        parser = argparse.ArgumentParser(prog='pool', description='manage the pools of idle base containers')
+        parser.add_argument('action', choices=('list', 'fill', 'drain'),
+                            help="list idle containers, fill the pool up to the size or remove idle containers")
+        parser.add_argument('-s', '--source_image_name', dest='source_image_name',
+                            help="source (base) image name, required for fill, default: all pools")
+        parser.add_argument('-n', '--size', dest='size', type=int, default=1,
+                            help="the number of idle containers, default: 1")
+        parser.add_argument('--ttl', dest='ttl', type=int, default=DEFAULT_TTL,
+                            help="remove containers idle longer than TTL seconds on fill, default: %d" % DEFAULT_TTL)
+        args = parser.parse_args(argv)
+
+        docker_cli = docker_client()
+
+        if args.action == 'list':
+            for cont in pool_containers(docker_cli, args.source_image_name):
+                print('%-12s  %-40s  %-20s  %6ds  %s' % (cont[u'id'][:12], cont[u'name'], cont[u'image'],
+                                                         time.time() - cont[u'created'], cont[u'status']))
+        elif args.action == 'fill':
+            if not args.source_image_name:
+                parser.error('the source image name is required for fill')
+            pool = ContainerPool(docker_cli, args.source_image_name, size=args.size, ttl=args.ttl)
+            pool.evict()
+            pool.fill()
+        else:
+            images = [args.source_image_name] if args.source_image_name else \
+                sorted(set(c[u'image'] for c in pool_containers(docker_cli)))
+            for image_name in images:
+                ContainerPool(docker_cli, image_name).drain()
+
+    @staticmethod
+    def halt(argv):
+        from builder.docker import docker_client, teardown_containers, DEFAULT_STOP_GRACE, TEARDOWN_BATCH_SIZE, \
+            TEARDOWN_JOBS
+
         parser = argparse.ArgumentParser(description='stop and remove containers')
         parser.add_argument('-c', '--container_id', dest='container_id', action='append',
                             help="the container id(-s)")
         parser.add_argument('--all', dest='all', action='store_true',
                             help="stop and remove all containers")
+        parser.add_argument('-f', '--filter', dest='filter', action='append', default=[],
+                            help="stop and remove all containers matching the filter, applied by docker daemon, "
+                                 "format: key=value, like label=builder or ancestor=alpine:3.5")
+        parser.add_argument('-g', '--grace', dest='grace', type=int, default=DEFAULT_STOP_GRACE,
+                            help="the grace period before the container is killed, seconds, default: %d "
+                                 "(kill at once)" % DEFAULT_STOP_GRACE)
+        parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=TEARDOWN_JOBS,
+                            help="the number of concurrent teardown batches, default: %d" % TEARDOWN_JOBS)
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=TEARDOWN_BATCH_SIZE,
+                            help="the number of containers per teardown batch, default: %d" % TEARDOWN_BATCH_SIZE)
 
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(argv)
 
-        if not args.container_id and not args.all:
+        filters = dict()
+        for _filter in args.filter:
+            key, sep, value = _filter.partition('=')
+            if not sep:
+                parser.error('the filter format is key=value, %s' % _filter)
+            filters.setdefault(key, []).append(value)
+
+        if not args.container_id and not args.all and not filters:
             parser.print_help()
             sys.exit(1)
 
-        docker_cli = DockerCLI()
+        docker_cli = docker_client()
 
         if args.container_id:
             logger.info(**{u'msg': u'Halting container', u'container.id': args.container_id})
-            docker_cli.stop_containers(args.container_id)
-            docker_cli.remove_containers(args.container_id)
+            docker_cli.teardown(*args.container_id, grace=args.grace)
 
-        if args.all:
-            ids = [c[u'id'] for c in docker_cli.containers_list()]
+        if args.all or filters:
+            ids = [c[u'id'] for c in docker_cli.containers_list(**filters)]
             logger.info(**{u'msg': u'Halting all container(-s)', u'container.ids': ids})
-            docker_cli.stop_containers(*ids)
-            docker_cli.remove_containers(*ids)
+            teardown_containers(docker_cli, ids, grace=args.grace,
+                                batch_size=max(1, args.batch_size), jobs=max(1, args.jobs))
         logger.info(**{u'msg': u'Available containers',
                        u'container.ids': [c[u'id'] for c in docker_cli.containers_list()]})
+
+    @staticmethod
+    def serve(argv):
+        import signal
+
+        from builder.server import BuilderServer, DEFAULT_SOCKET
+
+        parser = argparse.ArgumentParser(prog='serve', description='run the resident builder server')
+        parser.add_argument('-s', '--socket', dest='socket', default=os.environ.get('BUILDER_SERVER', DEFAULT_SOCKET),
+                            help="the unix socket, default: $BUILDER_SERVER or %s" % DEFAULT_SOCKET)
+        parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                            help="the number of workers, the concurrent requests, default: the number of CPUs")
+        parser.add_argument('--warm-image', dest='warm_images', action='append', default=[],
+                            help="keep the pool of idle base containers of the image filled, see pool command")
+        parser.add_argument('--warm-pool', dest='warm_pool', type=int, default=1,
+                            help="the number of idle containers per warm image, default: 1")
+        parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                            help="serve the metrics of the served requests on the local port, GET /metrics. "
+                                 "They are served on the unix socket too and written to --metrics-dir if it's set")
+        args = parser.parse_args(argv)
+
+        # the workers get the modules imported, the server does not start threads before the workers are forked
+        import builder.build
+        from builder.docker import docker_client
+        from builder.inventory import get_inventory
+        from builder.pool import ContainerPool
+
+        def warm_up(number):
+            # every worker keeps the docker connections and the inventory, the first one fills the pools
+            docker_cli = docker_client()
+            get_inventory(docker_cli)
+            if number == 0:
+                for image_name in args.warm_images:
+                    pool = ContainerPool(docker_cli, image_name, size=args.warm_pool)
+                    pool.evict()
+                    pool.fill()
+
+        server = BuilderServer(args.socket, jobs=args.jobs, initializer=warm_up,
+                               metrics_dir=os.environ.get('BUILDER_METRICS_DIR'),
+                               metrics_port=args.metrics_port).bind()
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
@@ -1,23 +1,52 @@
 from __future__ import (absolute_import, division, print_function)
 
+import os
 import shlex
+import contextlib
 
+from six import text_type
+
+from builder import trace
 from builder.log import Logger
-from builder.docker import DockerCLI
+from builder.archive import Content, archive_entries
+from builder.batch import Batch
+from builder.docker import docker_client
+from builder.inventory import get_inventory
+from builder.session import CommandOutput, ShellSession
+from builder.sync import host_manifest, manifest_digest, sync_directory
 from builder.utils import facts as fact_utils
 
 logger = Logger(__name__)
 
 
 class ContainerContext(object):
-    def __init__(self, container_name):
-        self._cli = DockerCLI()
+    def __init__(self, container_name, session=False, cache=None):
+        '''
+        :param container_name: container name
+        :param session: execute cmd()/shell() in the persistent shell session
+            instead of `docker exec` per command, default: False
+        :param cache: StepCache, the build cache for commands and copying to the container
+        '''
+        self._cli = docker_client()
 
-        containers = [c[u'names'] for c in self._cli.containers_list()]
-        if container_name not in containers:
+        if not get_inventory(self._cli).container(container_name):
             raise RuntimeError('Container does not exist, %s' % container_name)
 
         self._container_name = container_name
+        self._session = ShellSession(container_name) if session else None
+        self._batch = None
+        self._cache = cache
+        # the host manifests of synced directories, see sync()
+        self._sync_manifests = dict()
+        if cache:
+            cache.on_restart(self.close)
+
+    def close(self):
+        '''
+        Close the shell session, if any
+        '''
+        if self._session:
+            self._session.close()
 
     def get_logger(self, name=__name__):
         '''
@@ -35,58 +64,144 @@ class ContainerContext(object):
         :return: the dict with facts about container
         '''
         logger.info(msg='Facts gathering')
-        _facts = dict()
-        if 'all' in categories or 'hw' in categories:
-            _facts.update(fact_utils.parse_cpuinfo(self.cmd('cat /proc/cpuinfo')))
-            _facts.update(fact_utils.parse_meminfo(self.cmd('cat /proc/meminfo')))
-
-        if 'all' in categories or 'env' in categories:
-            _facts.update({u'env': fact_utils.parse_env(self.cmd('env'))})
-
-        if 'all' in categories or 'release' in categories:
-            _facts.update({u'release': fact_utils.parse_env(self.shell('cat /etc/*release*'))})
-
-        if 'all' in categories or 'uname' in categories:
-            _facts.update({u'uname': {
-                u'machine.type': self.cmd('uname -m').strip(),
-                u'hardware.platform': self.cmd('uname -i').strip(),
-                u'hostname': self.cmd('uname -n').strip(),
-                u'kernel.release': self.cmd('uname -r').strip(),
-                u'kernel.version': self.cmd('uname -v').strip(),
-                u'kernel.name': self.cmd('uname -s').strip(),
-                u'processor.type': self.cmd('uname -p').strip(),
-                u'os.name': self.cmd('uname -o').strip(),
-            }})
-
-        if 'all' in categories or 'net' in categories:
-            _facts.update({u'net': {
-                u'hostname': self.cmd('cat /etc/hostname').strip()}
-            })
-            _facts[u'net'].update(fact_utils.parse_resolv(self.cmd('cat /etc/resolv.conf')))
-            _facts[u'net'][u'interfaces'] = fact_utils.parse_ifconfig(self.cmd('ifconfig').strip())
-        return _facts
-
-    def cmd(self, command):
-        '''
-        Execute command
-        :param command: command line arguments as string
-        :return: command stdout
-        '''
-        args = shlex.split(command)
-        stdout = self._cli.execute(self._container_name, *args)
-        return stdout
-
-    def shell(self, command):
-        '''
-        Execute command via /bin/sh
+        # the facts are the current state of the container, the cache and the active batch are bypassed
+        if self._cache:
+            self._cache.materialize()
+        # all facts are gathered by one script, in one exec
+        output = self._cli.execute(self._container_name, '/bin/sh', '-c', fact_utils.facts_script(categories))
+        return fact_utils.parse_facts(text_type(output) if output else u'')
+
+    def cmd(self, *commands, **kwargs):
+        '''
+        Execute command(-s), several commands are executed as the batch in one `docker exec`,
+        see batch()
+        :param commands: command line arguments as string
+        :param stream: streaming mode, return ExecStream, the iterator of (stream name, line) tuples
+            where stream name is stdout or stderr
+        :param callback: the function called with (stream name, line) as output arrives,
+            the command runs in streaming mode, ExecStream is returned when the command finished
+        :param raw: stream raw chunks as memoryview instead of lines
+        :return: command stdout, the list of BatchCommand for several commands
+        '''
+        return self._execute([shlex.split(command) for command in commands], **kwargs)
+
+    def shell(self, *commands, **kwargs):
+        '''
+        Execute command(-s) via /bin/sh, several commands are executed as the batch
         
-        :param command: command line arguments as string
-        :return: command stdout
+        :param commands: command line arguments as string
+        :param stream: streaming mode, see cmd()
+        :param callback: the function called with (stream name, line), see cmd()
+        :param raw: stream raw chunks as memoryview instead of lines
+        :return: command stdout, the list of BatchCommand for several commands
+        '''
+        return self._execute([['/bin/sh', '-c', command] for command in commands], **kwargs)
+
+    @contextlib.contextmanager
+    def batch(self, fail_fast=True):
         '''
-        args = ['/bin/sh', '-c', command]
-        # args = shlex.split(command)
-        stdout = self._cli.execute(self._container_name, *args)
-        return stdout
+        Record cmd()/shell() calls and execute them by one script in one `docker exec` on exit.
+        The calls return BatchCommand, its stdout, stderr, exit_code and duration are
+        available after the batch was executed
+
+        Usage:
+
+            with ctxt.batch() as batch:
+                ctxt.cmd('apk update')
+                ctxt.cmd('apk add python')
+            print(batch.ok, [c.exit_code for c in batch])
+
+        :param fail_fast: stop the batch on the first failed command, default: True
+        :return: Batch
+        '''
+        if self._batch is not None:
+            raise RuntimeError('Nested batches are not supported')
+        batch = Batch(fail_fast=fail_fast)
+        self._batch = batch
+        try:
+            yield batch
+        finally:
+            self._batch = None
+        self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        if not batch.commands:
+            return batch
+        logger.info(**{u'msg': u'Execute batch of commands',
+                       u'container.name': self._container_name,
+                       u'commands.args': [c.args for c in batch]})
+
+        def run():
+            batch.parse(self._cli.exec_stream(self._container_name, '/bin/sh', '-c', batch.script()))
+            return batch.ok, [[c.stdout, c.stderr, c.exit_code, c.duration] for c in batch]
+
+        hit, results = self._cached(u'batch', [c.args for c in batch], run)
+        if hit:
+            for command, result in zip(batch, results):
+                command.stdout, command.stderr, command.exit_code, command.duration = result
+        batch.report()
+        return batch
+
+    def _cached(self, kind, args, run, files=()):
+        '''
+        Execute the step via the build cache, if any
+
+        :return: the tuple (hit, result)
+        '''
+        with trace.span(u'step.%s' % kind, container=self._container_name, args=args) as span:
+            if not self._cache:
+                return False, run()[1]
+            hit, result = self._cache.step(kind, args, run, files=files)
+            span.set(u'cache.hit', hit)
+            return hit, result
+
+    def _execute(self, commands, stream=False, callback=None, raw=False):
+        if not commands:
+            raise ValueError('No command to execute')
+        if len(commands) > 1:
+            if self._batch is not None:
+                # the commands are recorded by the active batch in the order of calls
+                return [self._batch.add(args) for args in commands]
+            batch = Batch()
+            for args in commands:
+                batch.add(args)
+            return self._run_batch(batch).commands
+
+        args = commands[0]
+        if not stream and not callback:
+            if self._batch is not None:
+                return self._batch.add(args)
+            return self._run_command(args)
+
+        if self._cache:
+            self._cache.materialize()
+        output = self._cli.exec_stream(self._container_name, *args, raw=raw)
+        if callback:
+            for name, data in output:
+                callback(name, data)
+        return output
+
+    def _run_command(self, args):
+        outputs = []
+
+        def run():
+            if self._session:
+                output = self._session.execute(*args)
+            else:
+                output = self._cli.execute(self._container_name, *args)
+            outputs.append(output)
+            # [] is returned in case of error
+            if isinstance(output, list):
+                return False, output
+            stderr = getattr(output, 'stderr', b'')
+            return True, [text_type(output), stderr.decode('utf-8', 'replace')]
+
+        hit, result = self._cached(u'cmd', args, run)
+        if not hit:
+            return outputs[0]
+        # the cached output has the same attributes as the output of the executed command
+        stdout, stderr = result
+        return CommandOutput(0, stdout.encode('utf-8'), stderr.encode('utf-8'))
 
     def copy(self, src, dest, to_container=True):
         '''
@@ -97,10 +212,91 @@ class ContainerContext(object):
         :return: True if operation was successful
         '''
         if to_container:
-            return self._cli.copy(src, "{}:{}".format(self._container_name, dest))
+            def run():
+                ok = self._cli.copy(src, "{}:{}".format(self._container_name, dest))
+                return ok, ok
+            return self._cached(u'copy', [os.path.basename(os.path.normpath(src)), dest], run, files=[src])[1]
         else:
+            if self._cache:
+                self._cache.materialize()
             return self._cli.copy("{}:{}".format(self._container_name, src), dest)
 
+    def copy_many(self, sources, dest, include=None, exclude=None, uid=0, gid=0):
+        '''
+        Copy host paths and in-memory contents to the container directory in one streamed tar archive
+
+        Usage:
+
+            ctxt.copy_many(['src/', ('conf/app.yml', 'etc/app.yml'),
+                            (Content(u'nameserver 8.8.8.8\\n'), 'etc/resolv.conf')], '/opt/app',
+                           exclude=['*.pyc', '.git'])
+
+        :param sources: the list of host paths, (host path, name) or (Content, name) tuples,
+            the names are relative to the destination directory
+        :param dest: the directory in the container, it must exist
+        :param include: glob patterns of the files to copy, default: all files
+        :param exclude: glob patterns of the files and directories to skip
+        :param uid: the owner of copied files, default: root, None - keep the host one
+        :param gid: the group of copied files, default: root, None - keep the host one
+        :return: True if operation was successful
+        '''
+        entries = archive_entries(sources)
+
+        def run():
+            ok = self._cli.copy_many(self._container_name, entries, dest,
+                                     include=include, exclude=exclude, uid=uid, gid=gid)
+            return ok, ok
+        args = [[[name, source.digest() if isinstance(source, Content) else None] for source, name in entries],
+                dest, include, exclude, uid, gid]
+        return self._cached(u'copy_many', args, run,
+                            files=[s for s, _ in entries if not isinstance(s, Content)])[1]
+
+    def extract(self, src, dest, include=None, exclude=None, predicate=None, strip_components=0, store=None):
+        '''
+        Extract the files from the container, the archive of the path is filtered while it's streamed,
+        only matched files are written to the host
+
+        Usage:
+
+            ctxt.extract('/build/out', 'dist/', include=['*.so', 'out/bin/*'], strip_components=1,
+                         store=ArtifactStore('.builder-artifacts'))
+
+        :param src: the path in the container, the files are named by its base name and relative path
+        :param dest: the host directory, it's created if missing
+        :param include: glob patterns of the files to extract, default: all files
+        :param exclude: glob patterns of the files and directories to skip
+        :param predicate: the function which gets TarInfo and returns True if the member is extracted
+        :param strip_components: strip the number of leading components from the file names, like tar
+        :param store: ArtifactStore, the files are stored by content and linked to the destination
+        :return: the list of extracted files, the dicts with name, size and digest (with the store only),
+            None on error
+        '''
+        if self._cache:
+            self._cache.materialize()
+        return self._cli.extract(self._container_name, src, dest, include=include, exclude=exclude,
+                                 predicate=predicate, strip_components=strip_components, store=store)
+
+    def sync(self, src, dest, exclude=None):
+        '''
+        Sync the host directory to the directory in the container like rsync: only added and changed
+        files are copied, in one tar stream, and removed files are deleted in the container.
+        The host files which size and mtime were not changed since the previous sync are not hashed again
+
+        :param src: host directory
+        :param dest: the directory in the container, it's created if missing
+        :param exclude: glob patterns of the files and directories to skip, they are kept in the container
+        :return: the dict with the numbers of uploaded, deleted and unchanged paths, None on error
+        '''
+        # the step is keyed by the host manifest, the unchanged files are not hashed again
+        manifest = self._sync_manifests[src] = host_manifest(src, exclude=exclude,
+                                                             previous=self._sync_manifests.get(src))
+
+        def run():
+            result, self._sync_manifests[src] = sync_directory(self._cli, self._container_name, src, dest,
+                                                               exclude=exclude, previous=manifest)
+            return result is not None, result
+        return self._cached(u'sync', [dest, exclude, manifest_digest(manifest)], run)[1]
+
     def inspect(self, path):
         '''
         Inspect container details by JSON path
@@ -3,15 +3,37 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import os
+import re
 import copy
 import json
 import yaml
 
-from six import text_type
-
 from builder.log import Logger
 logger = Logger(__name__)
 
+# the backends of the dataloader, YAML is parsed by libyaml if the extension is importable
+BACKEND_JSON = u'json'
+BACKEND_LIBYAML = u'libyaml'
+BACKEND_YAML = u'yaml'
+
+try:
+    from yaml import CSafeLoader as YAMLLoader
+    YAML_BACKEND = BACKEND_LIBYAML
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+    YAML_BACKEND = BACKEND_YAML
+
+# JSON text of vars files starts with an object or an array, YAML documents rarely do
+JSON_START = re.compile(r'\s*[{\[]')
+
+
+def sniff(data):
+    '''
+    :param data: JSON/YAML string
+    :return: the backend for the data, BACKEND_JSON or YAML_BACKEND
+    '''
+    return BACKEND_JSON if JSON_START.match(data) else YAML_BACKEND
+
 
 class DataLoader(object):
 
@@ -21,7 +43,7 @@ class DataLoader(object):
     read in through other means. 
 
     Data read from files will also be cached, so the file will never be
-    read from disk more than once.
+    read from disk more than once while it's not changed.
 
     Usage:
 
@@ -32,43 +54,58 @@ class DataLoader(object):
 
     def __init__(self):
         self._cache = dict()
+        # the backend which parsed the file: the absolute path -> BACKEND_JSON, BACKEND_LIBYAML or BACKEND_YAML
+        self.backends = dict()
 
     def load(self, data):
         '''  Creates a python datastructure from the given data, which can be either a JSON/YAML string.
         '''
+        return self.parse(data)[0]
+
+    def parse(self, data):
+        '''
+        Creates a python datastructure from the given JSON/YAML string, the format is sniffed by the first character,
+        YAML is parsed by the safe loader
+
+        :return: the tuple (the list of documents, None if the data cannot be parsed; the backend which parsed it)
+        '''
         if not data:
             logger.warning(msg=u'Empty data passed to the dataloader')
-            return None
+            return None, None
 
-        try:
-            # we first try to load this data as JSON
-            result = json.loads(data)
-            result = [result,] if isinstance(result, dict) else result
-        except:
-            # must not be JSON, let the rest try
-            in_data = text_type(data) if isinstance(data, unicode) else data
+        backend = sniff(data)
+        if backend == BACKEND_JSON:
             try:
-                result = [d for d in yaml.load_all(in_data) if d]
-            except:
-                logger.error(**{ u'msg': u'Cannot detect file format', u'date.format': type(data)})
-                result = None
-        return result
+                result = json.loads(data)
+                return ([result,] if isinstance(result, dict) else result), backend
+            except ValueError:
+                # YAML flow collections like {a: 1} look like JSON
+                backend = YAML_BACKEND
+        try:
+            return [d for d in yaml.load_all(data, Loader=YAMLLoader) if d], backend
+        except yaml.YAMLError as err:
+            logger.error(**{u'msg': u'Cannot detect file format, %s' % err, u'data.format': type(data).__name__})
+            return None, backend
 
     def load_from_file(self, filename):
         ''' Loads data from a file, which can contain either JSON or YAML.  '''
         if not os.path.exists(filename) or not os.path.isfile(filename):
             raise IOError('The file does not exist, %s' % filename)
 
-        # if the file has already been read in and cached, we'll
-        # return those results to avoid more file/vault operations
-        if filename in self._cache:
-            parsed_data = self._cache[filename]
+        # if the file has already been read in and cached and it's not changed since then,
+        # we'll return those results to avoid more file/vault operations
+        path, stat = os.path.abspath(filename), os.stat(filename)
+        version = (stat.st_mtime, stat.st_size)
+        if path in self._cache and self._cache[path][0] == version:
+            parsed_data = self._cache[path][1]
         else:
             with open(filename) as data:
-                parsed_data = self.load(data=data.read())
+                parsed_data, backend = self.parse(data=data.read())
+            logger.debug(**{u'msg': u'File was loaded', u'file': filename, u'loader.backend': backend})
 
             # cache the file contents for next time
-            self._cache[filename] = parsed_data
+            self._cache[path] = (version, parsed_data)
+            self.backends[path] = backend
 
         # return a deep copy here, so the cache is not affected
         return copy.deepcopy(parsed_data)
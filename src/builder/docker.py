@@ -1,75 +1,212 @@
 from __future__ import (absolute_import, division, print_function)
 
+import os
+import re
 import sh
 import json
+import tarfile
+import threading
 import itertools
+import subprocess
 
+from multiprocessing.pool import ThreadPool
+
+from six.moves import queue
+
+from builder import trace, DOCKER_BACKENDS
 from builder.log import Logger
+from builder.archive import Content, ChunkReader, archive_entries, iter_archive, extract_archive
+from builder.inventory import get_inventory, current_inventory
+from builder.records import ImageRecord, ContainerRecord
+from builder.stream import ExecStream, iter_output, traced_frames, STREAM_STDOUT, STREAM_STDERR
 
 logger = Logger(__name__)
 
+# the command of base container: PID 1 shell exits on SIGTERM/SIGINT, the container is stopped
+# immediately instead of waiting for the stop timeout. `tail -f /dev/null` alone ignores the signals
+KEEPALIVE_COMMAND = ['/bin/sh', '-c', 'trap "exit 0" TERM INT; tail -f /dev/null & wait']
+
+# the stderr of streamed docker commands kept for error reports, bytes
+MAX_ERROR_SIZE = 64 * 1024
+
+# the grace period of container teardown, seconds: 0 - kill and remove the container at once
+DEFAULT_STOP_GRACE = 0
+
+# the parallel teardown of many containers: the number of containers per call and concurrent calls
+TEARDOWN_BATCH_SIZE = 16
+TEARDOWN_JOBS = 4
+
+# the function which returns the command line run instead of `docker`, see set_command_runner()
+_command_runner = None
+
+
+def set_command_runner(runner):
+    '''
+    Run the docker commands by another executable, like the replay of recorded commands, see builder.replay
+
+    :param runner: the function which gets the list of docker command line arguments and returns the command line
+                   which is run instead, None - run docker
+    :return: the previous runner
+    '''
+    global _command_runner
+    previous, _command_runner = _command_runner, runner
+    return previous
+
+
+def _docker_command_line(args):
+    '''
+    :param args: docker command line arguments
+    :return: the command line which runs the docker command
+    '''
+    if _command_runner is None:
+        return ['docker'] + list(args)
+    return _command_runner([a.decode('utf-8') if isinstance(a, bytes) else a for a in args])
+
+
+class DockerCommand(object):
+    '''
+    `docker` command of sh: `docker_command.run(*args)` is the same as `docker_command('run', *args)`,
+    the special keyword arguments like `_iter` or `_in` are passed to sh. The command is run by the command
+    runner if it's set, see set_command_runner()
+    '''
+    def __init__(self, *args):
+        self._args = args
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return DockerCommand(*(self._args + (name,)))
+
+    def __call__(self, *args, **kwargs):
+        args = self._args + args
+        if _command_runner is None:
+            return sh.docker(*args, **kwargs)
+        # the options like `filter='label=x'` are passed as `--filter=label=x`, the same way as sh does
+        options = ['--%s=%s' % (k.replace('_', '-'), v) for k, v in sorted(kwargs.items()) if not k.startswith('_')]
+        command_line = _docker_command_line(list(args) + options)
+        return sh.Command(command_line[0])(*command_line[1:],
+                                           **dict((k, v) for k, v in kwargs.items() if k.startswith('_')))
+
+
+docker_command = DockerCommand()
+
 
 class DockerCLI(object):
     def __init__(self, **kwargs):
         self._kwargs = kwargs
 
-    def images_list(self):
+    @property
+    def endpoint(self):
         '''
-        :return: the list of existing images 
+        :return: docker host of the client, the clients of the same host share the inventory
         '''
-        try:
-            for details in sh.docker.images(format='{{json .}}').split('\n'):
-                if not details:
-                    continue
-                try:
-                    img = json.loads(details)
-                except ValueError as err:
-                    logger.error(**{u'msg': u'{}'.format(err), u'image.details': u'{}'.format(details)})
-                    continue
-                yield {
-                    u'id': img.get(u'ID', u''),
-                    u'repository': img.get(u'Repository', u''),
-                    u'tag': img.get(u'Tag', u''),
-                    u'size': img.get(u'Size', 0),
-                    u'createdAt': img.get(u'CreatedAt', '')
-                }
-        except sh.ErrorReturnCode as err:
-            logger.error(msg=err.stderr)
-            raise StopIteration()
+        return u'cli+%s' % os.environ.get('DOCKER_HOST', u'')
+
+    def _inventory_update(self, method, *args):
+        ''' apply the change made by the client to the inventory, if it was started
+        '''
+        inventory = current_inventory(self)
+        if inventory:
+            getattr(inventory, method)(*args)
+
+    @staticmethod
+    def _filter_args(filters):
+        '''
+        :param filters: the dict of filters, the value is a string or the list of strings
+        :return: `--filter key=value` command line arguments
+        '''
+        args = []
+        for key, values in sorted((filters or {}).items()):
+            for value in (values if isinstance(values, (list, tuple)) else [values]):
+                args.extend(['--filter', '%s=%s' % (key, value)])
+        return args
+
+    @staticmethod
+    def _iter_json(*args):
+        '''
+        Run docker command with `--format '{{json .}}'` and stream its output line by line,
+        the lines are not decoded. The command errors are logged.
+
+        :return: the iterator of JSON lines
+        '''
+        lines = queue.Queue()
+        # the lines are passed by callback, sh `_iter` mode notices the end of output
+        # up to 1 second later
+        proc = docker_command(*(args + ('--format', '{{json .}}')),
+                              _bg=True, _bg_exc=False, _no_out=True, _out=lines.put)
+
+        def waiter():
+            try:
+                proc.wait()
+            except sh.ErrorReturnCode as err:
+                logger.error(msg=err.stderr)
+            finally:
+                lines.put(None)
+
+        thread = threading.Thread(target=waiter)
+        thread.daemon = True
+        thread.start()
+        for line in iter(lines.get, None):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('{'):
+                logger.error(**{u'msg': u'Unexpected output', u'details': u'{}'.format(line)})
+                continue
+            yield line
 
-    def containers_list(self):
+    @trace.traced_iter(u'docker.images')
+    def images_list(self, **filters):
+        '''
+        :param filters: the filters applied by docker daemon, like reference='alpine:*', label='key=value',
+            dangling='true', the value is a string or the list of strings
+        :return: the list of existing images, ImageRecord
+        '''
+        for line in self._iter_json('images', *self._filter_args(filters)):
+            yield ImageRecord(line)
+
+    @trace.traced_iter(u'docker.ps')
+    def containers_list(self, **filters):
         '''
         return the list of containers
-        :return: the list of containers
-        '''
-        try:
-            for details in sh.docker.ps('-a', format='{{json .}}').split('\n'):
-                if not details:
-                    continue
-                try:
-                    cont = json.loads(details)
-                except ValueError as err:
-                    logger.error(**{u'msg': u'{}'.format(err), u'image.details': u'{}'.format(details)})
-                    continue
-                yield {
-                    u'id': cont.get(u'ID', u''),
-                    u'names': cont.get(u'Names', u''),
-                    u'image': cont.get(u'Image', u''),
-                    u'labels': cont.get(u'Labels', []),
-                    u'command': cont.get(u'Command', u''),
-                    u'createdAt': cont.get(u'CreatedAt', u''),
-                    u'localVolumes': cont.get(u'LocalVolumes', u''),
-                    u'mounts': cont.get(u'Mounts', u''),
-                    u'networks': cont.get(u'Networks', u''),
-                    u'ports': cont.get(u'Ports', []),
-                    u'status': cont.get(u'Status', u''),
-                    u'runningFor': cont.get(u'RunningFor', u''),
-                    u'size': cont.get(u'Size', 0),
-                }
-        except sh.ErrorReturnCode as err:
-            logger.error(msg=err.stderr)
-            raise StopIteration()
+        :param filters: the filters applied by docker daemon, like name, label='key=value', ancestor='alpine:3.5',
+            status='running', the value is a string or the list of strings
+        :return: the list of containers, ContainerRecord
+        '''
+        for line in self._iter_json('ps', '-a', *self._filter_args(filters)):
+            yield ContainerRecord(line)
 
+    def find_containers(self, name=None, label=None, ancestor=None, status=None):
+        '''
+        Find containers, the lookup is done by docker daemon
+
+        :param name: exact container name
+        :param label: label filter(-s), format: key or key=value
+        :param ancestor: image name or id, the container is created from the image or its descendant
+        :param status: container status: created, restarting, running, removing, paused, exited, dead
+        :return: the list of containers, ContainerRecord
+        '''
+        filters = dict((k, v) for k, v in ((u'label', label), (u'ancestor', ancestor), (u'status', status)) if v)
+        if name:
+            # the name filter is the regular expression, the name may have leading slash
+            filters[u'name'] = u'^/?%s$' % re.escape(name)
+        return list(self.containers_list(**filters))
+
+    def find_images(self, reference=None, label=None, dangling=None):
+        '''
+        Find images, the lookup is done by docker daemon
+
+        :param reference: image name pattern, like alpine or alpine:3.*
+        :param label: label filter(-s), format: key or key=value
+        :param dangling: True for untagged images only, False for tagged ones
+        :return: the list of images, ImageRecord
+        '''
+        filters = dict((k, v) for k, v in ((u'reference', reference), (u'label', label)) if v)
+        if dangling is not None:
+            filters[u'dangling'] = u'true' if dangling else u'false'
+        return list(self.images_list(**filters))
+
+    @trace.traced(u'docker.run', args=slice(None))
     def run(self, *args):
         '''
         Run image
@@ -77,7 +214,7 @@ class DockerCLI(object):
         :return the ID of container
         '''
         try:
-            return sh.docker.run(*args).strip()
+            return docker_command.run(*args).strip()
         except sh.ErrorReturnCode as err:
             logger.error(msg=err.stderr)
             return None
@@ -95,25 +232,31 @@ class DockerCLI(object):
             u'container.name': container_name,
             u'rerun': rerun,
         })
-        container_exists = ([c for c in self.containers_list() if container_name == c[u'names']])
+        container = get_inventory(self).container(container_name)
+        container_exists = [container] if container else []
         if container_exists:
-            logger.warning(**{u'msg': u'Container exists', u'container.details': container_exists})
+            logger.warning(**{u'msg': u'Container exists', u'container.details': [dict(c) for c in container_exists]})
             if not rerun:
                 logger.info(msg=u'Base container was not created')
                 return None
             else:
-                container_ids = [c[u'id'] for c in container_exists]
-                self.stop_containers(*container_ids)
-                self.remove_containers(*container_ids)
+                self.teardown(*[c[u'id'] for c in container_exists])
         _args = ['-d', '--name=%s' % container_name]
         if volumes:
             _args.extend(list(itertools.chain(*[('--volume', v) for v in volumes])))
-        _args.extend([ image_name, '/bin/sh', '-c', 'tail -f /dev/null'])
+        _args.append(image_name)
+        _args.extend(KEEPALIVE_COMMAND)
         logger.info(msg=u'Container options', args=_args)
-        _id = self.run(*_args).strip()
+        _id = self.run(*_args)
+        if not _id:
+            logger.error(**{u'msg': u'Base container was not created', u'container.name': container_name})
+            return None
+        _id = _id.strip()
         logger.info(**{u'msg': 'Base container was created', u'container.id': _id})
+        self._inventory_update('add_container', _id, container_name, image_name)
         return _id
 
+    @trace.traced(u'docker.stop', containers=slice(None))
     def stop_containers(self, *ids):
         '''
         Stop container(-s)
@@ -127,11 +270,12 @@ class DockerCLI(object):
             return []
 
         try:
-            return sh.docker.stop(*ids).strip()
+            return docker_command.stop(*ids).strip()
         except sh.ErrorReturnCode as err:
             logger.error(msg=err.stderr)
             return []
 
+    @trace.traced(u'docker.rm', containers=slice(None))
     def remove_containers(self, *ids):
         '''
         Remove container(-s)
@@ -145,11 +289,64 @@ class DockerCLI(object):
             return []
 
         try:
-            return sh.docker.rm(*ids).strip()
+            removed = docker_command.rm(*ids).strip()
+            self._inventory_update('remove_containers', *removed.split())
+            return removed
         except sh.ErrorReturnCode as err:
             logger.error(msg=err.stderr)
             return []
 
+    @trace.traced(u'docker.teardown', containers=slice(None))
+    def teardown(self, *ids, **kwargs):
+        '''
+        Force remove container(-s) in one call: `docker rm -f` kills the running container.
+        With the grace period the containers are stopped first, SIGTERM is sent and the container
+        is killed if it's still running after the grace period
+
+        :param ids: container ids or names
+        :param grace: the grace period, seconds, default: DEFAULT_STOP_GRACE
+        :return: removed container ids
+        '''
+        grace = kwargs.get('grace', DEFAULT_STOP_GRACE)
+        logger.info(**{u'msg': u'Tearing down containers', u'container.ids': ids, u'grace': grace})
+
+        if not ids:
+            logger.info(msg=u'No containers for teardown')
+            return []
+
+        try:
+            if grace:
+                docker_command.stop('--time=%d' % grace, *ids)
+        except sh.ErrorReturnCode as err:
+            logger.warning(msg=err.stderr)
+        try:
+            removed = docker_command.rm('--force', *ids).strip()
+        except sh.ErrorReturnCode as err:
+            # some of containers may be removed, the inventory is updated by docker events
+            logger.error(msg=err.stderr)
+            return []
+        self._inventory_update('remove_containers', *removed.split())
+        return removed
+
+    @trace.traced(u'docker.rename', container=0, new_name=1)
+    def rename(self, container_name, new_name):
+        '''
+        Rename container
+
+        :param container_name: container name or id
+        :param new_name: new container name
+        :return: True if the container was renamed
+        '''
+        logger.info(**{u'msg': u'Renaming container', u'container.name': container_name, u'new.name': new_name})
+        try:
+            docker_command.rename(container_name, new_name)
+            self._inventory_update('rename_container', container_name, new_name)
+            return True
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return False
+
+    @trace.traced(u'docker.exec', container=0, command=slice(1, None))
     def execute(self, containter_name, *args):
         '''
         Execute command(-s) in the container
@@ -160,44 +357,179 @@ class DockerCLI(object):
         logger.info(**{u'msg': u'Execute command in the container',
                        u'container.name': containter_name,
                        u'command.args': args})
+        span = trace.current()
         try:
-            return sh.docker('exec', containter_name, *args)
+            output = docker_command('exec', containter_name, *args)
         except sh.ErrorReturnCode as err:
+            span.set(u'exit.code', err.exit_code)
             if err.stdout:
                 print(err.stdout)
             if err.stderr:
                 print(err.stderr)
             return []
+        span.set(u'exit.code', output.exit_code)
+        span.set(u'bytes.received', len(output.stdout))
+        return output
+
+    def exec_stream(self, containter_name, *args, **kwargs):
+        '''
+        Execute command(-s) in the container in streaming mode, the output is not kept in memory
 
-    def commit(self, containter_name, image_name):
+        :param containter_name: container name
+        :param args: the list of command line arguments
+        :param raw: stream raw chunks instead of lines, default: False
+        :param tail_size: the number of output lines kept for error reports, default: 100
+        :return: ExecStream
+        '''
+        logger.info(**{u'msg': u'Execute command in the container (streaming)',
+                       u'container.name': containter_name,
+                       u'command.args': args})
+        span = trace.started(u'docker.exec_stream', container=containter_name, command=list(args))
+        try:
+            proc = self._popen('exec', containter_name, *args)
+        except OSError as err:
+            logger.error(msg=u'Cannot run docker, {}'.format(err))
+            span.finish(err)
+            return ExecStream(iter([]), lambda: 127, args=args)
+        frames, exit_code = traced_frames(span, iter_output(proc), proc.wait)
+        return ExecStream(frames, exit_code, args=args,
+                          raw=kwargs.get('raw', False), tail_size=kwargs.get('tail_size', 100))
+
+    @trace.traced(u'docker.commit', container=0, image=1)
+    def commit(self, containter_name, image_name=None, labels=None, changes=None):
         '''
         Commit container to image
         
         :param containter_name: container name 
-        :param image_name: image name
+        :param image_name: image name, the image without name is committed if only labels are specified
+        :param labels: the dict of image labels
+        :param changes: the list of Dockerfile instructions applied to the image, like CMD, ENV
         :return: image id 
         '''
         logger.info(**{u'msg': u'Committing container into image',
                        u'container.name': containter_name,
                        u'image.name': image_name})
 
-        if not containter_name or not image_name:
+        if not containter_name or not (image_name or labels):
             logger.info(**{u'msg': u'No container or image names for commit',
                            u'container.name': containter_name,
                            u'image.name': image_name})
             return []
 
+        _args = [containter_name]
+        for k, v in sorted((labels or {}).items()):
+            _args.extend(['--change', 'LABEL %s="%s"' % (k, v)])
+        for change in changes or []:
+            _args.extend(['--change', change])
+        if image_name:
+            _args.append(image_name)
         try:
-            _id = sh.docker.commit(containter_name, image_name).strip()
+            _id = docker_command.commit(*_args).strip()
             logger.info(**{u'msg': 'Container committed to the image',
                            u'container.name': containter_name,
                            u'image.name': image_name,
                            u'image.id': _id})
+            if image_name:
+                self._inventory_update('add_image', _id, image_name)
             return _id
         except sh.ErrorReturnCode as err:
             logger.error(msg=err.stderr)
             return []
+        except OSError as err:
+            # like E2BIG, the arguments are too long
+            logger.error(msg=u'Cannot run docker commit, {}'.format(err))
+            return []
+
+    def command_changes(self, image_name):
+        '''
+        The base container runs the keepalive command instead of the command of the image, the command
+        of the image is restored on commit
+
+        :param image_name: the image which the container was run from
+        :return: the list of Dockerfile instructions for commit()
+        '''
+        return [u'CMD %s' % json.dumps(self.inspect_image(image_name, '.Config.Cmd') or [])]
+
+    @trace.traced(u'docker.tag', image=0, tag=1)
+    def tag(self, image, image_name):
+        '''
+        Tag the image
+
+        :param image: image id or name
+        :param image_name: new image name
+        :return: True if the image was tagged
+        '''
+        logger.info(**{u'msg': u'Tagging image', u'image.id': image, u'image.name': image_name})
+        try:
+            docker_command.tag(image, image_name)
+            self._inventory_update('tag_image', image, image_name)
+            return True
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return False
+
+    def events(self, since=None):
+        '''
+        Stream docker events
+
+        :param since: unix timestamp, stream the events since the time
+        :return: the tuple (the iterator of events, the function which closes the stream)
+        '''
+        args = ['--format', '{{json .}}']
+        if since:
+            args.extend(['--since', '%d' % since])
+        proc = docker_command.events(*args, _iter=True, _bg_exc=False, _ok_code=list(range(256)))
+
+        def events():
+            try:
+                for line in proc:
+                    try:
+                        yield json.loads(line)
+                    except ValueError as err:
+                        logger.error(**{u'msg': u'{}'.format(err), u'event.details': u'{}'.format(line)})
+            except sh.ErrorReturnCode:
+                pass
 
+        def close():
+            try:
+                proc.terminate()
+            except OSError:
+                pass
+
+        return events(), close
+
+    @trace.traced(u'docker.image_ids', label=0)
+    def image_ids(self, label):
+        '''
+        Find images, including intermediate ones, by label
+
+        :param label: label filter, format: key or key=value
+        :return: the list of image ids
+        '''
+        try:
+            output = docker_command.images('-a', '-q', '--no-trunc', filter='label=%s' % label)
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return []
+        return [_id for _id in output.split() if _id]
+
+    @trace.traced(u'docker.inspect_image', image=0, path=1)
+    def inspect_image(self, image_name, path):
+        '''
+        Inspect docker image
+
+        :param image_name: Docker image name or id
+        :param path: JSON path
+        :return: selection by JSON path
+        '''
+        try:
+            return json.loads(docker_command.inspect('--type', 'image', '-f', '{{ json %s }}' % path,
+                                                     image_name).strip())
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return None
+
+    @trace.traced(u'docker.inspect', container=0, path=1)
     def inspect(self, container_name, path):
         '''
         Inspect docker container
@@ -210,11 +542,12 @@ class DockerCLI(object):
                        u'container.name': container_name,
                        u'json.path': path})
         try:
-            return json.loads(sh.docker.inspect('-f', '{{ json %s }}' % path, container_name).strip())
+            return json.loads(docker_command.inspect('-f', '{{ json %s }}' % path, container_name).strip())
         except sh.ErrorReturnCode as err:
             logger.error(msg=err.stderr)
             return None
 
+    @trace.traced(u'docker.cp', source=0, destination=1)
     def copy(self, src, dest):
         '''
         Copy files/folders between a container and the local filesystem
@@ -227,8 +560,270 @@ class DockerCLI(object):
                        u'source.path': src,
                         u'destination.path': dest})
         try:
-            sh.docker.cp(src, dest)
+            docker_command.cp(src, dest)
             return True
         except sh.ErrorReturnCode as err:
             logger.error(msg=err.stderr.strip())
             return False
+
+    @staticmethod
+    def _feed(chunks, errors):
+        '''
+        :return: the iterator of chunks for sh stdin, the errors of the iterator are appended to the list
+            and end the input, as sh does not close stdin if the input fails
+        '''
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as err:
+            errors.append(err)
+
+    @trace.traced(u'docker.put_archive', container=0, destination=1)
+    def put_archive(self, container_name, path, chunks):
+        '''
+        Extract the tar archive to the directory in the container, the archive is streamed
+        to `docker cp - container:path` stdin
+
+        :param container_name: container name
+        :param path: the directory in the container, it must exist
+        :param chunks: the iterator of archive chunks, see iter_archive()
+        :return: result of copying (True/False)
+        '''
+        logger.info(**{u'msg': u'Extracting archive to the container',
+                       u'container.name': container_name,
+                       u'destination.path': path})
+        errors = []
+        try:
+            docker_command.cp('-', '%s:%s' % (container_name, path),
+                              _in=self._feed(trace.counted(chunks, u'bytes.sent'), errors))
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr.strip())
+            return False
+        if errors:
+            logger.error(msg=u'Cannot read the archive, {}'.format(errors[0]))
+            return False
+        return True
+
+    @trace.traced(u'docker.copy_many', container=0, destination=2)
+    def copy_many(self, container_name, sources, dest, include=None, exclude=None, uid=0, gid=0):
+        '''
+        Copy host paths and in-memory contents to the container in one streamed tar archive
+
+        :param container_name: container name
+        :param sources: the list of host paths, (host path, name) or (Content, name) tuples,
+            the names are relative to the destination directory
+        :param dest: the directory in the container, it must exist
+        :param include: glob patterns of the files to copy, default: all files
+        :param exclude: glob patterns of the files and directories to skip
+        :param uid: the owner of copied files, default: root, None - keep the host one
+        :param gid: the group of copied files, default: root, None - keep the host one
+        :return: result of copying (True/False)
+        '''
+        try:
+            entries = archive_entries(sources)
+        except ValueError as err:
+            logger.error(msg=u'{}'.format(err))
+            return False
+        missing = [s for s, _ in entries if not isinstance(s, Content) and not os.path.lexists(s)]
+        if missing:
+            logger.error(msg=u'Source path does not exist', paths=missing)
+            return False
+        logger.info(**{u'msg': u'Copying files', u'source.paths': [n for _, n in entries],
+                       u'destination.path': dest, u'include': include, u'exclude': exclude})
+        return self.put_archive(container_name, dest,
+                                iter_archive(entries, include=include, exclude=exclude, uid=uid, gid=gid))
+
+    @staticmethod
+    def _popen(*args):
+        '''
+        Start docker command with stdout and stderr pipes, the output is read by iter_output(): sh reads
+        the streamed output byte by byte and polls the process, that's too slow for large outputs
+
+        :param args: docker command line arguments
+        :return: subprocess.Popen
+        :raise OSError: if docker cannot be started
+        '''
+        with open(os.devnull, 'rb') as devnull:
+            return subprocess.Popen(_docker_command_line(args), stdin=devnull,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+
+    def _stream_output(self, *args):
+        '''
+        Run docker command and stream its binary output
+
+        :param args: docker command line arguments
+        :return: the iterator of output chunks, IOError is raised at the end if the command failed.
+            The command is killed if the iterator is closed before the end
+        '''
+        proc = self._popen(*args)
+        output, errors = iter_output(proc), []
+        try:
+            for stream_type, chunk in output:
+                if stream_type == STREAM_STDOUT:
+                    yield chunk
+                elif sum(len(e) for e in errors) < MAX_ERROR_SIZE:
+                    errors.append(chunk)
+        finally:
+            # the command is killed if the stream is closed before the end
+            output.close()
+        if proc.returncode:
+            logger.error(msg=b''.join(errors).decode('utf-8', 'replace').strip())
+            raise IOError('The command failed, docker %s' % ' '.join(args))
+
+    @trace.traced_iter(u'docker.get_archive', container=0, path=1)
+    def get_archive(self, container_name, path):
+        '''
+        Stream the tar archive of the path in the container, `docker cp container:path -`
+
+        :param container_name: container name
+        :param path: the path in the container
+        :return: the iterator of archive chunks, IOError is raised at the end if the command failed.
+            The command is killed if the iterator is closed before the end
+        '''
+        return self._stream_output('cp', '%s:%s' % (container_name, path), '-')
+
+    @trace.traced_iter(u'docker.export', container=0)
+    def export(self, container_name):
+        '''
+        Stream the filesystem of the container as tar archive, `docker export`
+
+        :param container_name: container name
+        :return: the iterator of archive chunks, see get_archive()
+        '''
+        return self._stream_output('export', container_name)
+
+    @trace.traced(u'docker.diff', container=0)
+    def changes(self, container_name):
+        '''
+        The changes of the container filesystem since it was created from the image, `docker diff`
+
+        :param container_name: container name
+        :return: the list of (kind, path) tuples, the kind is A (added), C (changed) or D (deleted),
+            None on error
+        '''
+        try:
+            output = docker_command.diff(container_name)
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return None
+        return [tuple(line.split(' ', 1)) for line in output.splitlines() if line.strip()]
+
+    @trace.traced(u'docker.import', image=1)
+    def import_image(self, chunks, image_name, changes=None):
+        '''
+        Create the image from the filesystem archive, `docker import`
+
+        :param chunks: the iterator of archive chunks
+        :param image_name: image name
+        :param changes: the list of Dockerfile instructions, like ENV, CMD, WORKDIR, LABEL
+        :return: image id, None on error
+        '''
+        logger.info(**{u'msg': u'Importing image', u'image.name': image_name})
+        _args = list(itertools.chain(*[('--change', c) for c in changes or []]))
+        errors = []
+        try:
+            _id = docker_command('import', *(_args + ['-', image_name]),
+                                 _in=self._feed(trace.counted(chunks, u'bytes.sent'), errors)).strip()
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return None
+        if errors:
+            # the image of partial filesystem is not tagged
+            logger.error(msg=u'Cannot read the filesystem archive, {}'.format(errors[0]))
+            return None
+        self._inventory_update('add_image', _id, image_name)
+        return _id
+
+    @trace.traced(u'docker.container_size', container=0)
+    def container_size(self, container_name):
+        '''
+        :param container_name: container name
+        :return: the tuple (the size of the writable layer, the total size of the filesystem), bytes
+        '''
+        try:
+            output = docker_command.inspect('--size', '-f', '{{ json .SizeRw }} {{ json .SizeRootFs }}', container_name)
+            return tuple(json.loads(v) for v in output.split())
+        except sh.ErrorReturnCode as err:
+            logger.error(msg=err.stderr)
+            return None, None
+
+    @trace.traced(u'docker.extract', container=0, source=1, destination=2)
+    def extract(self, container_name, path, dest, include=None, exclude=None, predicate=None,
+                strip_components=0, store=None):
+        '''
+        Extract the files from the container to the host directory, the archive of the path is filtered
+        while it's streamed, only matched files are written
+
+        :param container_name: container name
+        :param path: the path in the container, the archive members are named by its base name
+        :param dest: the host directory, it's created if missing
+        :param include: glob patterns of the files to extract, default: all files
+        :param exclude: glob patterns of the files and directories to skip
+        :param predicate: the function which gets TarInfo and returns True if the member is extracted
+        :param strip_components: strip the number of leading components from the member names, like tar
+        :param store: ArtifactStore, the files are stored by content and linked to the destination
+        :return: the list of extracted files, see extract_archive(), None on error
+        '''
+        logger.info(**{u'msg': u'Extracting files', u'container.name': container_name, u'source.path': path,
+                       u'destination.path': dest, u'include': include, u'exclude': exclude})
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        chunks = self.get_archive(container_name, path)
+        try:
+            extracted = extract_archive(ChunkReader(trace.counted(chunks, u'bytes.received')), dest,
+                                        include=include, exclude=exclude, predicate=predicate,
+                                        strip_components=strip_components, store=store)
+            # the rest of the stream is the archive padding, the errors are reported at the end of the stream
+            for _ in chunks:
+                pass
+        except (tarfile.TarError, IOError, OSError) as err:
+            logger.error(msg=u'Cannot extract files, {}'.format(err))
+            return None
+        finally:
+            chunks.close()
+        logger.info(**{u'msg': u'Files were extracted', u'container.name': container_name,
+                       u'files': len(extracted), u'bytes': sum(f[u'size'] for f in extracted)})
+        return extracted
+
+
+def teardown_containers(cli, ids, grace=DEFAULT_STOP_GRACE, batch_size=TEARDOWN_BATCH_SIZE, jobs=TEARDOWN_JOBS):
+    '''
+    Teardown many containers in parallel batches
+
+    :param cli: docker client
+    :param ids: the list of container ids or names
+    :param grace: the grace period, seconds, see DockerCLI.teardown()
+    :param batch_size: the number of containers removed by one call
+    :param jobs: the number of concurrent calls
+    :return: the list of removed container ids
+    '''
+    ids = list(ids)
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    if len(batches) < 2:
+        removed = cli.teardown(*ids, grace=grace) if ids else []
+        return removed.split() if removed else []
+
+    pool = ThreadPool(min(jobs, len(batches)))
+    try:
+        results = pool.map(lambda batch: cli.teardown(*batch, grace=grace), batches)
+    finally:
+        pool.close()
+        pool.join()
+    return [_id for removed in results if removed for _id in removed.split()]
+
+
+def docker_client(**kwargs):
+    '''
+    Docker client factory, the backend is selected by BUILDER_DOCKER_BACKEND environment variable
+        cli - `docker` command line client (default)
+        api - Docker Engine API over the daemon socket
+
+    :return: docker client
+    '''
+    backend = os.environ.get('BUILDER_DOCKER_BACKEND', 'cli')
+    if backend not in DOCKER_BACKENDS:
+        raise ValueError('Unknown docker backend, %s' % backend)
+    if backend == 'api':
+        from builder.dockerapi import DockerAPI
+        return DockerAPI(**kwargs)
+    return DockerCLI(**kwargs)
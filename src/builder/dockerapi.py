@@ -0,0 +1,997 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import socket
+import struct
+import base64
+import tarfile
+import argparse
+import posixpath
+import threading
+
+from six.moves import http_client
+from six.moves.urllib.parse import quote as _quote, urlencode, urlparse
+
+from builder import trace
+from builder.log import Logger
+from builder.archive import iter_archive, member_target, CHUNK_SIZE
+from builder.docker import DockerCLI, DEFAULT_STOP_GRACE
+from builder.errors import DockerAPIError
+from builder.records import APIImageRecord, APIContainerRecord
+from builder.stream import ExecStream, traced_frames, STREAM_STDERR
+
+logger = Logger(__name__)
+
+DEFAULT_DOCKER_HOST = 'unix:///var/run/docker.sock'
+
+# the kinds of container filesystem changes, GET /containers/{id}/changes
+_CHANGE_KINDS = {0: u'C', 1: u'A', 2: u'D'}
+
+# os.FileMode directory bit, as reported by X-Docker-Container-Path-Stat
+_GO_MODE_DIR = 1 << 31
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    ''' HTTP/1.1 connection over the unix domain socket
+    '''
+    def __init__(self, path, timeout=None):
+        http_client.HTTPConnection.__init__(self, 'localhost')
+        self._path = path
+        self._timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self._timeout is not None:
+            sock.settimeout(self._timeout)
+        sock.connect(self._path)
+        self.sock = sock
+
+
+class _OptionsParser(argparse.ArgumentParser):
+    ''' the parser of docker command line options, the error is raised instead of exit
+    '''
+    def error(self, message):
+        raise ValueError(u'%s: %s' % (self.prog, message))
+
+
+# the function which creates the connections of all pools, see set_connection_interceptor()
+_connection_interceptor = None
+
+
+def set_connection_interceptor(interceptor):
+    '''
+    Intercept the new connections to docker hosts, like the record and replay of the requests, see builder.replay
+
+    :param interceptor: the function which gets the connection factory of the pool and returns new connection,
+                        None - the connection is created by the factory
+    :return: the previous interceptor
+    '''
+    global _connection_interceptor
+    previous, _connection_interceptor = _connection_interceptor, interceptor
+    return previous
+
+
+class ConnectionPool(object):
+    ''' The pool of persistent (keep-alive) connections to the Docker daemon
+    '''
+    def __init__(self, factory, maxsize=4):
+        self._factory = factory
+        self._maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if _connection_interceptor is None:
+            return self._factory()
+        return _connection_interceptor(self._factory)
+
+    def get(self):
+        '''
+        :return: the tuple (connection, reused)
+        '''
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def new(self):
+        '''
+        :return: new connection, for the long-lived streams which are not returned to the pool
+        '''
+        return self._connect()
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < self._maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def read_exactly(fp, size):
+    '''
+    Read exactly `size` bytes from file-like object
+
+    :return: bytes or empty bytes in case of EOF
+    '''
+    chunks = []
+    while size > 0:
+        chunk = fp.read(size)
+        if not chunk:
+            return b''
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def iter_frames(fp):
+    '''
+    Demultiplex the raw stream of exec/attach endpoints
+
+    :param fp: file-like object with multiplexed stream
+    :return: the iterator of (stream type, payload) tuples
+    '''
+    while True:
+        header = read_exactly(fp, 8)
+        if not header:
+            return
+        stream_type, size = struct.unpack('>BxxxL', header)
+        payload = read_exactly(fp, size)
+        if size and not payload:
+            return
+        yield stream_type, payload
+
+
+def iter_lines(fp):
+    '''
+    :param fp: file-like object, like HTTP response
+    :return: the iterator of non-empty lines
+    '''
+    def read_line():
+        # python 2 HTTPResponse has no readline(), it's read by bytes
+        chunks = []
+        for char in iter(lambda: fp.read(1), b''):
+            chunks.append(char)
+            if char == b'\n':
+                break
+        return b''.join(chunks)
+
+    readline = getattr(fp, 'readline', None) or read_line
+    while True:
+        line = readline()
+        if not line:
+            return
+        if line.strip():
+            yield line.strip()
+
+
+def quote(name):
+    ''' quote the name of image or container in the URL path
+    '''
+    return _quote(name, safe='/:@')
+
+
+def _flatten(ids):
+    result = []
+    for _id in ids:
+        if isinstance(_id, (list, tuple)):
+            result.extend(_flatten(_id))
+        else:
+            result.append(_id)
+    return result
+
+
+def _split_image_name(image_name):
+    ''' split the image name to repository and tag, the registry port is not a tag
+    '''
+    repo, sep, tag = image_name.rpartition(':')
+    if not sep or '/' in tag:
+        return image_name, 'latest'
+    return repo, tag
+
+
+def _split_container_path(path):
+    ''' split "container:path" argument of `docker cp`
+    '''
+    if os.path.isabs(path) or path.startswith('.'):
+        return None, path
+    container, sep, _path = path.partition(':')
+    if not sep:
+        return None, path
+    return container, _path
+
+
+def _select(details, path):
+    ''' select the value by JSON path, like `docker inspect -f '{{ json .path }}'`
+    '''
+    for key in [k for k in path.strip().split('.') if k]:
+        if not isinstance(details, dict):
+            return None
+        details = details.get(key)
+    return details
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(base_url, timeout=None, maxsize=4):
+    '''
+    :return: the connection pool shared by all clients of the same docker host
+    '''
+    with _pools_lock:
+        if (base_url, timeout) in _pools:
+            return _pools[(base_url, timeout)]
+
+        url = urlparse(base_url)
+        if url.scheme in ('unix', 'http+unix'):
+            path = url.path or url.netloc
+            pool = ConnectionPool(lambda: UnixHTTPConnection(path, timeout=timeout), maxsize=maxsize)
+        elif url.scheme in ('tcp', 'http'):
+            netloc = url.netloc
+            pool = ConnectionPool(lambda: http_client.HTTPConnection(netloc, timeout=timeout), maxsize=maxsize)
+        else:
+            raise ValueError('Unsupported docker host, %s' % base_url)
+        _pools[(base_url, timeout)] = pool
+        return pool
+
+
+def close_pools():
+    ''' close idle connections to all docker hosts
+    '''
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+class DockerAPI(DockerCLI):
+    '''
+    Docker Engine API client over HTTP/1.1, it uses the pool of persistent connections
+    to the daemon socket instead of forking `docker` client per call.
+
+    Usage:
+
+        cli = DockerAPI()                                   # DOCKER_HOST or /var/run/docker.sock
+        cli = DockerAPI(base_url='unix:///tmp/docker.sock')
+        cli = DockerAPI(base_url='tcp://127.0.0.1:2375')
+    '''
+    def __init__(self, base_url=None, timeout=None, pool_size=4, **kwargs):
+        super(DockerAPI, self).__init__(**kwargs)
+        self._base_url = base_url or os.environ.get('DOCKER_HOST') or DEFAULT_DOCKER_HOST
+        self._timeout = timeout
+
+        self._pool = get_pool(self._base_url, timeout=timeout, maxsize=pool_size)
+
+    @property
+    def endpoint(self):
+        return self._base_url
+
+    def _send(self, method, path, params=None, body=None, headers=None):
+        '''
+        Send the request via pooled connection, the request is re-sent once over the new connection
+        if the kept-alive one was closed by the daemon
+
+        :return: the tuple (connection, response)
+        :raise DockerAPIError: if the daemon is not available
+        '''
+        if params:
+            path = '%s?%s' % (path, urlencode(params))
+        headers = dict(headers or {})
+        while True:
+            conn, reused = self._pool.get()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (socket.error, http_client.HTTPException) as err:
+                conn.close()
+                if not reused:
+                    raise self._connection_error(err)
+
+    def _connection_error(self, err):
+        return DockerAPIError(None, u'Cannot connect to the Docker daemon at %s, %s' % (self._base_url, err))
+
+    def _release(self, conn, response, reusable=True):
+        if reusable and not response.will_close:
+            self._pool.put(conn)
+        else:
+            conn.close()
+
+    def _request(self, method, path, params=None, body=None, headers=None):
+        '''
+        :return: the tuple (response, data)
+        '''
+        conn, response = self._send(method, path, params=params, body=body, headers=headers)
+        try:
+            data = response.read()
+        except (socket.error, http_client.HTTPException) as err:
+            self._release(conn, response, reusable=False)
+            raise self._connection_error(err)
+        self._release(conn, response)
+        if response.status >= 400:
+            raise DockerAPIError(response.status, self._error_message(data))
+        return response, data
+
+    def _json(self, method, path, params=None, payload=None):
+        body, headers = None, {}
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        _, data = self._request(method, path, params=params, body=body, headers=headers)
+        if not data:
+            return None
+        return json.loads(data.decode('utf-8'))
+
+    @staticmethod
+    def _error_message(data):
+        try:
+            return json.loads(data.decode('utf-8')).get(u'message', u'')
+        except ValueError:
+            return data.decode('utf-8', 'replace').strip()
+
+    @trace.traced(u'docker.version')
+    def version(self):
+        '''
+        :return: the version details of docker daemon
+        '''
+        return self._json('GET', '/version')
+
+    @staticmethod
+    def _filters_param(filters):
+        '''
+        :return: `filters` query parameter, JSON encoded map[string][]string
+        '''
+        return json.dumps(dict((k, list(v) if isinstance(v, (list, tuple)) else [v]) for k, v in filters.items()))
+
+    @trace.traced_iter(u'docker.images')
+    def images_list(self, **filters):
+        '''
+        :param filters: the filters applied by docker daemon, see DockerCLI.images_list()
+        :return: the list of existing images, APIImageRecord
+        '''
+        params = {'filters': self._filters_param(filters)} if filters else None
+        try:
+            images = self._json('GET', '/images/json', params=params)
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return
+        for img in images:
+            for repo_tag in (img.get(u'RepoTags') or [u'<none>:<none>']):
+                yield APIImageRecord((img, repo_tag))
+
+    @trace.traced_iter(u'docker.ps')
+    def containers_list(self, **filters):
+        '''
+        return the list of containers
+        :param filters: the filters applied by docker daemon, see DockerCLI.containers_list()
+        :return: the list of containers, APIContainerRecord
+        '''
+        params = {'all': 1}
+        if filters:
+            params['filters'] = self._filters_param(filters)
+        try:
+            containers = self._json('GET', '/containers/json', params=params)
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return
+        for cont in containers:
+            yield APIContainerRecord(cont)
+
+    @trace.traced(u'docker.run', args=slice(None))
+    def run(self, *args):
+        '''
+        Run image, the subset of `docker run` options is supported: -d, --name, --volume, --label, --init
+        :param args: docker run command line arguments
+        :return the ID of container, None if the container was not started or the option is not supported
+        '''
+        parser = _OptionsParser(prog='docker run', add_help=False)
+        parser.add_argument('-d', '--detach', action='store_true')
+        parser.add_argument('--name')
+        parser.add_argument('-v', '--volume', action='append', default=[])
+        parser.add_argument('-l', '--label', action='append', default=[])
+        parser.add_argument('--init', action='store_true')
+        parser.add_argument('image')
+        parser.add_argument('command', nargs=argparse.REMAINDER)
+        try:
+            opts = parser.parse_args(list(args))
+        except ValueError as err:
+            logger.error(msg=u'{}'.format(err))
+            return None
+
+        payload = {
+            u'Image': opts.image,
+            u'Labels': dict(l.split('=', 1) if '=' in l else (l, '') for l in opts.label),
+            u'HostConfig': {u'Binds': opts.volume},
+        }
+        if opts.command:
+            payload[u'Cmd'] = opts.command
+        if opts.init:
+            payload[u'HostConfig'][u'Init'] = True
+        params = {'name': opts.name} if opts.name else None
+        try:
+            _id = self._json('POST', '/containers/create', params=params, payload=payload)[u'Id']
+            self._request('POST', '/containers/%s/start' % _id)
+            return _id
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return None
+
+    @trace.traced(u'docker.stop', containers=slice(None))
+    def stop_containers(self, *ids):
+        '''
+        Stop container(-s)
+        :param container_id: container id
+        :return: the result of stopping (True or False)
+        '''
+        logger.info(**{u'msg': u'Stopping containers', u'container.ids': ids})
+
+        if not ids:
+            logger.info(msg=u'No containers for stopping')
+            return []
+
+        stopped = []
+        for _id in _flatten(ids):
+            try:
+                self._request('POST', '/containers/%s/stop' % quote(_id))
+                stopped.append(_id)
+            except DockerAPIError as err:
+                logger.error(msg=err.message)
+        return '\n'.join(stopped)
+
+    @trace.traced(u'docker.rm', containers=slice(None))
+    def remove_containers(self, *ids):
+        '''
+        Remove container(-s)
+        :param container_id: container id
+        :return: the result of removing (True or False)
+        '''
+        logger.info(**{u'msg': u'Removing containers', u'container.ids': ids})
+
+        if not ids:
+            logger.info(msg=u'No containers for stopping')
+            return []
+
+        removed = []
+        for _id in _flatten(ids):
+            try:
+                self._request('DELETE', '/containers/%s' % quote(_id))
+                removed.append(_id)
+            except DockerAPIError as err:
+                logger.error(msg=err.message)
+        self._inventory_update('remove_containers', *removed)
+        return '\n'.join(removed)
+
+    @trace.traced(u'docker.teardown', containers=slice(None))
+    def teardown(self, *ids, **kwargs):
+        '''
+        Force remove container(-s), the running container is killed by DELETE /containers/{id}?force=1.
+        With the grace period the containers are stopped first
+
+        :param ids: container ids or names
+        :param grace: the grace period, seconds, default: DEFAULT_STOP_GRACE
+        :return: removed container ids
+        '''
+        grace = kwargs.get('grace', DEFAULT_STOP_GRACE)
+        logger.info(**{u'msg': u'Tearing down containers', u'container.ids': ids, u'grace': grace})
+
+        if not ids:
+            logger.info(msg=u'No containers for teardown')
+            return []
+
+        removed = []
+        for _id in _flatten(ids):
+            try:
+                if grace:
+                    self._request('POST', '/containers/%s/stop' % quote(_id), params={'t': grace})
+            except DockerAPIError as err:
+                logger.warning(msg=err.message)
+            try:
+                self._request('DELETE', '/containers/%s' % quote(_id), params={'force': 1})
+                removed.append(_id)
+            except DockerAPIError as err:
+                logger.error(msg=err.message)
+        self._inventory_update('remove_containers', *removed)
+        return '\n'.join(removed)
+
+    @trace.traced(u'docker.rename', container=0, new_name=1)
+    def rename(self, container_name, new_name):
+        '''
+        Rename container
+
+        :param container_name: container name or id
+        :param new_name: new container name
+        :return: True if the container was renamed
+        '''
+        logger.info(**{u'msg': u'Renaming container', u'container.name': container_name, u'new.name': new_name})
+        try:
+            self._request('POST', '/containers/%s/rename' % quote(container_name), params={'name': new_name})
+            self._inventory_update('rename_container', container_name, new_name)
+            return True
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return False
+
+    def exec_frames(self, container_name, *args):
+        '''
+        Start command in the container and return the demultiplexed output
+
+        :param container_name: container name
+        :param args: the list of command line arguments
+        :return: the tuple (exec id, the iterator of (stream type, payload) frames)
+        '''
+        exec_id = self._json('POST', '/containers/%s/exec' % quote(container_name), payload={
+            u'AttachStdout': True,
+            u'AttachStderr': True,
+            u'Tty': False,
+            u'Cmd': list(args),
+        })[u'Id']
+        conn, response = self._send('POST', '/exec/%s/start' % exec_id,
+                                    body=json.dumps({u'Detach': False, u'Tty': False}),
+                                    headers={'Content-Type': 'application/json'})
+        if response.status >= 400:
+            data = response.read()
+            self._release(conn, response, reusable=False)
+            raise DockerAPIError(response.status, self._error_message(data))
+
+        def frames():
+            # the exec stream is hijacked by daemon, the connection cannot be reused
+            try:
+                for frame in iter_frames(response):
+                    yield frame
+            finally:
+                self._release(conn, response, reusable=False)
+
+        return exec_id, frames()
+
+    def exec_exit_code(self, exec_id):
+        '''
+        :return: exit code of finished exec instance
+        '''
+        return self._json('GET', '/exec/%s/json' % exec_id).get(u'ExitCode')
+
+    @trace.traced(u'docker.exec', container=0, command=slice(1, None))
+    def execute(self, containter_name, *args):
+        '''
+        Execute command(-s) in the container
+        :param containter_name: container name
+        :param args: the list of command line arguments
+        :return: exit code of command execution
+        '''
+        logger.info(**{u'msg': u'Execute command in the container',
+                       u'container.name': containter_name,
+                       u'command.args': args})
+        try:
+            exec_id, frames = self.exec_frames(containter_name, *args)
+            stdout, stderr = [], []
+            for stream_type, payload in frames:
+                (stderr if stream_type == STREAM_STDERR else stdout).append(payload)
+            span = trace.current()
+            span.set(u'bytes.received', sum(len(p) for p in stdout))
+            stdout = b''.join(stdout).decode('utf-8', 'replace')
+            stderr = b''.join(stderr).decode('utf-8', 'replace')
+            exit_code = self.exec_exit_code(exec_id)
+            span.set(u'exit.code', exit_code)
+            if exit_code != 0:
+                if stdout:
+                    print(stdout)
+                if stderr:
+                    print(stderr)
+                return []
+            return stdout
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return []
+
+    def exec_stream(self, containter_name, *args, **kwargs):
+        '''
+        Execute command(-s) in the container in streaming mode, the output is not kept in memory
+
+        :param containter_name: container name
+        :param args: the list of command line arguments
+        :param raw: stream raw chunks instead of lines, default: False
+        :param tail_size: the number of output lines kept for error reports, default: 100
+        :return: ExecStream
+        '''
+        logger.info(**{u'msg': u'Execute command in the container (streaming)',
+                       u'container.name': containter_name,
+                       u'command.args': args})
+        span = trace.started(u'docker.exec_stream', container=containter_name, command=list(args))
+        try:
+            exec_id, frames = self.exec_frames(containter_name, *args)
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            span.finish(err)
+            return ExecStream(iter(()), lambda: -1, args=args)
+        frames, exit_code = traced_frames(span, frames, lambda: self.exec_exit_code(exec_id))
+        return ExecStream(frames, exit_code, args=args,
+                          raw=kwargs.get('raw', False), tail_size=kwargs.get('tail_size', 100))
+
+    @trace.traced(u'docker.commit', container=0, image=1)
+    def commit(self, containter_name, image_name=None, labels=None, changes=None):
+        '''
+        Commit container to image
+
+        :param containter_name: container name
+        :param image_name: image name, the image without name is committed if only labels are specified
+        :param labels: the dict of image labels
+        :param changes: the list of Dockerfile instructions applied to the image, like CMD, ENV
+        :return: image id
+        '''
+        logger.info(**{u'msg': u'Committing container into image',
+                       u'container.name': containter_name,
+                       u'image.name': image_name})
+
+        if not containter_name or not (image_name or labels):
+            logger.info(**{u'msg': u'No container or image names for commit',
+                           u'container.name': containter_name,
+                           u'image.name': image_name})
+            return []
+
+        params = {'container': containter_name}
+        if image_name:
+            params['repo'], params['tag'] = _split_image_name(image_name)
+        changes = ['LABEL %s="%s"' % kv for kv in sorted((labels or {}).items())] + list(changes or [])
+        if changes:
+            params['changes'] = '\n'.join(changes)
+        try:
+            _id = self._json('POST', '/commit', params=params)[u'Id']
+            logger.info(**{u'msg': 'Container committed to the image',
+                           u'container.name': containter_name,
+                           u'image.name': image_name,
+                           u'image.id': _id})
+            if image_name:
+                self._inventory_update('add_image', _id, image_name)
+            return _id
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return []
+
+    @trace.traced(u'docker.tag', image=0, tag=1)
+    def tag(self, image, image_name):
+        '''
+        Tag the image
+
+        :param image: image id or name
+        :param image_name: new image name
+        :return: True if the image was tagged
+        '''
+        logger.info(**{u'msg': u'Tagging image', u'image.id': image, u'image.name': image_name})
+        repo, tag = _split_image_name(image_name)
+        try:
+            self._request('POST', '/images/%s/tag' % quote(image), params={'repo': repo, 'tag': tag})
+            self._inventory_update('tag_image', image, image_name)
+            return True
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return False
+
+    def events(self, since=None):
+        '''
+        Stream docker events
+
+        :param since: unix timestamp, stream the events since the time
+        :return: the tuple (the iterator of events, the function which closes the stream)
+        '''
+        path = '/events?%s' % urlencode({'since': '%d' % since}) if since else '/events'
+        # the stream is closed by the socket shutdown, the connection object drops the socket
+        # once the response is read until close. In python 2 the dropped socket object is closed
+        # by replacing its real socket, which is kept by the response
+        conn = self._pool.new()
+        conn.connect()
+        sock = getattr(conn.sock, '_sock', conn.sock)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+        except (socket.error, http_client.HTTPException):
+            conn.close()
+            raise
+        if response.status >= 400:
+            data = response.read()
+            conn.close()
+            raise DockerAPIError(response.status, self._error_message(data))
+
+        def events():
+            try:
+                for line in iter_lines(response):
+                    try:
+                        yield json.loads(line.decode('utf-8'))
+                    except ValueError as err:
+                        logger.error(**{u'msg': u'{}'.format(err), u'event.details': u'{!r}'.format(line)})
+            except (socket.error, http_client.HTTPException, ValueError):
+                pass
+            finally:
+                response.close()
+                conn.close()
+
+        def close():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        return events(), close
+
+    @trace.traced(u'docker.image_ids', label=0)
+    def image_ids(self, label):
+        '''
+        Find images, including intermediate ones, by label
+
+        :param label: label filter, format: key or key=value
+        :return: the list of image ids
+        '''
+        try:
+            images = self._json('GET', '/images/json', params={'all': 1, 'filters': json.dumps({'label': [label]})})
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return []
+        return [img[u'Id'] for img in images]
+
+    @trace.traced(u'docker.inspect_image', image=0, path=1)
+    def inspect_image(self, image_name, path):
+        '''
+        Inspect docker image
+
+        :param image_name: Docker image name or id
+        :param path: JSON path
+        :return: selection by JSON path
+        '''
+        try:
+            result = self._json('GET', '/images/%s/json' % quote(image_name))
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return None
+        return _select(result, path)
+
+    @trace.traced(u'docker.inspect', container=0, path=1)
+    def inspect(self, container_name, path):
+        '''
+        Inspect docker container
+
+        :param container_name: Docker container name
+        :param path: JSON path
+        :return: selection by JSON path
+        '''
+        logger.info(**{u'msg': u'Inspect docker container',
+                       u'container.name': container_name,
+                       u'json.path': path})
+        try:
+            result = self._json('GET', '/containers/%s/json' % quote(container_name))
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return None
+        return _select(result, path)
+
+    def _path_stat(self, container_name, path):
+        try:
+            response, _ = self._request('HEAD', '/containers/%s/archive' % quote(container_name),
+                                        params={'path': path})
+        except DockerAPIError:
+            return None
+        stat = response.getheader('X-Docker-Container-Path-Stat')
+        return json.loads(base64.b64decode(stat).decode('utf-8')) if stat else None
+
+    def _send_chunked(self, method, path, params, chunks, content_type='application/x-tar'):
+        '''
+        Send the request body by chunked transfer encoding while it's produced, over the new connection
+        as the request cannot be re-sent
+
+        :param params: query parameters, the list value is sent as repeated parameter
+        :param chunks: the iterator of body chunks
+        :return: the tuple (response, data)
+        '''
+        conn = self._pool.new()
+        try:
+            conn.putrequest(method, '%s?%s' % (path, urlencode(params, doseq=True)))
+            conn.putheader('Content-Type', content_type)
+            conn.putheader('Transfer-Encoding', 'chunked')
+            conn.endheaders()
+            for chunk in chunks:
+                if chunk:
+                    conn.send(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+            conn.send(b'0\r\n\r\n')
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, response)
+        if response.status >= 400:
+            raise DockerAPIError(response.status, self._error_message(data))
+        return response, data
+
+    def _put_archive(self, container_name, path, chunks):
+        self._send_chunked('PUT', '/containers/%s/archive' % quote(container_name), {'path': path}, chunks)
+
+    @trace.traced(u'docker.put_archive', container=0, destination=1)
+    def put_archive(self, container_name, path, chunks):
+        '''
+        Extract the tar archive to the directory in the container, the archive is streamed
+        to PUT /containers/{id}/archive
+
+        :param container_name: container name
+        :param path: the directory in the container, it must exist
+        :param chunks: the iterator of archive chunks, see iter_archive()
+        :return: result of copying (True/False)
+        '''
+        logger.info(**{u'msg': u'Extracting archive to the container',
+                       u'container.name': container_name,
+                       u'destination.path': path})
+        try:
+            self._put_archive(container_name, path, trace.counted(chunks, u'bytes.sent'))
+            return True
+        except (DockerAPIError, socket.error, http_client.HTTPException, tarfile.TarError, IOError, OSError) as err:
+            logger.error(msg=u'{}'.format(err))
+            return False
+
+    def _copy_to_container(self, src, container_name, path):
+        stat = self._path_stat(container_name, path)
+        if stat and stat.get(u'mode', 0) & _GO_MODE_DIR:
+            target_dir, arcname = path, os.path.basename(os.path.normpath(src))
+        else:
+            target_dir, arcname = posixpath.dirname(path) or '/', posixpath.basename(path)
+        self._put_archive(container_name, target_dir, iter_archive([(src, arcname)], uid=None, gid=None))
+
+    def _copy_from_container(self, container_name, path, dest):
+        conn, response = self._send('GET', '/containers/%s/archive' % quote(container_name),
+                                    params={'path': path})
+        try:
+            if response.status >= 400:
+                raise DockerAPIError(response.status, self._error_message(response.read()))
+            if os.path.isdir(dest):
+                target_dir, rename = dest, None
+            else:
+                target_dir, rename = os.path.dirname(dest) or '.', os.path.basename(dest)
+            real_dir = os.path.realpath(target_dir)
+            tar = tarfile.open(fileobj=response, mode='r|')
+            try:
+                for member in tar:
+                    if rename:
+                        head, sep, tail = member.name.partition('/')
+                        member.name = rename + sep + tail
+                    # the archive comes from the container, nothing is written outside of the destination
+                    target = member_target(real_dir, member)
+                    if not member.isdir() and (os.path.islink(target) or os.path.isfile(target)):
+                        # the file is replaced, the symlink in its place is not followed
+                        os.remove(target)
+                    tar.extract(member, target_dir)
+            finally:
+                tar.close()
+            response.read()
+        finally:
+            self._release(conn, response)
+
+    def _stream_get(self, path, params=None):
+        '''
+        :return: the iterator of response body chunks, empty on error
+        '''
+        def stream():
+            try:
+                conn, response = self._send('GET', path, params=params)
+            except DockerAPIError as err:
+                logger.error(msg=err.message)
+                return
+            if response.status >= 400:
+                data = response.read()
+                self._release(conn, response)
+                logger.error(msg=self._error_message(data))
+                return
+            finished = False
+            try:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    yield chunk
+                finished = True
+            finally:
+                # the connection with unread response is not reused
+                self._release(conn, response, reusable=finished)
+        return stream()
+
+    @trace.traced_iter(u'docker.get_archive', container=0, path=1)
+    def get_archive(self, container_name, path):
+        '''
+        Stream the tar archive of the path in the container, GET /containers/{id}/archive
+
+        :param container_name: container name
+        :param path: the path in the container
+        :return: the iterator of archive chunks, empty on error
+        '''
+        return self._stream_get('/containers/%s/archive' % quote(container_name), params={'path': path})
+
+    @trace.traced_iter(u'docker.export', container=0)
+    def export(self, container_name):
+        '''
+        Stream the filesystem of the container as tar archive, GET /containers/{id}/export
+
+        :param container_name: container name
+        :return: the iterator of archive chunks, empty on error
+        '''
+        return self._stream_get('/containers/%s/export' % quote(container_name))
+
+    @trace.traced(u'docker.diff', container=0)
+    def changes(self, container_name):
+        '''
+        The changes of the container filesystem since it was created from the image
+
+        :param container_name: container name
+        :return: the list of (kind, path) tuples, the kind is A (added), C (changed) or D (deleted),
+            None on error
+        '''
+        try:
+            changes = self._json('GET', '/containers/%s/changes' % quote(container_name)) or []
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return None
+        return [(_CHANGE_KINDS[c[u'Kind']], c[u'Path']) for c in changes]
+
+    @trace.traced(u'docker.import', image=1)
+    def import_image(self, chunks, image_name, changes=None):
+        '''
+        Create the image from the filesystem archive, POST /images/create?fromSrc=-
+
+        :param chunks: the iterator of archive chunks
+        :param image_name: image name
+        :param changes: the list of Dockerfile instructions, like ENV, CMD, WORKDIR, LABEL
+        :return: image id, None on error
+        '''
+        logger.info(**{u'msg': u'Importing image', u'image.name': image_name})
+        repo, tag = _split_image_name(image_name)
+        params = {'fromSrc': '-', 'repo': repo, 'tag': tag, 'changes': list(changes or [])}
+        try:
+            _, data = self._send_chunked('POST', '/images/create', params, trace.counted(chunks, u'bytes.sent'))
+        except (DockerAPIError, socket.error, http_client.HTTPException, IOError, OSError) as err:
+            logger.error(msg=u'{}'.format(err))
+            return None
+        # the progress messages, the last one is the image id or the error
+        messages = [json.loads(line) for line in data.decode('utf-8').splitlines() if line.strip()]
+        last = messages[-1] if messages else {}
+        if u'error' in last or not last.get(u'status'):
+            logger.error(msg=last.get(u'error') or u'No image id in the response of import')
+            return None
+        self._inventory_update('add_image', last[u'status'], image_name)
+        return last[u'status']
+
+    @trace.traced(u'docker.container_size', container=0)
+    def container_size(self, container_name):
+        '''
+        :param container_name: container name
+        :return: the tuple (the size of the writable layer, the total size of the filesystem), bytes
+        '''
+        try:
+            details = self._json('GET', '/containers/%s/json' % quote(container_name), params={'size': 1})
+        except DockerAPIError as err:
+            logger.error(msg=err.message)
+            return None, None
+        return details.get(u'SizeRw'), details.get(u'SizeRootFs')
+
+    @trace.traced(u'docker.cp', source=0, destination=1)
+    def copy(self, src, dest):
+        '''
+        Copy files/folders between a container and the local filesystem
+
+        :param src: source path
+        :param dest: destination path
+        :return: result of copying (True/False)
+        '''
+        logger.info(**{u'msg': u'Copying files',
+                       u'source.path': src,
+                        u'destination.path': dest})
+        src_container, src_path = _split_container_path(src)
+        dest_container, dest_path = _split_container_path(dest)
+        try:
+            if dest_container and not src_container:
+                self._copy_to_container(src_path, dest_container, dest_path)
+            elif src_container and not dest_container:
+                self._copy_from_container(src_container, src_path, dest_path)
+            else:
+                logger.error(msg=u'Copying between containers or local paths is not supported')
+                return False
+            return True
+        except (DockerAPIError, http_client.HTTPException, IOError, OSError, tarfile.TarError) as err:
+            logger.error(msg=u'{}'.format(err))
+            return False
@@ -7,3 +7,10 @@ class CommandExecutionFailed(Exception):
 
 class ShellExecutionFailed(Exception):
     pass
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__('%s %s' % (status, message))
+        self.status = status
+        self.message = message
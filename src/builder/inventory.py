@@ -0,0 +1,306 @@
+from __future__ import (absolute_import, division, print_function)
+
+import time
+import threading
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+# the delay before the resync after the event stream was dropped, seconds
+RESYNC_DELAY = 1.0
+
+# container statuses by event action, in terms of `docker ps`
+_CONTAINER_STATUSES = {
+    u'create': u'Created',
+    u'start': u'Up',
+    u'unpause': u'Up',
+    u'pause': u'Up (Paused)',
+    u'die': u'Exited',
+    u'stop': u'Exited',
+    u'kill': u'Exited',
+}
+
+
+def short_id(_id):
+    '''
+    :return: 12-char id without digest algorithm, like `docker ps` and `docker images` report
+    '''
+    return (_id or u'').split(u':')[-1][:12]
+
+
+class Inventory(object):
+    '''
+    The in-memory index of images and containers, it's loaded once by full listing and kept current
+    by `docker events` stream. The stream is watched in the background thread, if it drops the index
+    is resynced by full listing and the stream is reopened from the resync time.
+
+    The changes made by the builder itself are applied immediately, without waiting for events.
+
+    Usage:
+
+        inventory = get_inventory(docker_cli)
+        inventory.image(u'alpine:3.5')                          # the record or None
+        inventory.container(u'alpine3.5-build-container')       # the record or None
+    '''
+    def __init__(self, cli):
+        '''
+        :param cli: docker client
+        '''
+        self._cli = cli
+        self._lock = threading.RLock()
+        self._images = dict()
+        self._image_names = dict()
+        self._containers = dict()
+        self._container_names = dict()
+        # the ids of removed containers, the late events of the containers are ignored
+        self._removed = set()
+        # the images are relisted on next lookup, if the event has not enough details to update them
+        self._images_dirty = False
+        self._stopped = threading.Event()
+        self._close_stream = None
+        self._watcher = None
+        self.resyncs = 0
+
+    def _list_images(self):
+        images, image_names = dict(), dict()
+        for img in self._cli.images_list():
+            images.setdefault(img[u'id'], img)
+            if img[u'repository'] != u'<none>':
+                image_names[u'%s:%s' % (img[u'repository'], img[u'tag'])] = img[u'id']
+        return images, image_names
+
+    def load(self):
+        '''
+        Load the index by full listing of images and containers
+        '''
+        images, image_names = self._list_images()
+        containers, container_names = dict(), dict()
+        for cont in self._cli.containers_list():
+            containers[cont[u'id']] = cont
+            container_names[cont[u'names']] = cont[u'id']
+        with self._lock:
+            self._images, self._image_names = images, image_names
+            self._containers, self._container_names = containers, container_names
+            self._images_dirty = False
+        logger.info(**{u'msg': u'Inventory was loaded', u'images': len(images), u'containers': len(containers)})
+
+    def _reload_images(self):
+        images, image_names = self._list_images()
+        with self._lock:
+            self._images, self._image_names = images, image_names
+            self._images_dirty = False
+
+    def start(self):
+        '''
+        Load the index and start watching docker events
+        '''
+        since = time.time()
+        self.load()
+        self._watcher = threading.Thread(target=self._watch, args=(since,), name=u'inventory-events')
+        self._watcher.daemon = True
+        self._watcher.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop watching docker events
+        '''
+        self._stopped.set()
+        if self._close_stream:
+            self._close_stream()
+        if self._watcher:
+            self._watcher.join()
+
+    def _watch(self, since):
+        while not self._stopped.is_set():
+            try:
+                # the events since the load are replayed, they are applied idempotently
+                events, self._close_stream = self._cli.events(since=since)
+                # stop() was called while the stream was opened
+                if self._stopped.is_set():
+                    self._close_stream()
+                for event in events:
+                    self.apply(event)
+            except Exception as err:
+                # the stream closed by stop() may fail, that's expected
+                if self._stopped.is_set():
+                    break
+                logger.warning(msg=u'Docker events stream failed, %s' % err)
+            if self._stopped.wait(RESYNC_DELAY):
+                break
+            logger.warning(msg=u'Docker events stream was dropped, resyncing the inventory')
+            since = time.time()
+            try:
+                self.load()
+                self.resyncs += 1
+            except Exception as err:
+                logger.error(msg=u'Cannot resync the inventory, %s' % err)
+
+    def apply(self, event):
+        '''
+        Update the index by docker event
+
+        :param event: docker event, the dict in Engine API format
+        '''
+        _type, action = event.get(u'Type'), (event.get(u'Action') or u'').split(u':')[0]
+        actor = event.get(u'Actor') or {}
+        attrs = actor.get(u'Attributes') or {}
+        _id = short_id(actor.get(u'ID'))
+        if _type == u'container':
+            if _id in self._removed:
+                return
+            if action == u'destroy':
+                self.remove_containers(_id)
+            elif action == u'rename':
+                self.rename_container(_id, attrs.get(u'name'))
+            elif action in _CONTAINER_STATUSES:
+                with self._lock:
+                    if _id in self._containers:
+                        self._containers[_id][u'status'] = _CONTAINER_STATUSES[action]
+                    else:
+                        self.add_container(_id, attrs.get(u'name'), attrs.get(u'image'),
+                                           status=_CONTAINER_STATUSES[action])
+            elif action == u'commit':
+                self._images_dirty = True
+        elif _type == u'image':
+            if action == u'tag' and attrs.get(u'name'):
+                self.add_image(_id, attrs[u'name'])
+            elif action == u'delete':
+                self.remove_image(_id)
+            else:
+                self._images_dirty = True
+
+    def add_container(self, _id, name, image, status=u'Up'):
+        '''
+        Add the container started by the builder
+        '''
+        if not _id or not name:
+            return
+        with self._lock:
+            self._containers[short_id(_id)] = {
+                u'id': short_id(_id), u'names': name, u'image': image or u'', u'labels': u'',
+                u'command': u'', u'createdAt': u'', u'localVolumes': u'', u'mounts': u'', u'networks': u'',
+                u'ports': u'', u'status': status, u'runningFor': u'', u'size': 0,
+            }
+            self._container_names[name] = short_id(_id)
+
+    def remove_containers(self, *refs):
+        '''
+        Remove the containers by ids or names
+        '''
+        with self._lock:
+            for ref in refs:
+                cont = self.container(ref)
+                if cont:
+                    self._removed.add(cont[u'id'])
+                    self._containers.pop(cont[u'id'], None)
+                    self._container_names.pop(cont[u'names'], None)
+
+    def rename_container(self, ref, name):
+        with self._lock:
+            cont = self.container(ref)
+            if cont and name:
+                self._container_names.pop(cont[u'names'], None)
+                cont[u'names'] = name.lstrip(u'/')
+                self._container_names[cont[u'names']] = cont[u'id']
+
+    def add_image(self, _id, name):
+        '''
+        Add the image name, the name is moved from the image which had it before
+        '''
+        with self._lock:
+            _id = short_id(_id)
+            if u':' not in name.rpartition(u'/')[2]:
+                name = u'%s:latest' % name
+            repository, _, tag = name.rpartition(u':')
+            self._images[_id] = dict(self._images.get(_id) or {u'size': 0, u'createdAt': u''},
+                                     id=_id, repository=repository, tag=tag)
+            self._image_names[name] = _id
+
+    def tag_image(self, ref, name):
+        '''
+        Add the name to the image referenced by name or id
+        '''
+        img = self.image(ref)
+        if img:
+            self.add_image(img[u'id'], name)
+        else:
+            self._images_dirty = True
+
+    def remove_image(self, ref):
+        with self._lock:
+            img = self.image(ref)
+            if img:
+                self._images.pop(img[u'id'], None)
+                for name in [n for n, i in self._image_names.items() if i == img[u'id']]:
+                    del self._image_names[name]
+
+    def image(self, ref):
+        '''
+        :param ref: image name or id
+        :return: image record or None
+        '''
+        if self._images_dirty:
+            self._reload_images()
+        with self._lock:
+            _id = self._image_names.get(ref) or short_id(ref)
+            return self._images.get(_id)
+
+    def image_names(self):
+        '''
+        :return: the list of image names, repository:tag
+        '''
+        if self._images_dirty:
+            self._reload_images()
+        with self._lock:
+            return sorted(self._image_names)
+
+    def container(self, ref):
+        '''
+        :param ref: container name or id
+        :return: container record or None
+        '''
+        with self._lock:
+            _id = self._container_names.get(ref) or short_id(ref)
+            return self._containers.get(_id)
+
+    def containers(self):
+        '''
+        :return: the list of container records
+        '''
+        with self._lock:
+            return list(self._containers.values())
+
+
+_inventories = dict()
+_inventories_lock = threading.Lock()
+
+
+def get_inventory(cli):
+    '''
+    :param cli: docker client
+    :return: the inventory shared by all clients of the same docker host, it's started on first use
+    '''
+    with _inventories_lock:
+        if cli.endpoint not in _inventories:
+            _inventories[cli.endpoint] = Inventory(cli).start()
+        return _inventories[cli.endpoint]
+
+
+def current_inventory(cli):
+    '''
+    :return: the inventory of docker host of the client, None if it was not started
+    '''
+    return _inventories.get(cli.endpoint)
+
+
+def close_inventories():
+    ''' stop watching docker events of all docker hosts
+    '''
+    with _inventories_lock:
+        inventories = list(_inventories.values())
+        _inventories.clear()
+    for inventory in inventories:
+        inventory.stop()
+
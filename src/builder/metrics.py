@@ -0,0 +1,230 @@
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import errno
+import fcntl
+import bisect
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+# the log-scale buckets of duration histograms, seconds: 1ms, 2ms, 4ms ... ~35 min
+DURATION_BUCKETS = tuple(0.001 * 2 ** i for i in range(22))
+
+# the file name of node_exporter textfile collector
+TEXTFILE_NAME = u'docker_image_builder.prom'
+
+
+def _escape(value):
+    return u'{}'.format(value).replace(u'\\', u'\\\\').replace(u'\n', u'\\n').replace(u'"', u'\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return u''
+    return u'{%s}' % u','.join(u'%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return u'+Inf'
+    return u'%d' % value if isinstance(value, int) or float(value).is_integer() else repr(float(value))
+
+
+def parse_samples(text):
+    '''
+    :param text: the metrics in Prometheus text exposition format, like the textfile
+    :return: the ordered dict of samples {(name, labels): value}, labels as rendered: {operation="docker.exec"}
+    '''
+    samples = OrderedDict()
+    for line in text.splitlines():
+        if not line.strip() or line.startswith(u'#'):
+            continue
+        key, _, value = line.rpartition(u' ')
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        name, brace, labels = key.partition(u'{')
+        samples[(name, brace + labels)] = value
+    return samples
+
+
+class _Metric(object):
+    '''
+    The metric keeps the values by the tuples of label values, one sample per value
+    '''
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((k, list(v) if isinstance(v, list) else v) for k, v in self._values.items())
+
+    def samples(self):
+        return [(self.name, _labels(self.labels, k), v) for k, v in self._snapshot()]
+
+    def sample_names(self):
+        return (self.name,)
+
+    def render(self, previous=None):
+        '''
+        :param previous: the samples added to the samples of the metric, see parse_samples(),
+            the samples of the metric are removed from the dict
+        :return: the lines of the metric
+        '''
+        previous = {} if previous is None else previous
+        lines = [u'# HELP %s %s' % (self.name, self.help), u'# TYPE %s %s' % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append(u'%s%s %s' % (name, labels, _number(value + previous.pop((name, labels), 0))))
+        for name, labels in [key for key in previous if key[0] in self.sample_names()]:
+            lines.append(u'%s%s %s' % (name, labels, _number(previous.pop((name, labels)))))
+        return lines
+
+
+class Counter(_Metric):
+    kind = u'counter'
+
+    def inc(self, value=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Histogram(_Metric):
+    '''
+    The histogram with fixed buckets, the observation is one bisect and the increment of one bucket,
+    the buckets are accumulated on rendering. The value of the labels is the list: the counts of buckets
+    and +Inf, sum
+    '''
+    kind = u'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[pos] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for labels, counts in self._snapshot():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                total += count
+                samples.append((self.name + u'_bucket', _labels(self.labels, labels, [(u'le', _number(bound))]),
+                                total))
+            samples.append((self.name + u'_sum', _labels(self.labels, labels), counts[-1]))
+            samples.append((self.name + u'_count', _labels(self.labels, labels), total))
+        return samples
+
+    def sample_names(self):
+        return tuple(self.name + suffix for suffix in (u'_bucket', u'_sum', u'_count'))
+
+
+class Registry(object):
+    '''
+    The metrics of builder operations, they are collected from the finished trace spans
+
+    Usage:
+
+        registry = Registry()
+        trace.enable(record=False).listeners.append(registry.observe_span)
+        ...
+        registry.write_textfile('/var/lib/node_exporter/textfile')
+    '''
+    def __init__(self):
+        self.operations = Counter(u'builder_operations_total',
+                                  u'The number of docker operations, build steps and build stages',
+                                  labels=(u'operation', u'status'))
+        self.durations = Histogram(u'builder_operation_duration_seconds',
+                                   u'The duration of docker operations, build steps and build stages',
+                                   labels=(u'operation',))
+        self.transferred = Counter(u'builder_transferred_bytes_total',
+                                   u'The bytes sent to and received from the containers',
+                                   labels=(u'operation', u'direction'))
+        self.cache = Counter(u'builder_cache_requests_total', u'The build cache lookups of build steps',
+                             labels=(u'step', u'result'))
+
+    def observe_span(self, span):
+        '''
+        Update the metrics by the finished span, see builder.trace
+        '''
+        failed = u'error' in span.attributes or span.attributes.get(u'exit.code') not in (None, 0)
+        self.operations.inc(1, span.name, u'error' if failed else u'ok')
+        self.durations.observe(span.end - span.start, span.name)
+        for key, direction in ((u'bytes.sent', u'sent'), (u'bytes.received', u'received')):
+            if key in span.attributes:
+                self.transferred.inc(span.attributes[key], span.name, direction)
+        if u'cache.hit' in span.attributes:
+            self.cache.inc(1, span.name, u'hit' if span.attributes[u'cache.hit'] else u'miss')
+
+    def render(self, previous=None):
+        '''
+        :param previous: the samples added to the metrics, see parse_samples()
+        :return: the metrics in Prometheus text exposition format
+        '''
+        previous = OrderedDict(previous or {})
+        lines = []
+        for metric in (self.operations, self.durations, self.transferred, self.cache):
+            lines.extend(metric.render(previous))
+        return u'\n'.join(lines) + u'\n'
+
+    def write_textfile(self, directory, name=TEXTFILE_NAME):
+        '''
+        Add the metrics to the file of node_exporter textfile collector. The builder processes share the file:
+        the counters and the histograms of the file are summed up with the metrics of the process under
+        the lock. The file is replaced atomically so the collector never reads the partial file
+
+        :param directory: the directory of textfile collector
+        :param name: the file name
+        :return: the path of the file
+        '''
+        path = os.path.join(directory, name)
+        # the lock is released when the file is closed, the collector reads *.prom files only
+        with open(os.path.join(directory, u'.%s.lock' % name), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=u'.%s.' % name)
+            try:
+                with os.fdopen(fd, 'wb') as target:
+                    target.write(self.render(parse_samples(read_textfile(directory, name))).encode('utf-8'))
+                os.chmod(tmp_path, 0o644)
+                os.rename(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        logger.info(**{u'msg': u'Metrics were written', u'metrics.path': path})
+        return path
+
+
+def read_textfile(directory, name=TEXTFILE_NAME):
+    '''
+    :param directory: the directory of textfile collector
+    :param name: the file name
+    :return: the metrics of the file, empty string if there's no file
+    '''
+    try:
+        with io.open(os.path.join(directory, name), encoding='utf-8') as source:
+            return source.read()
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return u''
@@ -0,0 +1,194 @@
+from __future__ import (absolute_import, division, print_function)
+
+import re
+import time
+import uuid
+import threading
+
+from builder.log import Logger
+from builder.inventory import get_inventory
+
+logger = Logger(__name__)
+
+# the name of idle container: builder-pool-<image>-<creation time>-<random suffix>
+POOL_NAME_PREFIX = u'builder-pool-'
+POOL_NAME_RE = re.compile(r'^%s.*-(\d+)-[0-9a-f]{8}$' % POOL_NAME_PREFIX)
+
+# the idle container older than TTL is removed, seconds
+DEFAULT_TTL = 3600
+
+# the pool refills of the process are serialized, so concurrent builds do not overfill the pool
+_refill_lock = threading.Lock()
+
+# the refill threads of the process, see close_pools()
+_refills = []
+_refills_lock = threading.Lock()
+
+
+def pool_containers(cli, image_name=None):
+    '''
+    :param cli: docker client
+    :param image_name: source image name, default: the containers of all pools
+    :return: the list of idle containers, the oldest first
+    '''
+    result = []
+    for cont in get_inventory(cli).containers():
+        match = POOL_NAME_RE.match(cont[u'names'])
+        if not match or (image_name and cont[u'image'] != image_name):
+            continue
+        result.append({
+            u'id': cont[u'id'],
+            u'name': cont[u'names'],
+            u'image': cont[u'image'],
+            u'created': int(match.group(1)),
+            u'status': cont[u'status'],
+        })
+    return sorted(result, key=lambda c: c[u'created'])
+
+
+class ContainerPool(object):
+    '''
+    The pool of idle base containers started from the source image. The idle containers are named
+    with `builder-pool-` prefix and the creation time, they are not labelled as the labels of
+    the container are committed to the image. The container is checked out by renaming it
+    to the staging container name, so the same container cannot be checked out twice, even by
+    concurrent builder processes.
+
+    Usage:
+
+        pool = ContainerPool(docker_cli, 'alpine:3.5', size=2)
+        if not pool.checkout('alpine3.5-build-container'):
+            docker_cli.run_base_container('alpine:3.5', 'alpine3.5-build-container')
+        pool.refill()                   # in the background
+        ...
+        pool.close()                    # waits for the refill
+    '''
+    def __init__(self, cli, image_name, size=1, ttl=DEFAULT_TTL):
+        '''
+        :param cli: docker client
+        :param image_name: source image name
+        :param size: the number of idle containers
+        :param ttl: the max idle time of the container, seconds
+        '''
+        self._cli = cli
+        self.image_name = image_name
+        self.size = size
+        self.ttl = ttl
+        self._refills = []
+
+    def idle(self):
+        '''
+        :return: the list of idle running containers, the oldest first
+        '''
+        return [c for c in pool_containers(self._cli, self.image_name)
+                if c[u'status'].startswith((u'Up', u'running'))]
+
+    def checkout(self, container_name, rerun=False):
+        '''
+        Take the idle container from the pool and rename it to the container name
+
+        :param container_name: staging container name
+        :param rerun: remove the container with the same name if exists
+        :return: container id or None if the pool is empty
+        '''
+        existing = [c[u'id'] for c in [get_inventory(self._cli).container(container_name)] if c]
+        if existing:
+            if not rerun:
+                return None
+            self._cli.teardown(*existing)
+
+        now = time.time()
+        for cont in reversed(self.idle()):
+            if now - cont[u'created'] > self.ttl:
+                continue
+            # the rename of the container which was checked out by another process fails
+            if self._cli.rename(cont[u'name'], container_name):
+                logger.info(**{u'msg': u'Container was checked out from the pool',
+                               u'image.name': self.image_name,
+                               u'container.name': container_name,
+                               u'container.id': cont[u'id']})
+                return cont[u'id']
+        logger.info(**{u'msg': u'No idle containers in the pool', u'image.name': self.image_name})
+        return None
+
+    def evict(self):
+        '''
+        Remove the containers idle longer than TTL, stopped ones and the oldest ones above the pool size
+
+        :return: the list of removed container ids
+        '''
+        now = time.time()
+        containers = pool_containers(self._cli, self.image_name)
+        alive = [c for c in containers if c[u'status'].startswith((u'Up', u'running')) and
+                 now - c[u'created'] <= self.ttl]
+        evicted = [c[u'id'] for c in containers if c not in alive]
+        evicted.extend(c[u'id'] for c in alive[:max(0, len(alive) - self.size)])
+        if evicted:
+            logger.info(**{u'msg': u'Evicting idle containers', u'image.name': self.image_name,
+                           u'container.ids': evicted})
+            self._cli.teardown(*evicted)
+        return evicted
+
+    def fill(self):
+        '''
+        Start the containers up to the pool size
+
+        :return: the list of started container ids
+        '''
+        started = []
+        for _ in range(self.size - len(self.idle())):
+            name = u'%s%s-%d-%s' % (POOL_NAME_PREFIX, re.sub(r'[^a-zA-Z0-9_.-]', u'', self.image_name),
+                                    time.time(), uuid.uuid4().hex[:8])
+            _id = self._cli.run_base_container(self.image_name, name)
+            if _id:
+                started.append(_id)
+        return started
+
+    def drain(self):
+        '''
+        Remove all idle containers of the pool
+
+        :return: the list of removed container ids
+        '''
+        ids = [c[u'id'] for c in pool_containers(self._cli, self.image_name)]
+        if ids:
+            logger.info(**{u'msg': u'Draining the pool', u'image.name': self.image_name, u'container.ids': ids})
+            self._cli.teardown(*ids)
+        return ids
+
+    def refill(self):
+        '''
+        Evict and fill the pool in the background thread. The thread is not a daemon one,
+        the process waits for the refill before exit. The refill is joined by close() or close_pools()
+
+        :return: the refill thread
+        '''
+        def _refill():
+            with _refill_lock:
+                self.evict()
+                self.fill()
+
+        thread = threading.Thread(target=_refill, name=u'pool-refill')
+        thread.start()
+        self._refills = [t for t in self._refills if t.is_alive()] + [thread]
+        with _refills_lock:
+            _refills[:] = [t for t in _refills if t.is_alive()] + [thread]
+        return thread
+
+    def close(self):
+        '''
+        Wait for the refills of the pool
+        '''
+        refills, self._refills = self._refills, []
+        for thread in refills:
+            thread.join()
+
+
+def close_pools():
+    ''' wait for the refills of all pools of the process
+    '''
+    with _refills_lock:
+        refills = list(_refills)
+        del _refills[:]
+    for thread in refills:
+        thread.join()
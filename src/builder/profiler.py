@@ -0,0 +1,276 @@
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import sys
+import time
+import linecache
+import threading
+import collections
+
+from builder import DEFAULT_SAMPLING_INTERVAL
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+# the directory of builder package
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the components of the builder process: the name and the path fragments of its modules,
+# <builder> is the directory of builder package, the first match wins
+COMPONENTS = (
+    (u'sh', (u'/sh.py',)),
+    (u'logging', (u'<builder>/log.py', u'/logging/')),
+    (u'dataloader', (u'<builder>/dataloader.py', u'/yaml/')),
+    (u'facts', (u'<builder>/utils/facts.py',)),
+    (u'docker.api', (u'<builder>/dockerapi.py', u'/http/client.py', u'/httplib.py', u'/socket.py')),
+    (u'builder', (u'<builder>/',)),
+)
+
+# the time blocked on docker: the thread waits while the docker client or sh runs the command
+DOCKER_WAIT = u'docker.wait'
+# the components which wait for docker in the blocking calls
+DOCKER_COMPONENTS = (u'sh', u'docker.api')
+# the builder functions which wait for the output of docker commands: the path, the function name
+# and the blocking call in the line where the function waits
+DOCKER_WAIT_FRAMES = (
+    (u'<builder>/stream.py', u'iter_output', u'select.select'),
+    (u'<builder>/docker.py', u'_iter_json', u'lines.get'),
+)
+# the time blocked on anything else, like the idle workers of the scheduler
+IDLE = u'idle'
+OTHER = u'other'
+
+# the calls which block the thread, in the line of the innermost frame
+BLOCKING_CALLS = (u'select(', u'poll(', u'acquire(', u'recv', u'read(', u'readinto(', u'readline(',
+                  u'wait(', u'waitpid(', u'sleep(', u'join(', u'accept(')
+# the blocking built-in functions, in the names of cProfile entries
+BLOCKING_FUNCTIONS = (u'select', u'poll', u'acquire', u'recv', u'read', u'wait', u'sleep', u'accept')
+
+
+def _normalize(filename):
+    if filename.startswith(PACKAGE_DIR + os.sep):
+        filename = u'<builder>' + filename[len(PACKAGE_DIR):]
+    return filename.replace(os.sep, u'/')
+
+
+def component(filename):
+    '''
+    :param filename: the file name of the code
+    :return: the component name, see COMPONENTS, None for other code
+    '''
+    filename = _normalize(filename)
+    for name, fragments in COMPONENTS:
+        if any(f in filename for f in fragments):
+            return name
+    return None
+
+
+def _blocking_line(frame):
+    line = linecache.getline(frame.f_code.co_filename, frame.f_lineno)
+    return any(call in line for call in BLOCKING_CALLS)
+
+
+def _docker_wait_frame(filename, name):
+    filename = _normalize(filename)
+    return next((call for path, function, call in DOCKER_WAIT_FRAMES if path in filename and function == name), None)
+
+
+def _waits_for_docker(frame):
+    call = _docker_wait_frame(frame.f_code.co_filename, frame.f_code.co_name)
+    return call is not None and call in linecache.getline(frame.f_code.co_filename, frame.f_lineno)
+
+
+def classify_stack(frames):
+    '''
+    :param frames: the frames of the thread, from innermost to outermost
+    :return: the component where the thread spends the time, DOCKER_WAIT or IDLE if the thread is blocked
+    '''
+    # the builder waits for the output of the docker command, the innermost frame may be a helper like _retry()
+    if any(_waits_for_docker(f) for f in frames):
+        return DOCKER_WAIT
+    components = [component(f.f_code.co_filename) for f in frames]
+    if frames and _blocking_line(frames[0]):
+        return DOCKER_WAIT if set(components) & set(DOCKER_COMPONENTS) else IDLE
+    return next((c for c in components if c), OTHER)
+
+
+def breakdown(totals):
+    '''
+    :param totals: the dict: component -> time or the number of samples
+    :return: the dict: component -> share, percents
+    '''
+    total = sum(totals.values()) or 1
+    return dict((k, round(100.0 * v / total, 1)) for k, v in totals.items())
+
+
+class SamplingProfiler(object):
+    '''
+    The stack sampler: the stacks of all threads are sampled by the daemon thread on the wall clock interval
+    and counted as collapsed stacks for flame graphs, like `main;cli.py:build;docker.py:execute 12`.
+    The threads blocked in system calls, like waiting for docker, are sampled as often as the running ones
+    '''
+    def __init__(self, interval=DEFAULT_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.components = collections.Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._run, name=u'sampling-profiler')
+        self._sampler.daemon = True
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._sampler:
+            self._sampler.join()
+            self._sampler = None
+
+    def _run(self):
+        deadline = time.time()
+        while not self._stopped.is_set():
+            self._sample()
+            # the ticks missed by the slow sample are skipped
+            deadline = max(deadline + self.interval, time.time())
+            self._stopped.wait(max(0, deadline - time.time()))
+
+    def _sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        current = threading.current_thread().ident
+        for ident, top in sys._current_frames().items():
+            if ident == current:
+                continue
+            frames = []
+            while top is not None:
+                frames.append(top)
+                top = top.f_back
+            if not frames:
+                continue
+            self.samples += 1
+            kind = classify_stack(frames)
+            self.components[kind] += 1
+            stack = [u'%s:%s' % (os.path.basename(f.f_code.co_filename), f.f_code.co_name) for f in reversed(frames)]
+            self.stacks[u';'.join([names.get(ident, u'thread-%s' % ident)] + stack + [u'[%s]' % kind])] += 1
+
+    def write(self, path):
+        '''
+        Write the collapsed stacks, the input of flamegraph.pl or speedscope
+
+        :return: the breakdown by components, see breakdown()
+        '''
+        with io.open(path, 'w', encoding='utf-8') as target:
+            for stack, count in sorted(self.stacks.items()):
+                target.write(u'%s %d\n' % (stack, count))
+        return breakdown(self.components)
+
+
+class Profiler(object):
+    '''
+    cProfile of the main thread and the threads started while profiling, their stats are merged
+    '''
+    def __init__(self):
+        # cProfile and pstats are imported on profiling only, they are not needed to start the builder
+        import cProfile
+        self._new_profile = cProfile.Profile
+        self._main = cProfile.Profile()
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _thread_profile(self, frame, event, arg):
+        # the first event of the new thread replaces the profile function by cProfile
+        sys.setprofile(None)
+        profile = self._new_profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # the profiling tool is global since Python 3.12, the main thread is profiled only
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._thread_profile)
+        self._main.enable()
+        return self
+
+    def stop(self):
+        self._main.disable()
+        threading.setprofile(None)
+
+    def stats(self):
+        '''
+        :return: pstats.Stats of all profiled threads
+        '''
+        import pstats
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            for profile in self._profiles:
+                stats.add(profile)
+        return stats
+
+    def write(self, path):
+        '''
+        Write the stats for pstats, like `python -m pstats <path>`
+
+        :return: the breakdown by components of the function own time, see breakdown()
+        '''
+        stats = self.stats()
+        stats.dump_stats(path)
+        return breakdown(profile_components(stats))
+
+
+def profile_components(stats):
+    '''
+    The own time of functions by components, the time of the functions of other modules and built-in functions
+    is accounted to the component of their callers, the time of the blocking built-in functions is
+    DOCKER_WAIT if they are called by the docker client, sh or the functions of DOCKER_WAIT_FRAMES,
+    IDLE otherwise. The time of the blocking function is split by its callers in proportion to their time.
+
+    :param stats: pstats.Stats
+    :return: the dict: component -> seconds
+    '''
+    resolved = dict()
+
+    def resolve(func, seen):
+        if func in resolved:
+            return resolved[func]
+        name = component(func[0])
+        if name is None and func not in seen:
+            callers = stats.stats[func][4] if func in stats.stats else {}
+            # the caller with the most time spent in the function
+            for caller, _ in sorted(callers.items(), key=lambda item: -item[1][3]):
+                name = resolve(caller, seen | set([func]))
+                break
+        resolved[func] = name or OTHER
+        return resolved[func]
+
+    waits = dict()
+
+    def docker_share(func, seen):
+        # the share of the function time spent on behalf of the code waiting for docker
+        if func in waits:
+            return waits[func]
+        if component(func[0]) in DOCKER_COMPONENTS or _docker_wait_frame(func[0], func[2]) is not None:
+            share = 1.0
+        else:
+            callers = stats.stats[func][4] if func in stats.stats else {}
+            callers = [(caller, value[3]) for caller, value in callers.items() if caller not in seen]
+            total = sum(t for _, t in callers)
+            share = sum(t * docker_share(caller, seen | set([func])) for caller, t in callers) / total if total else 0.0
+        waits[func] = share
+        return share
+
+    totals = collections.Counter()
+    for func, (_, _, tottime, _, _) in stats.stats.items():
+        if func[0] == '~' and any(f in func[2] for f in BLOCKING_FUNCTIONS):
+            share = docker_share(func, set())
+            totals[DOCKER_WAIT] += tottime * share
+            totals[IDLE] += tottime * (1 - share)
+        else:
+            totals[resolve(func, set())] += tottime
+    return dict(totals)
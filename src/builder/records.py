@@ -0,0 +1,157 @@
+from __future__ import (absolute_import, division, print_function)
+
+import json
+import time
+
+from six import string_types
+
+
+def _key(name, default=u''):
+    return lambda data: data.get(name, default)
+
+
+def _api_time(data):
+    return time.strftime('%Y-%m-%d %H:%M:%S +0000 UTC', time.gmtime(data.get(u'Created', 0)))
+
+
+def _human_size(size):
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if size < 1000.0:
+            break
+        size /= 1000.0
+    return '%.3g%s' % (size, unit)
+
+
+class Record(object):
+    '''
+    The compact listing record, it keeps the source JSON line (or the dict decoded by Engine API client)
+    and decodes the fields on access. The record supports read-only dict access: record[u'id'],
+    record.get(u'names'), dict(record); the assigned values override decoded ones.
+    '''
+    __slots__ = ('_source', '_data', '_values')
+
+    # the record key -> the function which gets the value from the source dict
+    FIELDS = {}
+
+    def __init__(self, source):
+        '''
+        :param source: JSON text or dict
+        '''
+        self._source = source
+        self._data = None
+        self._values = None
+
+    def _decoded(self):
+        if self._data is None:
+            self._data = json.loads(self._source) if isinstance(self._source, string_types) else self._source
+            self._source = None
+        return self._data
+
+    def __getitem__(self, key):
+        if self._values and key in self._values:
+            return self._values[key]
+        return self.FIELDS[key](self._decoded())
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if self._values is None:
+            self._values = dict()
+        self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.FIELDS else default
+
+    def keys(self):
+        return sorted(self.FIELDS)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if hasattr(other, 'items') else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, dict(self.items()))
+
+
+class ImageRecord(Record):
+    ''' the line of `docker images --format '{{json .}}'`
+    '''
+    __slots__ = ()
+    FIELDS = {
+        u'id': _key(u'ID'),
+        u'repository': _key(u'Repository'),
+        u'tag': _key(u'Tag'),
+        u'size': _key(u'Size', 0),
+        u'createdAt': _key(u'CreatedAt'),
+    }
+
+
+class ContainerRecord(Record):
+    ''' the line of `docker ps --format '{{json .}}'`
+    '''
+    __slots__ = ()
+    FIELDS = {
+        u'id': _key(u'ID'),
+        u'names': _key(u'Names'),
+        u'image': _key(u'Image'),
+        u'labels': _key(u'Labels', []),
+        u'command': _key(u'Command'),
+        u'createdAt': _key(u'CreatedAt'),
+        u'localVolumes': _key(u'LocalVolumes'),
+        u'mounts': _key(u'Mounts'),
+        u'networks': _key(u'Networks'),
+        u'ports': _key(u'Ports', []),
+        u'status': _key(u'Status'),
+        u'runningFor': _key(u'RunningFor'),
+        u'size': _key(u'Size', 0),
+    }
+
+
+class APIImageRecord(Record):
+    ''' the item of GET /images/json, the source is the tuple (image, repo:tag)
+    '''
+    __slots__ = ()
+    FIELDS = {
+        u'id': lambda src: src[0].get(u'Id', u'').split(u':')[-1][:12],
+        u'repository': lambda src: src[1].rpartition(u':')[0],
+        u'tag': lambda src: src[1].rpartition(u':')[2],
+        u'size': lambda src: _human_size(src[0].get(u'Size', 0)),
+        u'createdAt': lambda src: _api_time(src[0]),
+    }
+
+
+class APIContainerRecord(Record):
+    ''' the item of GET /containers/json
+    '''
+    __slots__ = ()
+    FIELDS = {
+        u'id': lambda data: data.get(u'Id', u'')[:12],
+        u'names': lambda data: u','.join(n.lstrip(u'/') for n in data.get(u'Names') or []),
+        u'image': _key(u'Image'),
+        u'labels': lambda data: u','.join(u'%s=%s' % kv for kv in sorted((data.get(u'Labels') or {}).items())),
+        u'command': _key(u'Command'),
+        u'createdAt': _api_time,
+        u'localVolumes': lambda data: u'',
+        u'mounts': lambda data: u','.join(m.get(u'Name') or m.get(u'Source', u'') for m in data.get(u'Mounts') or []),
+        u'networks': lambda data: u','.join(sorted((data.get(u'NetworkSettings') or {}).get(u'Networks') or {})),
+        u'ports': lambda data: u'',
+        u'status': _key(u'Status'),
+        u'runningFor': lambda data: u'',
+        u'size': lambda data: 0,
+    }
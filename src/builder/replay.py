@@ -0,0 +1,595 @@
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import sys
+import json
+import gzip
+import time
+import uuid
+import fcntl
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+import collections
+
+from six.moves.urllib.parse import urlparse
+
+from builder import LATENCY_REAL, LATENCY_ZERO, LATENCIES
+from builder.log import Logger
+from builder.docker import set_command_runner
+from builder.dockerapi import set_connection_interceptor, close_pools
+
+logger = Logger(__name__)
+
+# the environment of `docker` record shim
+RECORD_ENV = 'BUILDER_RECORD_DIR'
+DOCKER_ENV = 'BUILDER_DOCKER_EXECUTABLE'
+
+# the trace directory: the interactions, one JSON line per docker command or API request,
+# and their outputs, one gzipped file per output
+INTERACTIONS_FILE = 'interactions.jsonl'
+OUTPUTS_DIR = 'outputs'
+
+# the interactions of docker command line client and Docker Engine API
+BACKEND_CLI = u'cli'
+BACKEND_API = u'api'
+
+# the exit code of the docker command and the status of the API request which were not recorded
+NOT_RECORDED_EXIT_CODE = 125
+NOT_RECORDED_STATUS = 500
+
+CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+
+# `docker` on PATH while recording: the builder package is imported from the same location as the running one
+RECORD_SCRIPT = '''#!/bin/sh
+PYTHONPATH="%(path)s${PYTHONPATH:+:$PYTHONPATH}" exec "%(python)s" -c 'from builder.replay import main; main()' "$@"
+'''
+
+# the replayed docker command, the interaction is selected by the builder and passed by the options:
+#   -i - read stdin, -f - run until terminated, like `docker events`, -d - the delay, seconds,
+#   -o/-e - the gzipped stdout/stderr, -m - the error message, -c - the exit code
+REPLAY_SCRIPT = '''#!/bin/sh
+code=0
+while getopts ifd:o:e:m:c: option; do
+    case $option in
+        i) stdin=1 ;;
+        f) follow=1 ;;
+        d) delay=$OPTARG ;;
+        o) stdout=$OPTARG ;;
+        e) stderr=$OPTARG ;;
+        m) message=$OPTARG ;;
+        c) code=$OPTARG ;;
+    esac
+done
+[ -n "$stdin" ] && cat >/dev/null
+[ -n "$delay" ] && sleep "$delay"
+[ -n "$stdout" ] && gzip -dc "$stdout"
+[ -n "$stderr" ] && gzip -dc "$stderr" >&2
+[ -n "$message" ] && printf '%s\\n' "$message" >&2
+if [ -n "$follow" ]; then
+    trap 'exit $code' TERM INT
+    while :; do
+        sleep 1 </dev/null >/dev/null 2>&1 &
+        wait $!
+    done
+fi
+exit $code
+'''
+
+
+def _which(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def _write_script(directory, text):
+    script = os.path.join(directory, 'docker')
+    with open(script, 'w') as shim:
+        shim.write(text)
+    os.chmod(script, 0o755)
+    return script
+
+
+def read_trace(path):
+    '''
+    :param path: the trace directory
+    :return: the iterator of recorded interactions, the dicts:
+        cli - backend, args, stdout, stderr, exit_code, duration, killed
+        api - backend, method, url, status, headers, will_close, body, duration, killed
+        the outputs are the names of gzipped files in the trace directory, None if the output is empty
+    '''
+    with open(os.path.join(path, INTERACTIONS_FILE), 'rb') as interactions:
+        for line in interactions:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+
+def write_interaction(path, interaction):
+    '''
+    Append the interaction to the trace, the file is locked as the commands run concurrently
+
+    :param path: the trace directory
+    '''
+    data = (json.dumps(interaction) + '\n').encode('utf-8')
+    with open(os.path.join(path, INTERACTIONS_FILE), 'ab') as interactions:
+        fcntl.flock(interactions, fcntl.LOCK_EX)
+        try:
+            interactions.write(data)
+        finally:
+            fcntl.flock(interactions, fcntl.LOCK_UN)
+
+
+def _reset_trace(path):
+    '''
+    Remove the interactions and the outputs recorded before
+    '''
+    if os.path.exists(os.path.join(path, INTERACTIONS_FILE)):
+        os.remove(os.path.join(path, INTERACTIONS_FILE))
+    shutil.rmtree(os.path.join(path, OUTPUTS_DIR), ignore_errors=True)
+    os.makedirs(os.path.join(path, OUTPUTS_DIR))
+
+
+class _Output(object):
+    '''
+    The output of the interaction written to the gzipped file while it's passed through,
+    the file is created by the first chunk
+    '''
+    def __init__(self, path, kind):
+        self._path = path
+        self._kind = kind
+        self._file = None
+        self.name = None
+
+    def write(self, chunk):
+        if self._file is None:
+            self.name = u'%s/%s.%s.gz' % (OUTPUTS_DIR, uuid.uuid4().hex, self._kind)
+            self._file = gzip.open(os.path.join(self._path, self.name), 'wb', GZIP_LEVEL)
+        self._file.write(chunk)
+
+    def close(self):
+        '''
+        :return: the name of the output file, None if the output is empty
+        '''
+        if self._file is not None:
+            self._file.close()
+        return self.name
+
+
+class _Shim(object):
+    '''
+    The directory with `docker` shim which is put first on PATH, the environment is restored on close
+    '''
+    def __init__(self, environ):
+        self.dir = tempfile.mkdtemp(prefix='builder-record-')
+        package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        _write_script(self.dir, RECORD_SCRIPT % {'path': package_path, 'python': sys.executable})
+        environ = dict(environ, PATH='%s%s%s' % (self.dir, os.pathsep, os.environ.get('PATH', '')))
+        self._saved = dict((k, os.environ.get(k)) for k in environ)
+        os.environ.update(environ)
+
+    def close(self):
+        for key, value in self._saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class _RecordingSocket(object):
+    '''
+    The socket of the recorded connection, the stream shut down by the builder, like the events,
+    is replayed until it's closed
+    '''
+    def __init__(self, sock, conn):
+        self._raw = sock
+        self._conn = conn
+
+    def shutdown(self, how):
+        self._conn.stream_closed = True
+        self._raw.shutdown(how)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class _RecordingConnection(object):
+    '''
+    The connection to docker host which records the requests and their responses
+    '''
+    def __init__(self, conn, path):
+        self._conn = conn
+        self._path = path
+        self._request = None
+        self.stream_closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @property
+    def sock(self):
+        sock = self._conn.sock
+        if sock is None:
+            return None
+        return _RecordingSocket(getattr(sock, '_sock', sock), self)
+
+    def request(self, method, url, *args, **kwargs):
+        self._request = (method, url, time.time())
+        return self._conn.request(method, url, *args, **kwargs)
+
+    def putrequest(self, method, url, *args, **kwargs):
+        self._request = (method, url, time.time())
+        return self._conn.putrequest(method, url, *args, **kwargs)
+
+    def getresponse(self):
+        method, url, started = self._request
+        return _RecordingResponse(self._conn.getresponse(), self, self._path, {
+            u'backend': BACKEND_API,
+            u'method': method,
+            u'url': url,
+        }, started)
+
+
+class _RecordingResponse(object):
+    '''
+    The response which writes the body to the trace while it's read, the interaction is recorded
+    when the body is read until the end or the response is closed
+    '''
+    def __init__(self, response, conn, path, interaction, started):
+        self._response = response
+        self._conn = conn
+        self._path = path
+        self._interaction = interaction
+        self._started = started
+        self._body = _Output(path, u'body')
+        self._recorded = False
+        if hasattr(response, 'readline'):
+            # python 2 HTTPResponse has no readline(), see dockerapi.iter_lines()
+            self.readline = self._readline
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _passed(self, data, finished):
+        if data:
+            self._body.write(data)
+        if finished or not data:
+            self._record()
+        return data
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._passed(self._response.read(), True)
+        return self._passed(self._response.read(amt), False)
+
+    def _readline(self, limit=-1):
+        return self._passed(self._response.readline(limit), False)
+
+    def close(self):
+        self._record()
+        self._response.close()
+
+    def _record(self):
+        if self._recorded:
+            return
+        self._recorded = True
+        self._interaction.update({
+            u'status': self._response.status,
+            u'headers': self._response.getheaders(),
+            u'will_close': bool(self._response.will_close),
+            u'body': self._body.close(),
+            u'duration': round(time.time() - self._started, 6),
+            u'killed': self._conn.stream_closed,
+        })
+        write_interaction(self._path, self._interaction)
+
+
+def start_recording(path):
+    '''
+    Record every docker command and Docker Engine API request of the builder: the arguments or the request,
+    the outputs, the exit code or the response status and headers, the wall time
+
+    :param path: the trace directory, the interactions recorded before are removed
+    :return: the function which stops recording
+    '''
+    path = os.path.abspath(path)
+    _reset_trace(path)
+    shim = None
+    docker = _which('docker')
+    if docker:
+        shim = _Shim({RECORD_ENV: path, DOCKER_ENV: docker})
+    else:
+        logger.warning(msg=u'Cannot find docker executable, only Docker Engine API requests are recorded')
+    # the idle connections opened before are not recorded
+    close_pools()
+    previous = set_connection_interceptor(lambda factory: _RecordingConnection(factory(), path))
+    logger.info(**{u'msg': u'Recording docker commands', u'trace.dir': path})
+
+    def stop():
+        set_connection_interceptor(previous)
+        close_pools()
+        if shim:
+            shim.close()
+
+    return stop
+
+
+class _ReplaySocket(object):
+    '''
+    The socket of the replayed connection, it's only closed
+    '''
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def shutdown(self, how):
+        self.closed.set()
+
+    def close(self):
+        self.closed.set()
+
+
+class _ReplayResponse(object):
+    '''
+    The recorded response, the body of the stream closed by the builder is followed by the wait for close
+    '''
+    def __init__(self, status, headers, will_close, body, closed=None):
+        self.status = status
+        self.will_close = will_close
+        self._headers = dict((k.lower(), v) for k, v in headers)
+        self._body = body
+        self._closed = closed
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return list(self._headers.items())
+
+    def _followed(self, data):
+        if not data and self._closed is not None:
+            self._closed.wait()
+        return data
+
+    def read(self, amt=None):
+        return self._followed(self._body.read() if amt is None else self._body.read(amt))
+
+    def readline(self, limit=-1):
+        return self._followed(self._body.readline(limit))
+
+    def close(self):
+        self._body.close()
+
+
+class _ReplayConnection(object):
+    '''
+    The connection which replies to the requests by the recorded responses, the request body is dropped
+    '''
+    def __init__(self, replay):
+        self._replay = replay
+        self._request = None
+        self.sock = _ReplaySocket()
+
+    def connect(self):
+        pass
+
+    def request(self, method, url, *args, **kwargs):
+        self._request = (method, url)
+
+    def putrequest(self, method, url, *args, **kwargs):
+        self._request = (method, url)
+
+    def putheader(self, header, *values):
+        pass
+
+    def endheaders(self, *args, **kwargs):
+        pass
+
+    def send(self, data):
+        pass
+
+    def getresponse(self):
+        return self._replay.response(self._request[0], self._request[1], self.sock.closed)
+
+    def close(self):
+        self.sock.close()
+
+
+def _command_keys(args):
+    '''
+    :return: the keys of docker command: the arguments, the docker command like exec or commit
+    '''
+    return [(u'args',) + tuple(args), (u'command', args[0] if args else u'')]
+
+
+def _request_keys(method, url):
+    '''
+    :return: the keys of API request: the method and URL, the method and the endpoint, the path
+        without the object id like /containers/*/start
+    '''
+    parts = urlparse(url).path.split(u'/')
+    if len(parts) > 3:
+        parts[2] = u'*'
+    return [(u'request', method, url), (u'endpoint', method, u'/'.join(parts))]
+
+
+class _Replay(object):
+    '''
+    The recorded interactions replayed by the builder process: the interaction is matched by the arguments
+    or the request, or taken in the recorded order of the same docker command or API endpoint. The docker
+    command is replied by the shell script run instead of docker, the API request - by the connection which
+    reads the recorded response
+    '''
+    def __init__(self, path, latency):
+        self.path = path
+        self.latency = latency
+        self._interactions = list(read_trace(path))
+        self._queues = dict()
+        self._consumed = set()
+        self._lock = threading.Lock()
+        for pos, interaction in enumerate(self._interactions):
+            if interaction.get(u'backend') == BACKEND_API:
+                keys = _request_keys(interaction[u'method'], interaction[u'url'])
+            else:
+                keys = _command_keys(interaction[u'args'])
+            for key in keys:
+                self._queues.setdefault(key, collections.deque()).append(pos)
+        self.dir = tempfile.mkdtemp(prefix='builder-replay-')
+        self.script = _write_script(self.dir, REPLAY_SCRIPT)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _take(self, keys):
+        '''
+        :return: the first not replayed interaction of the keys, None
+        '''
+        with self._lock:
+            for key in keys:
+                queue = self._queues.get(key)
+                while queue and queue[0] in self._consumed:
+                    queue.popleft()
+                if queue:
+                    pos = queue.popleft()
+                    self._consumed.add(pos)
+                    return self._interactions[pos]
+        return None
+
+    def command_line(self, args):
+        '''
+        :param args: docker command line arguments
+        :return: the command line of the replay script, see set_command_runner()
+        '''
+        interaction = self._take(_command_keys(args))
+        command_line = [self.script]
+        if interaction is None:
+            command_line.extend(['-m', u'No recorded interaction for docker %s' % u' '.join(args),
+                                 '-c', str(NOT_RECORDED_EXIT_CODE)])
+            return command_line + ['--'] + list(args)
+        if '-' in args:
+            command_line.append('-i')
+        if interaction.get(u'killed'):
+            command_line.append('-f')
+        elif self.latency == LATENCY_REAL:
+            command_line.extend(['-d', '%.6f' % interaction[u'duration']])
+        for option, output in (('-o', u'stdout'), ('-e', u'stderr')):
+            if interaction.get(output):
+                command_line.extend([option, os.path.join(self.path, interaction[output])])
+        command_line.extend(['-c', str(interaction[u'exit_code'])])
+        return command_line + ['--'] + list(args)
+
+    def connection(self, factory):
+        '''
+        :return: the replayed connection, see set_connection_interceptor()
+        '''
+        return _ReplayConnection(self)
+
+    def response(self, method, url, closed):
+        '''
+        :param closed: the event of closed connection, the stream closed by the builder is waiting for it
+        :return: the recorded response to the request
+        '''
+        interaction = self._take(_request_keys(method, url))
+        if interaction is None:
+            message = u'No recorded interaction for %s %s' % (method, url)
+            return _ReplayResponse(NOT_RECORDED_STATUS, [], True,
+                                   io.BytesIO(json.dumps({u'message': message}).encode('utf-8')))
+        if self.latency == LATENCY_REAL and not interaction.get(u'killed'):
+            time.sleep(interaction[u'duration'])
+        body = io.BytesIO()
+        if interaction.get(u'body'):
+            body = gzip.open(os.path.join(self.path, interaction[u'body']), 'rb')
+        return _ReplayResponse(interaction[u'status'], interaction[u'headers'], interaction[u'will_close'], body,
+                               closed=closed if interaction.get(u'killed') else None)
+
+
+def start_replay(path, latency=LATENCY_ZERO):
+    '''
+    Replay the recorded docker commands and Docker Engine API requests instead of running them
+
+    :param path: the trace directory, see start_recording()
+    :param latency: LATENCY_REAL - keep the recorded wall time, LATENCY_ZERO - reply at once
+    :return: the function which stops replaying
+    '''
+    if latency not in LATENCIES:
+        raise ValueError('Unknown replay latency, %s' % latency)
+    replay = _Replay(os.path.abspath(path), latency)
+    # the idle connections opened before are not replayed
+    close_pools()
+    previous_runner = set_command_runner(replay.command_line)
+    previous_interceptor = set_connection_interceptor(replay.connection)
+    logger.info(**{u'msg': u'Replaying docker commands', u'trace.dir': path, u'replay.latency': latency})
+
+    def stop():
+        set_command_runner(previous_runner)
+        set_connection_interceptor(previous_interceptor)
+        close_pools()
+        replay.close()
+
+    return stop
+
+
+def _stdout():
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+def _stderr():
+    return getattr(sys.stderr, 'buffer', sys.stderr)
+
+
+def record(args):
+    '''
+    Run the docker command, pass its output through and record the interaction,
+    the outputs are written to the trace while they are passed
+
+    :return: exit code
+    '''
+    path = os.environ[RECORD_ENV]
+    started = time.time()
+    proc = subprocess.Popen([os.environ[DOCKER_ENV]] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    killed = []
+
+    def terminate(signum, frame):
+        killed.append(signum)
+        proc.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    stdout, stderr = _Output(path, u'stdout'), _Output(path, u'stderr')
+
+    def forward(source, target, output):
+        for chunk in iter(lambda: os.read(source.fileno(), CHUNK_SIZE), b''):
+            target.write(chunk)
+            target.flush()
+            output.write(chunk)
+
+    threads = [threading.Thread(target=forward, args=(proc.stdout, _stdout(), stdout)),
+               threading.Thread(target=forward, args=(proc.stderr, _stderr(), stderr))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    exit_code = proc.wait()
+    write_interaction(path, {
+        u'backend': BACKEND_CLI,
+        u'args': list(args),
+        u'stdout': stdout.close(),
+        u'stderr': stderr.close(),
+        u'exit_code': exit_code,
+        u'duration': round(time.time() - started, 6),
+        u'killed': bool(killed),
+    })
+    return exit_code
+
+
+def main():
+    '''
+    The entry point of `docker` record shim
+    '''
+    sys.exit(record([a.decode('utf-8') if isinstance(a, bytes) else a for a in sys.argv[1:]]))
@@ -0,0 +1,198 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import threading
+
+from six.moves import queue
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+BUILD_SKIPPED = u'skipped'
+
+# the duration of the target without history, when no target has history
+DEFAULT_DURATION = 60.0
+
+
+class BuildGraph(object):
+    '''
+    The dependencies of the manifest targets: the target depends on the other target
+    if its source image is the target image of the other one
+
+    Usage:
+
+        graph = BuildGraph(targets)
+        graph.parent(u'ownport/app:1.0')      # u'ownport/python:alpine-3.5'
+        graph.order()                         # topologically sorted target names
+    '''
+    def __init__(self, targets):
+        '''
+        :param targets: the list of targets, see load_manifest()
+        '''
+        self.targets = dict()
+        for target in targets:
+            name = target[u'target_image_name']
+            if name in self.targets:
+                raise ValueError('The target is defined twice, %s' % name)
+            self.targets[name] = target
+
+        self.children = dict((name, []) for name in self.targets)
+        for name, target in self.targets.items():
+            parent = self.parent(name)
+            if parent:
+                self.children[parent].append(name)
+        self.order()
+
+    def parent(self, name):
+        '''
+        :return: the name of the parent target or None
+        '''
+        source = self.targets[name][u'source_image_name']
+        return source if source in self.targets and source != name else None
+
+    def order(self):
+        '''
+        :return: target names, every parent comes before its children
+        '''
+        result = [name for name in sorted(self.targets) if not self.parent(name)]
+        for name in result:
+            result.extend(sorted(self.children[name]))
+        if len(result) != len(self.targets):
+            raise ValueError('The targets have circular dependencies, %s' %
+                             ', '.join(sorted(set(self.targets) - set(result))))
+        return result
+
+    def descendants(self, name):
+        result = []
+        for child in self.children[name]:
+            result.append(child)
+            result.extend(self.descendants(child))
+        return result
+
+    def critical_paths(self, durations):
+        '''
+        The critical path of the target is the longest chain of builds starting from the target
+
+        :param durations: the dict of expected build durations by target name
+        :return: the dict of critical path durations by target name
+        '''
+        known = [durations[name] for name in self.targets if name in durations]
+        default = sum(known) / len(known) if known else DEFAULT_DURATION
+        result = dict()
+        for name in reversed(self.order()):
+            result[name] = durations.get(name, default) + max([result[c] for c in self.children[name]] or [0.0])
+        return result
+
+
+class BuildHistory(object):
+    '''
+    The durations of the targets from the previous runs, stored in JSON file
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.durations = dict()
+        if filename and os.path.isfile(filename):
+            try:
+                with open(filename) as source:
+                    self.durations = json.load(source)
+            except ValueError as err:
+                logger.warning(msg=u'Cannot load build history, %s' % err, filename=filename)
+
+    def update(self, results):
+        '''
+        :param results: the list of build results, the durations of failed builds are not recorded
+        '''
+        for result in results:
+            if result[u'status'] == u'ok':
+                self.durations[result[u'target']] = result[u'duration']
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename, 'w') as target:
+            json.dump(self.durations, target, indent=2, sort_keys=True)
+
+
+class Scheduler(object):
+    '''
+    Build the targets on the bounded number of workers. The target is started as soon as its parent
+    was built, the ready targets with the longest critical path are started first. The descendants
+    of failed target are skipped.
+
+    Usage:
+
+        results = Scheduler(targets, build_target, jobs=4, durations=history.durations).run()
+    '''
+    def __init__(self, targets, build, jobs=1, durations=None):
+        '''
+        :param targets: the list of targets, see load_manifest()
+        :param build: the function which builds the target and returns the build result
+        :param jobs: the number of concurrent builds
+        :param durations: the dict of expected build durations by target name
+        '''
+        self._graph = BuildGraph(targets)
+        self._build = build
+        self._jobs = max(1, jobs)
+        self._priority = self._graph.critical_paths(durations or {})
+        self._ready = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._results = dict()
+
+    def _put(self, name):
+        # the longest critical path first, the name makes the order stable
+        self._ready.put((-self._priority[name], name))
+
+    def _done(self, name, result):
+        with self._lock:
+            self._results[name] = result
+            if result[u'status'] == u'ok':
+                for child in self._graph.children[name]:
+                    self._put(child)
+            else:
+                for descendant in self._graph.descendants(name):
+                    logger.warning(**{u'msg': u'Skipping the target, the parent target failed',
+                                      u'target': descendant, u'parent': name})
+                    self._results[descendant] = {
+                        u'target': descendant,
+                        u'source': self._graph.targets[descendant][u'source_image_name'],
+                        u'status': BUILD_SKIPPED, u'image.id': None, u'duration': 0.0,
+                        u'error': u'The parent target failed, %s' % name}
+            if len(self._results) == len(self._graph.targets):
+                for _ in range(self._jobs):
+                    self._ready.put((float('inf'), None))
+
+    def _worker(self):
+        while True:
+            _, name = self._ready.get()
+            if name is None:
+                return
+            try:
+                result = self._build(self._graph.targets[name])
+            except Exception as err:
+                logger.error(**{u'msg': u'The build failed', u'target': name, u'error.msg': u'%s' % err})
+                result = {u'target': name, u'source': self._graph.targets[name][u'source_image_name'],
+                          u'status': u'failed', u'image.id': None, u'duration': 0.0, u'error': u'%s' % err}
+            self._done(name, result)
+
+    def run(self):
+        '''
+        :return: the list of build results in topological order
+        '''
+        order = self._graph.order()
+        if not order:
+            return []
+        for name in order:
+            if not self._graph.parent(name):
+                self._put(name)
+        logger.info(**{u'msg': u'Scheduling targets', u'targets': order, u'jobs': self._jobs,
+                       u'critical.paths': self._priority})
+
+        workers = [threading.Thread(target=self._worker) for _ in range(min(self._jobs, len(order)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return [self._results[name] for name in order]
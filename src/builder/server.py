@@ -0,0 +1,515 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import json
+import errno
+import select
+import signal
+import shutil
+import socket
+import argparse
+import tempfile
+import multiprocessing
+import threading
+import traceback
+
+from six.moves import reload_module
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+# the unix socket of the server: $BUILDER_SERVER or the socket of the user in the temporary directory
+SERVER_ENV = 'BUILDER_SERVER'
+METRICS_DIR_ENV = 'BUILDER_METRICS_DIR'
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'docker-image-builder-%d.sock' % os.getuid())
+
+# the commands which are sent to the server by the client, other commands run locally
+SERVED_COMMANDS = ('run', 'build', 'build-all', 'pool', 'halt')
+
+# the exit code of the client if the server dropped the connection
+CONNECTION_LOST_EXIT_CODE = 255
+
+CHUNK_SIZE = 64 * 1024
+
+# the interval of checking the workers, seconds
+REAP_INTERVAL = 0.2
+
+# the timeout of metrics requests, seconds
+METRICS_TIMEOUT = 5
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def _flush():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def strip_option(argv, option):
+    '''
+    :return: the command line arguments without the option and its value
+    '''
+    result, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            result.append(arg)
+    return result
+
+
+class BuildModules(object):
+    '''
+    The build modules imported by the server, the builds get them already imported. The module is reloaded
+    when its file changes
+    '''
+    def __init__(self):
+        self._mtimes = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _source(module):
+        path = getattr(module, '__file__', None) or ''
+        return path[:-1] if path.endswith(('.pyc', '.pyo')) else path
+
+    def load(self, name):
+        '''
+        Import the module or reload it if the file was changed since the last import
+
+        :param name: the module name
+        :return: the module, None if the module cannot be imported
+        '''
+        with self._lock:
+            try:
+                module = sys.modules.get(name)
+                if module is None:
+                    module = __import__(name, globals(), locals(), ['BuildModule'])
+                    logger.info(**{u'msg': u'Build module was imported', u'module': name})
+                elif os.path.getmtime(self._source(module)) != self._mtimes.get(name):
+                    module = reload_module(module)
+                    logger.info(**{u'msg': u'Build module was reloaded', u'module': name})
+                self._mtimes[name] = os.path.getmtime(self._source(module))
+                return module
+            except Exception as err:
+                # the build reports the error
+                logger.warning(**{u'msg': u'Cannot import build module, %s' % err, u'module': name})
+                return None
+
+
+def run_cli(argv):
+    '''
+    Run the command of the builder, the handler of server requests
+
+    :param argv: the command line arguments
+    :return: exit code
+    '''
+    from builder.cli import CLI
+
+    sys.argv = [sys.argv[0]] + list(argv)
+    try:
+        CLI(served=True)
+    except SystemExit as err:
+        if err.code is None or isinstance(err.code, int):
+            return err.code or 0
+        print(err.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+class BuilderServer(object):
+    '''
+    The resident builder server: the pool of worker processes accepts the requests on the unix socket.
+    The workers are forked by the server before any thread is started, so the worker does not inherit the locks
+    held by other threads. The worker is long-lived: the imports, docker connections, the inventory, the parsed
+    variables files and the build modules are kept in memory between the requests. The worker runs one request
+    at a time with the working directory, the environment and the logging of the client, they are restored
+    after the request. The worker which died is replaced by the new one.
+
+    The protocol is JSON lines over the unix socket, the request:
+
+        {"argv": ["build", "-s", ...], "cwd": "/path", "env": {...}}
+
+    the replies: {"stdout": "..."}, {"stderr": "..."} and the last one {"exit_code": 0}
+
+    The metrics of the served requests (see builder.metrics) are added to the textfile in the metrics directory
+    after every request, they are served by `GET /metrics` on the unix socket and on the metrics port
+
+    Usage:
+
+        BuilderServer('/tmp/builder.sock').serve_forever()
+    '''
+    def __init__(self, path=DEFAULT_SOCKET, jobs=None, handler=run_cli, initializer=None,
+                 metrics_dir=None, metrics_port=None):
+        '''
+        :param path: the unix socket path
+        :param jobs: the number of workers, the concurrent requests, default: the number of CPUs
+        :param handler: the function which runs the request in the worker: argv -> exit code
+        :param initializer: the function called in the new worker with the worker number, to warm it up
+        :param metrics_dir: the directory of the metrics textfile, like the one of node_exporter textfile
+            collector, default: the temporary directory removed when the server is stopped
+        :param metrics_port: serve the metrics on the local TCP port too, for Prometheus
+        '''
+        self.path = path
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.modules = BuildModules()
+        self.metrics_dir = metrics_dir
+        self.metrics_port = metrics_port
+        self._handler = handler
+        self._initializer = initializer
+        self._temporary_metrics_dir = None
+        self._socket = None
+        self._metrics_socket = None
+        self._stopped = threading.Event()
+        # the worker pids and numbers, in the server
+        self._workers = dict()
+        # the state of the worker process
+        self._busy = False
+        self._stopping = False
+
+    def bind(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise RuntimeError('The builder server is already running, %s' % self.path)
+            except socket.error:
+                # the socket of the stopped server
+                os.remove(self.path)
+            finally:
+                probe.close()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        # the builds run with the permissions of the server
+        os.chmod(self.path, 0o600)
+        self._socket.listen(64)
+        if self.metrics_port is not None:
+            self._metrics_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._metrics_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._metrics_socket.bind(('127.0.0.1', self.metrics_port))
+            self._metrics_socket.listen(16)
+            self.metrics_port = self._metrics_socket.getsockname()[1]
+        if not self.metrics_dir:
+            self.metrics_dir = self._temporary_metrics_dir = tempfile.mkdtemp(prefix='docker-image-builder-metrics-')
+        # the workers wait for the connections on both sockets, the connection is accepted by one of them
+        for listener in self._listeners():
+            listener.setblocking(False)
+        logger.info(**{u'msg': u'Builder server is listening', u'server.socket': self.path,
+                       u'metrics.port': self.metrics_port, u'metrics.dir': self.metrics_dir})
+        return self
+
+    def _listeners(self):
+        return [listener for listener in (self._socket, self._metrics_socket) if listener]
+
+    def serve_forever(self):
+        if self._socket is None:
+            self.bind()
+        try:
+            for number in range(self.jobs):
+                self._spawn(number)
+            while not self._stopped.is_set():
+                self._reap()
+                self._stopped.wait(REAP_INTERVAL)
+        finally:
+            self.close()
+
+    def shutdown(self):
+        '''
+        Stop the server, the workers finish the running requests
+        '''
+        self._stopped.set()
+
+    def close(self):
+        self._stop_workers()
+        if self._metrics_socket:
+            self._metrics_socket.close()
+            self._metrics_socket = None
+        if self._temporary_metrics_dir:
+            shutil.rmtree(self._temporary_metrics_dir, ignore_errors=True)
+            self._temporary_metrics_dir = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            logger.info(**{u'msg': u'Builder server was stopped', u'server.socket': self.path})
+
+    def _spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(number)
+        self._workers[pid] = number
+        logger.info(**{u'msg': u'Worker was started', u'worker.pid': pid, u'worker.number': number})
+
+    def _reap(self):
+        '''
+        Replace the workers which died
+        '''
+        for pid, number in list(self._workers.items()):
+            try:
+                _pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                _pid, status = pid, 0
+            if not _pid:
+                continue
+            del self._workers[pid]
+            logger.warning(**{u'msg': u'Worker exited', u'worker.pid': pid, u'exit.code': _exit_code(status)})
+            if not self._stopped.is_set():
+                self._spawn(number)
+
+    def _stop_workers(self):
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in list(self._workers):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            del self._workers[pid]
+
+    def _stop_worker(self, signum, frame):
+        # SIGTERM: the idle worker exits at once, the busy one after the request
+        self._stopping = True
+        if not self._busy:
+            os._exit(0)
+
+    def _run_worker(self, number):
+        # the worker process, it never returns
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, self._stop_worker)
+            self._workers = dict()
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+            # the requests are traced by the worker, see _run()
+            from builder import trace
+            trace.disable()
+            if self._initializer:
+                try:
+                    self._initializer(number)
+                except Exception as err:
+                    # the worker is not warm, the requests are served anyway
+                    logger.warning(**{u'msg': u'Cannot warm up the worker, %s' % err, u'worker.number': number})
+            while not self._stopping:
+                try:
+                    ready, _, _ = select.select(self._listeners(), [], [])
+                    # the connection may be accepted by another worker
+                    conn, _ = ready[0].accept()
+                except (select.error, socket.error) as err:
+                    if err.args and err.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    raise
+                conn.setblocking(True)
+                self._busy = True
+                try:
+                    self._handle(conn, metrics_only=ready[0] is self._metrics_socket)
+                finally:
+                    self._busy = False
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            _flush()
+            os._exit(code)
+
+    def prepare(self, request):
+        '''
+        Warm the worker for the request: import or reload the build module and parse the variables files,
+        the build gets them ready
+        '''
+        argv, cwd = request.get(u'argv') or [], request.get(u'cwd') or os.getcwd()
+        if not argv or argv[0] != u'build':
+            return
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('-b', '--build-module', dest='build_module')
+        parser.add_argument('-p', '--build-modules-path', dest='build_modules_path', action='append')
+        parser.add_argument('--vars', dest='vars', action='append')
+        args, _ = parser.parse_known_args(argv[1:])
+
+        from builder.build import add_build_modules_path, load_vars
+
+        add_build_modules_path([os.path.join(cwd, p) for p in args.build_modules_path or []])
+        if args.build_module:
+            self.modules.load(args.build_module)
+        try:
+            load_vars([os.path.join(cwd, v) for v in args.vars or [] if os.path.isfile(os.path.join(cwd, v))])
+        except (IOError, ValueError) as err:
+            logger.warning(**{u'msg': u'Cannot load variables files, %s' % err, u'vars': args.vars})
+
+    def _handle(self, conn, metrics_only=False):
+        from builder.metrics import Registry
+
+        try:
+            if metrics_only:
+                # the port is open to the local users, only the metrics are served on it
+                conn.settimeout(METRICS_TIMEOUT)
+            stream = conn.makefile('rb')
+            line = stream.readline()
+            if metrics_only or line.startswith(b'GET '):
+                self._serve_metrics(conn, stream, line)
+                return
+            request = json.loads(line.decode('utf-8'))
+            logger.info(**{u'msg': u'Request was received', u'request.argv': request.get(u'argv'),
+                           u'request.cwd': request.get(u'cwd')})
+            self.prepare(request)
+            registry = Registry()
+            code = self._run(request, conn, registry)
+            # the metrics are written before the reply, the client which got the exit code sees them
+            self._write_metrics(registry)
+            _send(conn, {u'exit_code': code})
+            logger.info(**{u'msg': u'Request was completed', u'request.argv': request.get(u'argv'),
+                           u'exit.code': code})
+        except (socket.error, IOError, OSError, ValueError) as err:
+            logger.error(msg=u'Request failed, %s' % err)
+        finally:
+            conn.close()
+
+    def _write_metrics(self, registry):
+        try:
+            registry.write_textfile(self.metrics_dir)
+        except (IOError, OSError) as err:
+            logger.warning(**{u'msg': u'Cannot write metrics, %s' % err, u'metrics.dir': self.metrics_dir})
+
+    def _serve_metrics(self, conn, stream, request_line):
+        '''
+        Reply to HTTP request: GET /metrics - the metrics of the served requests in Prometheus text format
+        '''
+        from builder.metrics import Registry, read_textfile
+
+        conn.settimeout(METRICS_TIMEOUT)
+        # the headers are not used
+        while stream.readline().strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) > 1 and parts[0] == u'GET' and parts[1].split(u'?')[0] == u'/metrics':
+            status, content_type = '200 OK', METRICS_CONTENT_TYPE
+            # the metric types are known before the first request
+            body = (read_textfile(self.metrics_dir) or Registry().render()).encode('utf-8')
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b'Not Found\n'
+        headers = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (
+            status, content_type, len(body))
+        conn.sendall(headers.encode('ascii') + body)
+
+    def _run(self, request, conn, registry):
+        '''
+        Run the request with the output, the working directory, the environment and the logging of the client
+
+        :param registry: the metrics of the request, see builder.metrics
+        :return: exit code
+        '''
+        import logging
+
+        from builder import trace
+
+        cwd, environ = os.getcwd(), dict(os.environ)
+        handlers, level = logging.root.handlers[:], logging.root.level
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        relay = threading.Thread(target=self._relay, args=(conn, {out_r: u'stdout', err_r: u'stderr'}),
+                                 name=u'server-relay')
+        relay.daemon = True
+        relay.start()
+        saved = os.dup(1), os.dup(2)
+        code = 1
+        try:
+            _flush()
+            os.dup2(out_w, 1)
+            os.dup2(err_w, 2)
+            os.chdir(request.get(u'cwd') or u'/')
+            os.environ.clear()
+            os.environ.update(request.get(u'env') or {})
+            os.environ.pop(SERVER_ENV, None)
+            # the metrics of the request are collected by the server
+            os.environ.pop(METRICS_DIR_ENV, None)
+            trace.enable(record=False).listeners.append(registry.observe_span)
+            # the logging is configured by the request
+            logging.root.handlers = []
+            code = self._handler(strip_option(request.get(u'argv') or [], u'--metrics-dir'))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            trace.disable()
+            _flush()
+            # the relay gets EOF when the output of the request is closed
+            for fd, saved_fd in zip((1, 2), saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            os.close(out_w)
+            os.close(err_w)
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            logging.root.handlers = handlers
+            logging.root.setLevel(level)
+            relay.join()
+        return code if isinstance(code, int) else 1
+
+    @staticmethod
+    def _relay(conn, streams):
+        '''
+        Send the output of the request to the client. If the client is gone, the build is stopped:
+        the worker exits and it's replaced by the new one
+        '''
+        try:
+            while streams:
+                ready, _, _ = select.select(list(streams) + [conn], [], [])
+                if conn in ready and not conn.recv(CHUNK_SIZE):
+                    raise socket.error(errno.EPIPE, u'The client closed the connection')
+                for fd in ready:
+                    if fd is conn:
+                        continue
+                    data = os.read(fd, CHUNK_SIZE)
+                    if not data:
+                        os.close(fd)
+                        del streams[fd]
+                        continue
+                    _send(conn, {streams[fd]: data.decode('utf-8', 'replace')})
+        except (socket.error, IOError, OSError) as err:
+            logger.error(msg=u'Request was stopped, %s' % err)
+            os._exit(CONNECTION_LOST_EXIT_CODE)
+
+
+def send_request(path, argv):
+    '''
+    Send the command to the server and write its output to stdout and stderr
+
+    :param path: the unix socket of the server
+    :param argv: the command line arguments
+    :return: the exit code of the command
+    :raise socket.error: if the server is not available
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        _send(conn, {u'argv': list(argv), u'cwd': os.getcwd(), u'env': dict(os.environ)})
+        for line in conn.makefile('rb'):
+            reply = json.loads(line.decode('utf-8'))
+            if u'exit_code' in reply:
+                return reply[u'exit_code']
+            stream = sys.stdout if u'stdout' in reply else sys.stderr
+            stream.write(reply.get(u'stdout', reply.get(u'stderr')))
+            stream.flush()
+    finally:
+        conn.close()
+    print('The builder server closed the connection', file=sys.stderr)
+    return CONNECTION_LOST_EXIT_CODE
@@ -0,0 +1,177 @@
+from __future__ import (absolute_import, division, print_function)
+
+import sh
+import uuid
+import threading
+
+from six import python_2_unicode_compatible, text_type
+from six.moves import queue, shlex_quote
+
+from builder.docker import docker_command
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+
+@python_2_unicode_compatible
+class CommandOutput(object):
+    '''
+    The output of the command executed in the shell session, it has the same attributes as the result
+    of DockerCLI.execute(): stdout and stderr as bytes, exit code. The string value is the decoded stdout.
+    '''
+    def __init__(self, exit_code, stdout, stderr):
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __str__(self):
+        return self.stdout.decode('utf-8', 'replace')
+
+    def __eq__(self, other):
+        return text_type(self) == text_type(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(text_type(self))
+
+    def __len__(self):
+        return len(text_type(self))
+
+    def __repr__(self):
+        return '<CommandOutput exit_code=%r stdout=%r>' % (self.exit_code, self.stdout)
+
+
+class ShellSession(object):
+    '''
+    The long-lived `docker exec -i <container> /bin/sh` process, commands are written to its stdin
+    and every command is framed by the unique sentinel with exit code. Each command runs
+    in a subshell with stdin from /dev/null, so `cd`, variables and `exit` do not leak
+    to the next command. The shell is restarted automatically if it died.
+
+    Usage:
+
+        session = ShellSession('b1')
+        session.execute('mkdir', '-p', '/opt/app')  # stdout or [] in case of error
+        session.run('ls', '/opt')                   # (exit code, stdout, stderr)
+        session.close()
+    '''
+    def __init__(self, container_name, shell='/bin/sh'):
+        self._container_name = container_name
+        self._shell = shell
+        self._proc = None
+        self._stdin = None
+        self._output = None
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self):
+        return self._proc is not None and self._output is not None and self._proc.process.is_alive()[0]
+
+    def _start(self):
+        logger.info(**{u'msg': u'Starting shell session',
+                       u'container.name': self._container_name,
+                       u'shell': self._shell})
+        stdin = queue.Queue()
+        output = queue.Queue()
+        # latin-1 decoding is lossless, the output is decoded as utf-8 per command
+        self._proc = docker_command('exec', '-i', self._container_name, self._shell,
+                                    _in=stdin, _bg=True, _bg_exc=False, _tty_out=False, _no_out=True, _no_err=True,
+                                    _out=lambda line: output.put((u'stdout', line)),
+                                    _err=lambda line: output.put((u'stderr', line)),
+                                    _encoding='latin-1', _ok_code=list(range(256)))
+        self._stdin = stdin
+        self._output = output
+
+        def waiter(proc):
+            try:
+                proc.wait()
+            except sh.ErrorReturnCode:
+                pass
+            finally:
+                output.put(None)
+
+        thread = threading.Thread(target=waiter, args=(self._proc,))
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        ''' stop the shell
+        '''
+        with self._lock:
+            if self.alive:
+                self._stdin.put(None)
+                try:
+                    self._proc.wait()
+                except sh.ErrorReturnCode:
+                    pass
+            self._proc = self._stdin = self._output = None
+
+    def run(self, *args):
+        '''
+        Run command in the shell session. If the shell died before the command was sent, the shell
+        is restarted. The command is never sent twice: it may have run partially if the shell died
+        while it was running.
+
+        :param args: the list of command line arguments
+        :return: the tuple (exit code, stdout, stderr), exit code is None if the shell died
+        '''
+        exit_code, stdout, stderr = self._communicate(args)
+        return exit_code, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+    def _communicate(self, args):
+        with self._lock:
+            exit_code, chunks = self._run(args)
+        # drop the newline printed before the sentinel
+        stdout, stderr = [u''.join(chunks[name])[:-1].encode('latin-1') for name in (u'stdout', u'stderr')]
+        return exit_code, stdout, stderr
+
+    def _run(self, args):
+        if not self.alive:
+            if self._proc is not None:
+                logger.warning(**{u'msg': u'Restarting shell session',
+                                  u'container.name': self._container_name})
+            self._start()
+        sentinel = u'__builder_session_%s__' % uuid.uuid4().hex
+        command = u' '.join(shlex_quote(arg) for arg in args)
+        self._stdin.put((u"( %s\n) </dev/null; printf '\\n%s %%d\\n' $?; printf '\\n%s\\n' >&2\n"
+                         % (command, sentinel, sentinel)).encode('utf-8'))
+
+        chunks = {u'stdout': [], u'stderr': []}
+        exit_code, done = None, set()
+        while len(done) < 2:
+            item = self._output.get()
+            if item is None:
+                logger.warning(**{u'msg': u'Shell session died',
+                                  u'container.name': self._container_name,
+                                  u'command.args': args})
+                self._proc = self._stdin = self._output = None
+                break
+            name, line = item
+            if line.startswith(sentinel):
+                done.add(name)
+                if name == u'stdout':
+                    exit_code = int(line.split()[1])
+            else:
+                chunks[name].append(line)
+        return exit_code, chunks
+
+    def execute(self, *args):
+        '''
+        Execute command in the shell session, the result is compatible with DockerCLI.execute()
+
+        :param args: the list of command line arguments
+        :return: CommandOutput or [] in case of error
+        '''
+        logger.info(**{u'msg': u'Execute command in the shell session',
+                       u'container.name': self._container_name,
+                       u'command.args': args})
+        exit_code, stdout, stderr = self._communicate(args)
+        if exit_code != 0:
+            if stdout:
+                print(stdout.decode('utf-8', 'replace'))
+            if stderr:
+                print(stderr.decode('utf-8', 'replace'))
+            return []
+        return CommandOutput(exit_code, stdout, stderr)
@@ -0,0 +1,137 @@
+from __future__ import (absolute_import, division, print_function)
+
+import json
+import posixpath
+
+from builder.log import Logger
+from builder.archive import ChunkReader, filter_archive
+
+logger = Logger(__name__)
+
+# the whole filesystem of the container is imported as one layer image
+SQUASH_ALL = u'all'
+# the changes made by the build are committed as one layer on top of the source image
+SQUASH_BUILD = u'build'
+
+SQUASH_MODES = (SQUASH_ALL, SQUASH_BUILD)
+
+# the max number of paths removed by one command
+DELETE_BATCH_SIZE = 500
+
+
+def _env_change(env):
+    '''
+    :param env: the variable of the config, KEY=value
+    :return: ENV instruction, the value is quoted, `$` is escaped as ENV substitutes the variables
+    '''
+    key, _, value = env.partition(u'=')
+    return u'ENV %s=%s' % (key, json.dumps(value, ensure_ascii=False).replace(u'$', u'\\$'))
+
+
+def config_changes(container_config, image_config):
+    '''
+    The image config as Dockerfile instructions. The staging container runs the keepalive command,
+    so CMD and ENTRYPOINT are taken from the source image
+
+    :param container_config: the config of the staging container, the result of `inspect .Config`
+    :param image_config: the config of the source image
+    :return: the list of instructions
+    '''
+    container_config, image_config = container_config or {}, image_config or {}
+    changes = [_env_change(env) for env in container_config.get(u'Env') or []]
+    for key, instruction in ((u'WorkingDir', u'WORKDIR'), (u'User', u'USER')):
+        if container_config.get(key):
+            changes.append(u'%s %s' % (instruction, container_config[key]))
+    for port in sorted(container_config.get(u'ExposedPorts') or {}):
+        changes.append(u'EXPOSE %s' % port)
+    for volume in sorted(container_config.get(u'Volumes') or {}):
+        changes.append(u'VOLUME %s' % json.dumps([volume]))
+    for key, value in sorted((container_config.get(u'Labels') or {}).items()):
+        changes.append(u'LABEL %s=%s' % (json.dumps(key), json.dumps(value)))
+    if image_config.get(u'Entrypoint'):
+        changes.append(u'ENTRYPOINT %s' % json.dumps(image_config[u'Entrypoint']))
+    # the image without CMD does not inherit the keepalive command
+    changes.append(u'CMD %s' % json.dumps(image_config.get(u'Cmd') or []))
+    return changes
+
+
+def _changed_paths(changes):
+    '''
+    :return: the tuple (the set of added and changed paths, the list of deleted paths)
+    '''
+    updated = set(path for kind, path in changes if kind in (u'A', u'C'))
+    deleted = sorted(path for kind, path in changes if kind == u'D')
+    return updated, deleted
+
+
+def _squash_build(cli, container_name, source_image_name, image_name, changes):
+    '''
+    Apply the changes of the staging container to the new container from the source image
+    and commit it: the exported filesystem is filtered to the added and changed paths on the fly
+    and streamed to the new container, the deleted paths are removed by one command per batch
+    '''
+    fs_changes = cli.changes(container_name)
+    if fs_changes is None:
+        return None
+    updated, deleted = _changed_paths(fs_changes)
+    squash_container_name = u'%s-squash' % container_name
+    if not cli.run_base_container(source_image_name, squash_container_name, rerun=True):
+        return None
+    try:
+        chunks = cli.export(container_name)
+        try:
+            ok = cli.put_archive(squash_container_name, u'/',
+                                 filter_archive(ChunkReader(chunks),
+                                                lambda m: posixpath.normpath(u'/' + m.name) in updated))
+        finally:
+            chunks.close()
+        if not ok:
+            return None
+        for pos in range(0, len(deleted), DELETE_BATCH_SIZE):
+            # [] is returned in case of error
+            if isinstance(cli.execute(squash_container_name, 'rm', '-rf', '--',
+                                      *deleted[pos:pos + DELETE_BATCH_SIZE]), list):
+                return None
+        return cli.commit(squash_container_name, image_name, changes=changes) or None
+    finally:
+        cli.teardown(squash_container_name)
+
+
+def squash_container(cli, container_name, source_image_name, image_name, mode=SQUASH_ALL):
+    '''
+    Create the image from the staging container without the layers of intermediate steps, the files
+    deleted during the build are not shipped. The filesystem is streamed from `docker export`,
+    nothing is written to the disk. The config of the image (ENV, CMD, WORKDIR, labels) is carried over
+
+    :param cli: docker client
+    :param container_name: staging container name
+    :param source_image_name: source image name
+    :param image_name: target image name
+    :param mode: SQUASH_ALL - import the whole filesystem as one layer image,
+        SQUASH_BUILD - commit the changes of the build as one layer on top of the source image
+    :return: the dict with image.id, size.before (the size of the committed image) and size.after
+        (the size of squashed image), None on error
+    '''
+    if mode not in SQUASH_MODES:
+        raise ValueError('Unknown squash mode, %s' % mode)
+    _, size_before = cli.container_size(container_name)
+    changes = config_changes(cli.inspect(container_name, '.Config'), cli.inspect_image(source_image_name, '.Config'))
+    logger.info(**{u'msg': u'Squashing container into image', u'container.name': container_name,
+                   u'image.name': image_name, u'squash.mode': mode, u'changes': changes})
+
+    if mode == SQUASH_ALL:
+        chunks = cli.export(container_name)
+        try:
+            image_id = cli.import_image(chunks, image_name, changes=changes)
+        finally:
+            chunks.close()
+    else:
+        image_id = _squash_build(cli, container_name, source_image_name, image_name, changes)
+    if not image_id:
+        logger.error(**{u'msg': u'Cannot squash the container', u'container.name': container_name})
+        return None
+
+    size_after = cli.inspect_image(image_id, '.Size')
+    logger.info(**{u'msg': u'Container was squashed into image', u'image.name': image_name, u'image.id': image_id,
+                   u'size.before': size_before, u'size.after': size_after})
+    return {u'image.id': image_id, u'size.before': size_before, u'size.after': size_after}
@@ -0,0 +1,203 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import errno
+import select
+import collections
+
+from builder.log import Logger
+
+logger = Logger(__name__)
+
+# the stream types of multiplexed exec/attach output, see Docker Engine API,
+# "Attach to a container" -> "Stream format"
+STREAM_STDIN = 0
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
+
+STREAM_NAMES = {
+    STREAM_STDIN: u'stdin',
+    STREAM_STDOUT: u'stdout',
+    STREAM_STDERR: u'stderr',
+}
+
+# the partial line longer than this limit is emitted as is, to keep memory usage constant
+MAX_LINE_SIZE = 64 * 1024
+
+# the size of pipe reads, os.read() returns what is available up to the size
+CHUNK_SIZE = 64 * 1024
+
+
+def _retry(func, *args):
+    # Python 2 does not retry the system calls interrupted by signals
+    while True:
+        try:
+            return func(*args)
+        except (OSError, IOError, select.error) as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+
+def iter_output(proc):
+    '''
+    Read stdout and stderr of the process as soon as the data is available, without buffering and polling
+
+    :param proc: subprocess.Popen with stdout and stderr pipes
+    :return: the iterator of (stream type, bytes) tuples. The process is killed if the iterator is closed
+        before the end of output, the process is waited for at the end
+    '''
+    pipes = {proc.stdout.fileno(): STREAM_STDOUT, proc.stderr.fileno(): STREAM_STDERR}
+    finished = False
+    try:
+        while pipes:
+            ready, _, _ = _retry(select.select, list(pipes), [], [])
+            for fd in ready:
+                chunk = _retry(os.read, fd, CHUNK_SIZE)
+                if chunk:
+                    yield pipes[fd], chunk
+                else:
+                    del pipes[fd]
+        finished = True
+    finally:
+        if not finished and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                # the process has exited
+                pass
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+
+
+def traced_frames(span, frames, exit_code):
+    '''
+    Trace the streamed command: the span counts received bytes and ends with the output, the exit code
+    is recorded
+
+    :param span: the started span, see trace.started()
+    :param frames: the iterator of (stream type, bytes) tuples
+    :param exit_code: the function returns exit code after the frames were consumed
+    :return: the tuple (frames, exit code function) for ExecStream
+    '''
+    result = []
+
+    def traced():
+        error = None
+        try:
+            for frame in frames:
+                span.add(u'bytes.received', len(frame[1]))
+                yield frame
+            result.append(exit_code())
+            span.set(u'exit.code', result[0])
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            span.finish(error)
+
+    return traced(), lambda: result[0] if result else exit_code()
+
+
+class ExecStream(object):
+    '''
+    The output of the command executed in streaming mode. Stdout and stderr are kept separate,
+    the output is not stored, only the tail of lines is kept for error reports.
+
+    Usage:
+
+        stream = ctxt.cmd('make', stream=True)
+        for name, line in stream:               # name: stdout or stderr
+            print(line)
+        stream.exit_code
+
+        ctxt.cmd('make', stream=True, raw=True) # the iterator of (name, memoryview) chunks
+        ctxt.cmd('make', callback=lambda name, line: print(name, line))
+    '''
+    def __init__(self, frames, exit_code, args=(), raw=False, tail_size=100):
+        '''
+        :param frames: the iterator of (stream type, bytes) tuples
+        :param exit_code: the function returns exit code after the frames were consumed
+        :param args: command line arguments, for error reports
+        :param raw: yield raw chunks instead of lines
+        :param tail_size: the number of lines kept in the tail buffer
+        '''
+        self._frames = frames
+        self._exit_code_fn = exit_code
+        self._args = args
+        self._raw = raw
+        self._pending = dict()
+        self._exit_code = None
+        self._finished = False
+        self.tail = collections.deque(maxlen=tail_size)
+        self.bytes = {u'stdout': 0, u'stderr': 0}
+
+    def __iter__(self):
+        if self._finished:
+            return
+        for stream_type, chunk in self._frames:
+            name = STREAM_NAMES.get(stream_type, u'stdout')
+            self.bytes[name] = self.bytes.get(name, 0) + len(chunk)
+            lines = self._split(name, chunk)
+            if self._raw:
+                yield name, memoryview(chunk)
+            else:
+                for line in lines:
+                    yield name, line
+        for name, line in self._flush():
+            if not self._raw:
+                yield name, line
+        self._finish()
+
+    def _split(self, name, chunk):
+        data = self._pending.pop(name, b'') + chunk
+        parts = data.split(b'\n')
+        pending = parts.pop()
+        if len(pending) > MAX_LINE_SIZE:
+            parts.append(pending)
+        elif pending:
+            self._pending[name] = pending
+        lines = [p.decode('utf-8', 'replace') for p in parts]
+        self.tail.extend((name, line) for line in lines)
+        return lines
+
+    def _flush(self):
+        result = []
+        for name in sorted(self._pending):
+            line = self._pending[name].decode('utf-8', 'replace')
+            self.tail.append((name, line))
+            result.append((name, line))
+        self._pending.clear()
+        return result
+
+    def _finish(self):
+        self._finished = True
+        self._exit_code = self._exit_code_fn()
+        if self._exit_code != 0:
+            logger.error(**{u'msg': u'Command execution failed',
+                            u'command.args': self._args,
+                            u'exit.code': self._exit_code,
+                            u'output.tail': [u'%s: %s' % (name, line) for name, line in self.tail]})
+
+    def wait(self):
+        '''
+        Consume the rest of output
+
+        :return: exit code
+        '''
+        for _ in self:
+            pass
+        return self._exit_code
+
+    @property
+    def exit_code(self):
+        ''' exit code of the command, None if the output was not consumed yet
+        '''
+        return self._exit_code
+
+    @property
+    def ok(self):
+        return self._finished and self._exit_code == 0
+
+    def __repr__(self):
+        return '<ExecStream args=%r exit_code=%r>' % (self._args, self._exit_code)
@@ -0,0 +1,199 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import mmap
+import stat
+import hashlib
+import posixpath
+
+from six import text_type
+
+from builder.log import Logger
+from builder.archive import match_patterns
+
+logger = Logger(__name__)
+
+# the files of this size and larger are hashed via mmap, bytes
+MMAP_THRESHOLD = 1024 * 1024
+
+# the max number of paths removed by one command
+DELETE_BATCH_SIZE = 500
+
+# the manifest of the directory in the container: `d <path>`, `l <path> -> <target>`, `<sha256>  <path>`
+CONTAINER_MANIFEST_SCRIPT = '''mkdir -p "$1" && cd "$1" || exit 1
+find . -type d -exec printf 'd %s\\n' {} +
+find . -type l -exec sh -c 'for p; do printf "l %s -> %s\\n" "$p" "$(readlink "$p")"; done' sh {} +
+find . -type f -exec sha256sum {} +
+'''
+
+
+def hash_file(path, size=None):
+    '''
+    :param path: host path
+    :param size: file size, the large files are hashed via mmap without reading them to memory
+    :return: sha256 hex digest of the content
+    '''
+    size = os.path.getsize(path) if size is None else size
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        if size >= MMAP_THRESHOLD:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def parents(name):
+    '''
+    :return: the parent directories of the relative path, like a, a/b for a/b/c
+    '''
+    parts = name.split('/')
+    return ['/'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def excluded(name, patterns):
+    '''
+    :return: True if the path or any of its parent directories matches the patterns
+    '''
+    return any(match_patterns(p, patterns) for p in parents(name) + [name])
+
+
+def host_manifest(src, exclude=None, previous=None):
+    '''
+    The manifest of the host directory, the files are hashed unless their size and mtime
+    are the same as in the previous manifest
+
+    :param src: host directory
+    :param exclude: glob patterns of the files and directories to skip
+    :param previous: the previous manifest of the directory
+    :return: the dict: relative path -> (kind, size, mtime, hash or link target), the kind is f, d or l
+    '''
+    exclude, previous = list(exclude or []), previous or {}
+    manifest = dict()
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        prefix = u'' if rel == os.curdir else rel.replace(os.sep, '/') + '/'
+        for name in sorted(dirs + files):
+            path, relpath = os.path.join(root, name), prefix + name
+            if match_patterns(relpath, exclude):
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                manifest[relpath] = (u'l', 0, 0, os.readlink(path))
+                if name in dirs:
+                    dirs.remove(name)
+            elif stat.S_ISDIR(st.st_mode):
+                manifest[relpath] = (u'd', 0, 0, None)
+            elif stat.S_ISREG(st.st_mode):
+                known = previous.get(relpath)
+                if known and known[:3] == (u'f', st.st_size, st.st_mtime):
+                    manifest[relpath] = known
+                else:
+                    manifest[relpath] = (u'f', st.st_size, st.st_mtime, hash_file(path, st.st_size))
+    return manifest
+
+
+def manifest_digest(manifest):
+    '''
+    :param manifest: host manifest, see host_manifest()
+    :return: sha256 hex digest of the paths, kinds and contents, mtimes are not a part of it
+    '''
+    digest = hashlib.sha256()
+    for path in sorted(manifest):
+        kind, size, _, value = manifest[path]
+        digest.update(json.dumps([path, kind, size, value]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def parse_container_manifest(output):
+    '''
+    :param output: the output of CONTAINER_MANIFEST_SCRIPT
+    :return: the dict: relative path -> (kind, hash or link target)
+    '''
+    manifest = dict()
+    for line in output.splitlines():
+        if line.startswith(u'd '):
+            kind, path, value = u'd', line[2:], None
+        elif line.startswith(u'l '):
+            kind, (path, _, value) = u'l', line[2:].partition(u' -> ')
+        else:
+            value, _, path = line.partition(u'  ')
+            kind = u'f'
+        if path.startswith(u'./'):
+            manifest[path[2:]] = (kind, value)
+    return manifest
+
+
+def plan(host, container, exclude=None):
+    '''
+    Compare the manifests
+
+    :param host: host manifest, see host_manifest()
+    :param container: container manifest, see parse_container_manifest()
+    :param exclude: glob patterns, the excluded paths in the container are kept
+    :return: the tuple (the list of paths to upload, the list of paths to delete), the new directories
+        are uploaded with their content, the removed directories are deleted with their content
+    '''
+    exclude = list(exclude or [])
+    upload, delete = set(), set()
+    for path in sorted(host):
+        if any(p in upload for p in parents(path)):
+            continue
+        kind, _, _, value = host[path]
+        known = container.get(path)
+        if known and known[0] != kind:
+            delete.add(path)
+            known = None
+        if not known or (kind != u'd' and known[1] != value):
+            upload.add(path)
+    for path in sorted(container):
+        if path not in host and not excluded(path, exclude) and not any(p in delete for p in parents(path)):
+            delete.add(path)
+    return sorted(upload), sorted(delete)
+
+
+def sync_directory(cli, container_name, src, dest, exclude=None, previous=None):
+    '''
+    Sync the host directory to the directory in the container like rsync: only the added and changed files
+    are copied, in one tar stream, and the removed files are deleted in the container.
+    The files are compared by content hashes
+
+    :param cli: docker client
+    :param container_name: container name
+    :param src: host directory
+    :param dest: the directory in the container, it's created if missing
+    :param exclude: glob patterns of the files and directories to skip, they are kept in the container
+    :param previous: the host manifest of the previous sync, to skip hashing of the files which were not modified
+    :return: the tuple (the dict with the numbers of uploaded, deleted and unchanged paths or None on error,
+        host manifest)
+    '''
+    manifest = host_manifest(src, exclude=exclude, previous=previous)
+    output = cli.execute(container_name, '/bin/sh', '-c', CONTAINER_MANIFEST_SCRIPT, 'sh', dest)
+    # [] is returned in case of error
+    if isinstance(output, list):
+        logger.error(**{u'msg': u'Cannot read the directory in the container',
+                        u'container.name': container_name, u'destination.path': dest})
+        return None, manifest
+    upload, delete = plan(manifest, parse_container_manifest(text_type(output)), exclude=exclude)
+    uploaded = set(upload)
+    result = {u'uploaded': len(upload), u'deleted': len(delete),
+              u'unchanged': len([p for p in manifest if p not in uploaded and not uploaded.intersection(parents(p))])}
+    logger.info(**{u'msg': u'Syncing directory', u'container.name': container_name,
+                   u'source.path': src, u'destination.path': dest, u'sync': result})
+
+    for pos in range(0, len(delete), DELETE_BATCH_SIZE):
+        paths = [posixpath.join(dest, p) for p in delete[pos:pos + DELETE_BATCH_SIZE]]
+        if isinstance(cli.execute(container_name, 'rm', '-rf', '--', *paths), list):
+            return None, manifest
+    if upload:
+        sources = [(os.path.join(src, *path.split('/')), path) for path in upload]
+        if not cli.copy_many(container_name, sources, dest, exclude=exclude):
+            return None, manifest
+    return result, manifest
@@ -0,0 +1,368 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import time
+import random
+import functools
+import threading
+
+from six import integer_types, string_types, text_type
+
+from builder import TRACE_CHROME, TRACE_OTLP, TRACE_FORMATS
+
+SERVICE_NAME = u'docker-image-builder'
+
+# the tracer of the process, None - tracing is disabled
+_tracer = None
+
+
+def _new_id(bits):
+    return u'%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+class Span(object):
+    '''
+    The timed operation, the spans started in the same thread while the span is active are its children
+
+    Usage:
+
+        with trace.span(u'docker.exec', container=u'b1') as span:
+            ...
+            span.set(u'exit.code', 0)
+    '''
+    def __init__(self, tracer, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.span_id = _new_id(64)
+        self.parent_id = None
+        self.thread_id = None
+        self.thread_name = None
+        self.start = None
+        self.end = None
+        self._tracer = tracer
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def add(self, key, value):
+        '''
+        Add the value to the counter attribute, like the number of transferred bytes
+        '''
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def begin(self):
+        '''
+        Start the span as the child of the active span, the span does not become active
+        '''
+        stack = self._tracer._stack()
+        self.parent_id = stack[-1].span_id if stack else None
+        thread = threading.current_thread()
+        self.thread_id, self.thread_name = thread.ident, thread.name
+        self.start = time.time()
+        return self
+
+    def finish(self, error=None):
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if error is not None:
+            self.attributes[u'error'] = u'{}'.format(error) or type(error).__name__
+        self._tracer._finish(self)
+
+    def __enter__(self):
+        self.begin()
+        self._tracer._stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        stack = self._tracer._stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.finish(exc_value if exc_type is not None else None)
+        return False
+
+
+class _NullSpan(object):
+    ''' the span of disabled tracing, nothing is recorded
+    '''
+    def begin(self):
+        return self
+
+    def finish(self, error=None):
+        pass
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    '''
+    Collect the finished spans of all threads of the process, the finished spans are passed to the listeners,
+    like metrics Registry.observe_span()
+    '''
+    def __init__(self, record=True):
+        '''
+        :param record: keep the finished spans for the trace file
+        '''
+        self.trace_id = _new_id(128)
+        self.record = record
+        self.spans = []
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _finish(self, span):
+        if self.record:
+            with self._lock:
+                self.spans.append(span)
+        for listener in self.listeners:
+            listener(span)
+
+    def span(self, name, **attributes):
+        return Span(self, name, attributes)
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else NULL_SPAN
+
+    def chrome_trace(self):
+        '''
+        :return: the trace in Chrome trace event format, for chrome://tracing or Perfetto
+        '''
+        pid = os.getpid()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        events = [{u'name': u'thread_name', u'ph': u'M', u'pid': pid, u'tid': tid, u'args': {u'name': name}}
+                  for tid, name in sorted(set((s.thread_id, s.thread_name) for s in spans))]
+        for s in spans:
+            events.append({u'name': s.name, u'cat': s.name.split(u'.')[0], u'ph': u'X', u'pid': pid,
+                           u'tid': s.thread_id, u'ts': int(s.start * 1e6), u'dur': int((s.end - s.start) * 1e6),
+                           u'args': dict((k, _json_value(v)) for k, v in s.attributes.items())})
+        return {u'traceEvents': events, u'displayTimeUnit': u'ms'}
+
+    def otlp_trace(self):
+        '''
+        :return: the trace in OTLP JSON format, ExportTraceServiceRequest
+        '''
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        otlp_spans = []
+        for s in spans:
+            otlp_span = {u'traceId': self.trace_id, u'spanId': s.span_id, u'name': s.name,
+                         u'kind': 1, u'startTimeUnixNano': text_type(int(s.start * 1e9)),
+                         u'endTimeUnixNano': text_type(int(s.end * 1e9)),
+                         u'attributes': [_otlp_attribute(k, v) for k, v in sorted(s.attributes.items())]}
+            if s.parent_id:
+                otlp_span[u'parentSpanId'] = s.parent_id
+            # STATUS_CODE_ERROR
+            if u'error' in s.attributes:
+                otlp_span[u'status'] = {u'code': 2, u'message': text_type(s.attributes[u'error'])}
+            otlp_spans.append(otlp_span)
+        return {u'resourceSpans': [{
+            u'resource': {u'attributes': [_otlp_attribute(u'service.name', SERVICE_NAME)]},
+            u'scopeSpans': [{u'scope': {u'name': u'builder'}, u'spans': otlp_spans}],
+        }]}
+
+    def write(self, path, trace_format=TRACE_CHROME):
+        '''
+        Write the trace file
+
+        :param path: the file path
+        :param trace_format: TRACE_CHROME or TRACE_OTLP
+        '''
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError('Unknown trace format, %s' % trace_format)
+        trace = self.chrome_trace() if trace_format == TRACE_CHROME else self.otlp_trace()
+        with open(path, 'w') as trace_file:
+            trace_file.write(json.dumps(trace))
+
+
+def _json_value(value):
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    if value is None or isinstance(value, (bool, float, text_type) + integer_types):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return u'{}'.format(value)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {u'boolValue': value}
+    if isinstance(value, integer_types):
+        # int64 is the string in OTLP JSON
+        return {u'intValue': text_type(value)}
+    if isinstance(value, float):
+        return {u'doubleValue': value}
+    if isinstance(value, (list, tuple)):
+        return {u'arrayValue': {u'values': [_otlp_value(v) for v in value]}}
+    return {u'stringValue': _json_value(value) if isinstance(value, string_types) else u'{}'.format(value)}
+
+
+def _otlp_attribute(key, value):
+    return {u'key': key, u'value': _otlp_value(value)}
+
+
+def enable(record=True):
+    '''
+    Start tracing of the process, the tracer is shared if tracing was already enabled
+
+    :param record: keep the finished spans for the trace file
+    :return: Tracer
+    '''
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(record=record)
+    else:
+        _tracer.record = _tracer.record or record
+    return _tracer
+
+
+def disable():
+    '''
+    Stop tracing of the process
+
+    :return: Tracer with recorded spans, None if tracing was not enabled
+    '''
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def span(name, **attributes):
+    '''
+    :param name: span name, like docker.exec or build.module
+    :param attributes: span attributes
+    :return: the span context manager, the span is not recorded if tracing is disabled
+    '''
+    tracer = _tracer
+    return tracer.span(name, **attributes) if tracer else NULL_SPAN
+
+
+def started(name, **attributes):
+    '''
+    Start the span which is not active: the spans of the thread are not its children, like the span
+    of the streamed output consumed by the caller. The span is finished by Span.finish()
+
+    :return: the started span, the null span if tracing is disabled
+    '''
+    tracer = _tracer
+    return tracer.span(name, **attributes).begin() if tracer else NULL_SPAN
+
+
+def current():
+    '''
+    :return: the active span of the current thread, the null span if there's no one
+    '''
+    tracer = _tracer
+    return tracer.current() if tracer else NULL_SPAN
+
+
+def traced(name, **arguments):
+    '''
+    Trace the calls of the method as the span, the arguments of the call are recorded as span attributes
+
+    Usage:
+
+        @traced(u'docker.exec', container=0, command=slice(1, None))
+        def execute(self, container_name, *args):
+
+    :param name: span name
+    :param arguments: attribute name -> the index or the slice of positional arguments
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = _tracer
+            if not tracer:
+                return method(self, *args, **kwargs)
+            with tracer.span(name, **_attributes(arguments, args)):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_iter(name, **arguments):
+    '''
+    Trace the calls of the method which returns the iterator, like the listing or the streamed output:
+    the span lasts until the iterator is exhausted or closed. The span is not active while the caller
+    consumes the iterator, see started()
+
+    :param name: span name
+    :param arguments: attribute name -> the index or the slice of positional arguments, see traced()
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = _tracer
+            if not tracer:
+                return method(self, *args, **kwargs)
+            active = tracer.span(name, **_attributes(arguments, args)).begin()
+            try:
+                items = method(self, *args, **kwargs)
+            except Exception as err:
+                active.finish(err)
+                raise
+            return _spanned(items, active)
+        return wrapper
+    return decorator
+
+
+def _attributes(arguments, args):
+    attributes = dict()
+    for key, index in arguments.items():
+        value = args[index] if isinstance(index, slice) or index < len(args) else None
+        if value is not None:
+            attributes[key] = list(value) if isinstance(index, slice) else value
+    return attributes
+
+
+def _spanned(items, active):
+    error = None
+    try:
+        for item in items:
+            yield item
+    except Exception as err:
+        error = err
+        raise
+    finally:
+        active.finish(error)
+
+
+def counted(chunks, key):
+    '''
+    Count the bytes of the chunks into the attribute of the active span
+
+    :param chunks: the iterator of chunks, bytes
+    :param key: the attribute name, like bytes.sent
+    :return: the iterator of chunks
+    '''
+    active = current()
+    if active is NULL_SPAN:
+        return chunks
+    return _count(chunks, active, key)
+
+
+def _count(chunks, active, key):
+    for chunk in chunks:
+        active.add(key, len(chunk))
+        yield chunk
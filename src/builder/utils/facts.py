@@ -4,6 +4,92 @@ import re
 
 from builder.utils import network as network_utils
 
+FACTS_SECTION_MARKER = u'__builder_facts_section__ '
+
+# the sections of facts script: (category, section, command)
+FACTS_SECTIONS = (
+    (u'hw', u'cpuinfo', u'cat /proc/cpuinfo'),
+    (u'hw', u'meminfo', u'cat /proc/meminfo'),
+    (u'env', u'env', u'env'),
+    (u'release', u'release', u'cat /etc/*release*'),
+    (u'uname', u'machine.type', u'uname -m'),
+    (u'uname', u'hardware.platform', u'uname -i'),
+    (u'uname', u'hostname', u'uname -n'),
+    (u'uname', u'kernel.release', u'uname -r'),
+    (u'uname', u'kernel.version', u'uname -v'),
+    (u'uname', u'kernel.name', u'uname -s'),
+    (u'uname', u'processor.type', u'uname -p'),
+    (u'uname', u'os.name', u'uname -o'),
+    (u'net', u'hostname', u'cat /etc/hostname'),
+    (u'net', u'resolv', u'cat /etc/resolv.conf'),
+    (u'net', u'ifconfig', u'ifconfig'),
+)
+
+
+def facts_script(categories=('all',)):
+    '''
+    Shell script for facts gathering in one run, the output of every command
+    is prefixed by the section marker
+
+    :param categories: the list of categories, default: all (all facts)
+    :return: shell script
+    '''
+    lines = []
+    for category, section, command in FACTS_SECTIONS:
+        if 'all' in categories or category in categories:
+            lines.append(u"echo '%s%s.%s'" % (FACTS_SECTION_MARKER, category, section))
+            lines.append(u'%s 2>/dev/null' % command)
+    lines.append(u'exit 0')
+    return u'\n'.join(lines)
+
+
+def split_sections(output):
+    '''
+    Split the output of facts script to sections
+
+    :param output: stdout of facts script
+    :return: the dict of (category, section) -> section output
+    '''
+    sections = dict()
+    current = None
+    for line in output.split('\n'):
+        if line.startswith(FACTS_SECTION_MARKER):
+            category, _, section = line[len(FACTS_SECTION_MARKER):].strip().partition(u'.')
+            current = sections.setdefault((category, section), [])
+        elif current is not None:
+            current.append(line)
+    return dict((k, u'\n'.join(v)) for k, v in sections.items())
+
+
+def parse_facts(output):
+    '''
+    Parse the output of facts script
+
+    :param output: stdout of facts script
+    :return: the dict with facts about container
+    '''
+    sections = split_sections(output)
+    facts = dict()
+    if (u'hw', u'cpuinfo') in sections:
+        facts.update(parse_cpuinfo(sections[(u'hw', u'cpuinfo')]))
+        facts.update(parse_meminfo(sections[(u'hw', u'meminfo')]))
+
+    if (u'env', u'env') in sections:
+        facts[u'env'] = parse_env(sections[(u'env', u'env')])
+
+    if (u'release', u'release') in sections:
+        facts[u'release'] = parse_env(sections[(u'release', u'release')])
+
+    uname = dict((section, v.strip()) for (category, section), v in sections.items() if category == u'uname')
+    if uname:
+        facts[u'uname'] = uname
+
+    if (u'net', u'hostname') in sections:
+        facts[u'net'] = {u'hostname': sections[(u'net', u'hostname')].strip()}
+        facts[u'net'].update(parse_resolv(sections[(u'net', u'resolv')]))
+        facts[u'net'][u'interfaces'] = parse_ifconfig(sections[(u'net', u'ifconfig')].strip())
+    return facts
+
 
 def parse_cpuinfo(info):
     '''
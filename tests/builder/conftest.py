@@ -0,0 +1,35 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import stat
+
+import pytest
+
+from builder import dockerapi, inventory
+from fakedaemon import FakeDockerDaemon
+
+# `docker exec [options] <container> <args>` runs <args> on the host
+FAKE_DOCKER_EXEC = '''#!/bin/sh
+shift
+while [ "${1#-}" != "$1" ]; do shift; done
+shift
+exec "$@"
+'''
+
+
+@pytest.fixture
+def fake_docker_exec(tmpdir, monkeypatch):
+    docker = tmpdir.join('docker')
+    docker.write(FAKE_DOCKER_EXEC)
+    os.chmod(str(docker), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmpdir, os.environ['PATH']))
+    return docker
+
+
+@pytest.fixture
+def daemon():
+    _daemon = FakeDockerDaemon(images=['alpine:3.5']).start()
+    yield _daemon
+    inventory.close_inventories()
+    dockerapi.close_pools()
+    _daemon.stop()
@@ -0,0 +1,491 @@
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import shutil
+import struct
+import fnmatch
+import hashlib
+import tarfile
+import tempfile
+import threading
+import subprocess
+
+from six.moves import queue, socketserver, BaseHTTPServer
+from six.moves.urllib.parse import urlparse, parse_qs, unquote
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.daemon.connections += 1
+
+    def address_string(self):
+        return 'fake-daemon'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        # the repeated parameters are passed as lists
+        params = dict((k, v[0] if len(v) == 1 else v) for k, v in parse_qs(url.query).items())
+        body = self._body()
+        self.server.daemon.requests.append((self.command, unquote(url.path)))
+        for method, pattern, handler in self.server.daemon.routes:
+            match = re.match(pattern + '$', unquote(url.path))
+            if method == self.command and match:
+                return handler(self, params, body, *match.groups())
+        self.reply(404, {u'message': u'page not found'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+    def reply(self, status, payload=None, headers=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+
+class FakeDockerDaemon(object):
+    '''
+    The local stand-in of Docker daemon, it serves the subset of Engine API over the unix socket.
+    Commands of exec instances are executed on the host in the container root directory,
+    the archive endpoints work with the same directory.
+
+    Usage:
+
+        daemon = FakeDockerDaemon(images=['alpine:3.5']).start()
+        cli = DockerAPI(base_url=daemon.url)
+        ...
+        daemon.stop()
+    '''
+    def __init__(self, images=()):
+        self.connections = 0
+        self.requests = []
+        self.images = dict()
+        self.containers = dict()
+        self.execs = dict()
+        self.events = []
+        self._subscribers = []
+        self._tmpdir = tempfile.mkdtemp(prefix='fake-docker-')
+        self.socket_path = os.path.join(self._tmpdir, 'docker.sock')
+        for name in images:
+            self.add_image(name)
+
+        self.routes = [
+            ('GET', r'/version', self.version),
+            ('GET', r'/events', self.events_stream),
+            ('GET', r'/images/json', self.images_json),
+            ('GET', r'/images/(.+)/json', self.image_inspect),
+            ('POST', r'/images/(.+)/tag', self.image_tag),
+            ('POST', r'/images/create', self.image_create),
+            ('GET', r'/containers/json', self.containers_json),
+            ('POST', r'/containers/create', self.container_create),
+            ('POST', r'/containers/([^/]+)/start', self.container_start),
+            ('POST', r'/containers/([^/]+)/stop', self.container_stop),
+            ('POST', r'/containers/([^/]+)/rename', self.container_rename),
+            ('DELETE', r'/containers/([^/]+)', self.container_delete),
+            ('GET', r'/containers/([^/]+)/json', self.container_inspect),
+            ('GET', r'/containers/([^/]+)/export', self.container_export),
+            ('GET', r'/containers/([^/]+)/changes', self.container_changes),
+            ('POST', r'/containers/([^/]+)/exec', self.exec_create),
+            ('POST', r'/exec/([^/]+)/start', self.exec_start),
+            ('GET', r'/exec/([^/]+)/json', self.exec_inspect),
+            ('POST', r'/commit', self.commit),
+            ('HEAD', r'/containers/([^/]+)/archive', self.archive_stat),
+            ('GET', r'/containers/([^/]+)/archive', self.archive_get),
+            ('PUT', r'/containers/([^/]+)/archive', self.archive_put),
+        ]
+
+    @property
+    def url(self):
+        return 'unix://%s' % self.socket_path
+
+    def start(self):
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.daemon = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.drop_events()
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    @staticmethod
+    def _new_id(seed):
+        return hashlib.sha256(('%s-%s' % (seed, uuid.uuid4())).encode('utf-8')).hexdigest()
+
+    def add_image(self, name=None, labels=None, config=None, size=4 * 1024 * 1024):
+        for img in self.images.values():
+            if name in img[u'RepoTags']:
+                img[u'RepoTags'].remove(name)
+        _id = 'sha256:' + self._new_id(name)
+        self.images[_id] = {u'Id': _id, u'RepoTags': [name] if name else [], u'Size': size,
+                            u'Created': int(time.time()), u'Labels': labels or {},
+                            u'Config': dict(config or {}, Labels=labels or {})}
+        return _id
+
+    @staticmethod
+    def apply_changes(config, changes):
+        '''
+        Apply Dockerfile instructions to the image config, ENV, CMD, ENTRYPOINT, WORKDIR and LABEL are supported
+
+        :param changes: the list of instructions or the string with one instruction per line
+        '''
+        config = dict(config, Labels=dict(config.get(u'Labels') or {}))
+        for change in (changes.split('\n') if isinstance(changes, str) else changes or []):
+            instruction, _, value = change.partition(' ')
+            if instruction == 'LABEL':
+                key, value = value.split('=', 1)
+                config[u'Labels'][key.strip('"')] = value.strip('"')
+            elif instruction == 'ENV':
+                key, _, value = value.partition('=')
+                if value.startswith('"'):
+                    # the double-quoted value, the backslash escapes the next character
+                    value = re.sub(r'\\(.)', r'\1', value[1:-1])
+                config[u'Env'] = (config.get(u'Env') or []) + ['%s=%s' % (key, value)]
+            elif instruction == 'CMD':
+                config[u'Cmd'] = json.loads(value)
+            elif instruction == 'ENTRYPOINT':
+                config[u'Entrypoint'] = json.loads(value)
+            elif instruction == 'WORKDIR':
+                config[u'WorkingDir'] = value
+        return config
+
+    def _size(self, cont):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, files in os.walk(self.root(cont)) for name in files)
+
+    def container(self, ref):
+        # the name is resolved before the id prefix like by docker, the names like b1 are valid id prefixes
+        for cont in self.containers.values():
+            if cont[u'Id'] == ref or cont[u'Name'] == ref:
+                return cont
+        for cont in self.containers.values():
+            if cont[u'Id'].startswith(ref):
+                return cont
+        return None
+
+    def root(self, cont, path='/'):
+        return os.path.join(self._tmpdir, 'containers', cont[u'Id'], path.lstrip('/'))
+
+    def emit(self, _type, action, _id, **attributes):
+        event = {u'Type': _type, u'Action': action, u'Actor': {u'ID': _id, u'Attributes': attributes},
+                 u'time': int(time.time()), u'timeNano': int(time.time() * 1e9)}
+        self.events.append(event)
+        for subscriber in list(self._subscribers):
+            subscriber.put(event)
+
+    def drop_events(self):
+        ''' close all event streams
+        '''
+        for subscriber in list(self._subscribers):
+            subscriber.put(None)
+
+    # Engine API handlers
+
+    def events_stream(self, req, params, body):
+        subscriber = queue.Queue()
+        for event in self.events:
+            if event[u'time'] >= int(params.get('since') or 0):
+                subscriber.put(event)
+        self._subscribers.append(subscriber)
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/json')
+        req.end_headers()
+        req.close_connection = True
+        try:
+            for event in iter(subscriber.get, None):
+                req.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+                req.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            self._subscribers.remove(subscriber)
+
+    def version(self, req, params, body):
+        req.reply(200, {u'Version': u'fake', u'ApiVersion': u'1.24'})
+
+    def image(self, ref):
+        for img in self.images.values():
+            if img[u'Id'] == ref or img[u'Id'].split(':')[-1].startswith(ref) or ref in img[u'RepoTags']:
+                return img
+        return None
+
+    @staticmethod
+    def _match_labels(labels, filters):
+        for _filter in filters:
+            key, sep, value = _filter.partition('=')
+            if key not in labels or (sep and labels[key] != value):
+                return False
+        return True
+
+    def images_json(self, req, params, body):
+        filters = json.loads(params.get('filters', '{}'))
+        req.reply(200, [img for img in self.images.values()
+                        if self._match_labels(img[u'Labels'], filters.get('label', [])) and
+                        all(any(fnmatch.fnmatch(t, r if ':' in r else r + ':*') for t in img[u'RepoTags'])
+                            for r in filters.get('reference', []))])
+
+    def image_inspect(self, req, params, body, ref):
+        img = self.image(ref)
+        if not img:
+            return req.reply(404, {u'message': u'No such image: %s' % ref})
+        req.reply(200, img)
+
+    def image_tag(self, req, params, body, ref):
+        img = self.image(ref)
+        if not img:
+            return req.reply(404, {u'message': u'No such image: %s' % ref})
+        name = '%s:%s' % (params['repo'], params.get('tag') or 'latest')
+        for other in self.images.values():
+            if name in other[u'RepoTags']:
+                other[u'RepoTags'].remove(name)
+        img[u'RepoTags'].append(name)
+        self.emit(u'image', u'tag', img[u'Id'], name=name)
+        req.reply(201)
+
+    def _match_container(self, cont, filters):
+        image = self.image(cont[u'Config'][u'Image'])
+        return (self._match_labels(cont[u'Config'][u'Labels'], filters.get('label', [])) and
+                all(re.search(n, u'/' + cont[u'Name']) for n in filters.get('name', [])) and
+                all(cont[u'State'][u'Status'] == s for s in filters.get('status', [])) and
+                all(image and self.image(a) is image for a in filters.get('ancestor', [])))
+
+    def containers_json(self, req, params, body):
+        filters = json.loads(params.get('filters', '{}'))
+        req.reply(200, [{
+            u'Id': c[u'Id'], u'Names': [u'/' + c[u'Name']], u'Image': c[u'Config'][u'Image'],
+            u'Command': u' '.join(c[u'Config'].get(u'Cmd') or []), u'Created': c[u'Created'],
+            u'Labels': c[u'Config'][u'Labels'], u'Status': c[u'State'][u'Status'], u'Mounts': [],
+            u'NetworkSettings': c[u'NetworkSettings'],
+        } for c in self.containers.values()
+            if (params.get('all') or c[u'State'][u'Running']) and self._match_container(c, filters)])
+
+    def container_create(self, req, params, body):
+        config = json.loads(body.decode('utf-8'))
+        if not self.image(config[u'Image']):
+            return req.reply(404, {u'message': u'No such image: %s' % config[u'Image']})
+        name = params.get('name') or self._new_id('name')[:8]
+        if any(c[u'Name'] == name for c in self.containers.values()):
+            return req.reply(409, {u'message': u'Conflict. The container name "/%s" is already in use' % name})
+        _id = self._new_id(name)
+        config.setdefault(u'Labels', {})
+        self.containers[_id] = {
+            u'Id': _id, u'Name': name, u'Created': int(time.time()), u'Config': config,
+            u'HostConfig': config.pop(u'HostConfig', {}),
+            u'State': {u'Status': u'created', u'Running': False},
+            u'NetworkSettings': {u'Networks': {u'bridge': {u'IPAddress': u'172.17.0.2'}}},
+        }
+        os.makedirs(self.root(self.containers[_id]))
+        self.emit(u'container', u'create', _id, name=name, image=config[u'Image'])
+        req.reply(201, {u'Id': _id, u'Warnings': None})
+
+    def container_start(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        cont[u'State'] = {u'Status': u'running', u'Running': True}
+        self.emit(u'container', u'start', cont[u'Id'], name=cont[u'Name'], image=cont[u'Config'][u'Image'])
+        req.reply(204)
+
+    def container_stop(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        cont[u'State'] = {u'Status': u'exited', u'Running': False}
+        self.emit(u'container', u'die', cont[u'Id'], name=cont[u'Name'], image=cont[u'Config'][u'Image'])
+        req.reply(204)
+
+    def container_rename(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        if any(c[u'Name'] == params['name'] for c in self.containers.values()):
+            return req.reply(409, {u'message': u'Conflict. The name "/%s" is already in use' % params['name']})
+        self.emit(u'container', u'rename', cont[u'Id'], name=params['name'], oldName=u'/' + cont[u'Name'])
+        cont[u'Name'] = params['name']
+        req.reply(204)
+
+    def container_delete(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        if cont[u'State'][u'Running'] and not params.get('force'):
+            return req.reply(409, {u'message': u'You cannot remove a running container'})
+        shutil.rmtree(self.root(cont), ignore_errors=True)
+        del self.containers[cont[u'Id']]
+        self.emit(u'container', u'destroy', cont[u'Id'], name=cont[u'Name'], image=cont[u'Config'][u'Image'])
+        req.reply(204)
+
+    def container_inspect(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        if params.get('size'):
+            size, image = self._size(cont), self.image(cont[u'Config'][u'Image'])
+            return req.reply(200, dict(cont, SizeRw=size, SizeRootFs=size + image[u'Size']))
+        req.reply(200, cont)
+
+    def _send_tar(self, req, path, arcname):
+        tar_path = os.path.join(self._tmpdir, self._new_id(path) + '.tar')
+        tar = tarfile.open(tar_path, mode='w')
+        tar.add(path, arcname=arcname)
+        tar.close()
+        with open(tar_path, 'rb') as tar_file:
+            data = tar_file.read()
+        os.remove(tar_path)
+        req.send_header('Content-Type', 'application/x-tar')
+        req.send_header('Content-Length', str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    def container_export(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        req.send_response(200)
+        self._send_tar(req, self.root(cont), '.')
+
+    def container_changes(self, req, params, body, ref):
+        ''' the image filesystem is empty, all files of the container were added
+        '''
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        root = self.root(cont)
+        req.reply(200, [{u'Kind': 1, u'Path': u'/' + os.path.relpath(os.path.join(r, name), root)}
+                        for r, dirs, files in os.walk(root) for name in dirs + files])
+
+    def image_create(self, req, params, body):
+        if params.get('fromSrc') != '-':
+            return req.reply(400, {u'message': u'Only the import from the request body is supported'})
+        tarfile.open(fileobj=io.BytesIO(body)).getmembers()
+        name = '%s:%s' % (params['repo'], params.get('tag') or 'latest')
+        config = self.apply_changes({}, params.get('changes') or [])
+        _id = self.add_image(name, labels=config.pop(u'Labels'), config=config, size=len(body))
+        self.emit(u'image', u'import', _id)
+        self.emit(u'image', u'tag', _id, name=name)
+        data = (json.dumps({u'status': _id}) + '\n').encode('utf-8')
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/json')
+        req.send_header('Content-Length', str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    def exec_create(self, req, params, body, ref):
+        cont = self.container(ref)
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % ref})
+        _id = self._new_id(ref)
+        self.execs[_id] = {u'ID': _id, u'Container': cont, u'Config': json.loads(body.decode('utf-8')),
+                           u'ExitCode': None, u'Running': False}
+        req.reply(201, {u'Id': _id})
+
+    def exec_start(self, req, params, body, ref):
+        _exec = self.execs.get(ref)
+        if not _exec:
+            return req.reply(404, {u'message': u'No such exec instance: %s' % ref})
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        req.end_headers()
+        req.close_connection = True
+
+        proc = subprocess.Popen(_exec[u'Config'][u'Cmd'], cwd=self.root(_exec[u'Container']),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        for stream_type, data in ((1, stdout), (2, stderr)):
+            if data:
+                req.wfile.write(struct.pack('>BxxxL', stream_type, len(data)) + data)
+        _exec[u'ExitCode'] = proc.returncode
+
+    def exec_inspect(self, req, params, body, ref):
+        _exec = self.execs.get(ref)
+        if not _exec:
+            return req.reply(404, {u'message': u'No such exec instance: %s' % ref})
+        req.reply(200, {u'ID': ref, u'ExitCode': _exec[u'ExitCode'], u'Running': _exec[u'Running']})
+
+    def commit(self, req, params, body):
+        cont = self.container(params.get('container', ''))
+        if not cont:
+            return req.reply(404, {u'message': u'No such container: %s' % params.get('container')})
+        name = '%s:%s' % (params['repo'], params.get('tag') or 'latest') if params.get('repo') else None
+        # the command of the container overrides the command of the image, like `docker run image cmd`
+        config = dict(self.image(cont[u'Config'][u'Image'])[u'Config'])
+        if cont[u'Config'].get(u'Cmd'):
+            config[u'Cmd'] = cont[u'Config'][u'Cmd']
+        config = self.apply_changes(config, params.get('changes', ''))
+        _id = self.add_image(name, labels=config.pop(u'Labels'), config=config, size=self._size(cont))
+        self.emit(u'container', u'commit', cont[u'Id'], name=cont[u'Name'], imageID=_id)
+        req.reply(201, {u'Id': _id})
+
+    def _stat_header(self, path):
+        st = os.stat(path)
+        mode = (st.st_mode & 0o777) | ((1 << 31) if os.path.isdir(path) else 0)
+        stat = {u'name': os.path.basename(path), u'size': st.st_size, u'mode': mode}
+        return {'X-Docker-Container-Path-Stat': base64.b64encode(json.dumps(stat).encode('utf-8')).decode('ascii')}
+
+    def archive_stat(self, req, params, body, ref):
+        cont = self.container(ref)
+        path = self.root(cont, params['path']) if cont else None
+        if not path or not os.path.exists(path):
+            return req.reply(404)
+        req.reply(200, headers=self._stat_header(path))
+
+    def archive_get(self, req, params, body, ref):
+        cont = self.container(ref)
+        path = self.root(cont, params['path']) if cont else None
+        if not path or not os.path.exists(path):
+            return req.reply(404, {u'message': u'Could not find the file %s' % params.get('path')})
+        req.send_response(200)
+        for k, v in self._stat_header(path).items():
+            req.send_header(k, v)
+        self._send_tar(req, path, os.path.basename(os.path.normpath(path)))
+
+    def archive_put(self, req, params, body, ref):
+        cont = self.container(ref)
+        path = self.root(cont, params['path']) if cont else None
+        if not path or not os.path.isdir(path):
+            return req.reply(404, {u'message': u'Could not find the file %s' % params.get('path')})
+        tar_path = os.path.join(self._tmpdir, self._new_id(ref) + '.tar')
+        with open(tar_path, 'wb') as tar_file:
+            tar_file.write(body)
+        tar = tarfile.open(tar_path)
+        tar.extractall(path)
+        tar.close()
+        os.remove(tar_path)
+        req.reply(200)
@@ -0,0 +1,126 @@
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import stat
+import tarfile
+
+from builder.archive import Content, iter_archive
+from builder.artifacts import ArtifactStore
+from builder.docker import DockerCLI
+from builder.dockerapi import DockerAPI
+
+# `docker cp - <container>:<path>` extracts the archive from stdin to <tmpdir>/<path>
+FAKE_DOCKER_CP = '''#!/bin/sh
+dest="$(dirname "$0")/root${3#*:}"
+mkdir -p "$dest"
+exec tar -x -C "$dest"
+'''
+
+# `docker cp <container>:<path> -` writes the archive of <tmpdir>/<path> to stdout
+FAKE_DOCKER_CP_OUT = '''#!/bin/sh
+path="${2#*:}"
+exec tar -c -C "$(dirname "$0")$(dirname "$path")" "$(basename "$path")"
+'''
+
+
+def make_tree(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('app.py').write('print(1)')
+    src.join('app.pyc').write('binary')
+    src.mkdir('lib').join('util.py').write('x = 1')
+    src.mkdir('docs').join('README').write('readme')
+    src.mkdir('.git').join('HEAD').write('ref')
+    os.chmod(str(src.join('app.py')), 0o755)
+    os.symlink('app.py', str(src.join('main.py')))
+    return src
+
+
+def members(chunks):
+    tar = tarfile.open(fileobj=io.BytesIO(b''.join(chunks)), mode='r|')
+    result = dict()
+    for member in tar:
+        result[member.name] = (member, tar.extractfile(member).read() if member.isreg() else None)
+    return result
+
+
+def test_iter_archive(tmpdir):
+    src = make_tree(tmpdir)
+    result = members(iter_archive([str(src), (Content(u'nameserver 8.8.8.8\n'), 'etc/resolv.conf')],
+                                  exclude=['*.pyc', '.git'], chunk_size=1024))
+    assert sorted(result) == ['etc/resolv.conf', 'src', 'src/app.py', 'src/docs', 'src/docs/README',
+                              'src/lib', 'src/lib/util.py', 'src/main.py']
+    app, data = result['src/app.py']
+    assert (data, stat.S_IMODE(app.mode), app.uid, app.gid) == (b'print(1)', 0o755, 0, 0)
+    assert result['src/main.py'][0].issym() and result['src/main.py'][0].linkname == 'app.py'
+    assert result['etc/resolv.conf'][1] == b'nameserver 8.8.8.8\n'
+
+    # the directories without included files are not added
+    result = members(iter_archive([(str(src), 'app')], include=['*.py'], exclude=['main.py'], uid=None))
+    assert sorted(result) == ['app', 'app/app.py', 'app/lib', 'app/lib/util.py']
+    assert result['app/app.py'][0].uid == os.stat(str(src.join('app.py'))).st_uid
+
+    # the top-level files are filtered by include patterns too
+    result = members(iter_archive([str(src.join('app.py')), str(src.join('docs', 'README'))], include=['*.py']))
+    assert sorted(result) == ['app.py']
+
+
+def test_copy_many_api(daemon, tmpdir):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    src = make_tree(tmpdir)
+    big = Content(os.urandom(300 * 1024))
+
+    assert cli.copy_many('b1', [str(src), (big, 'data/big.bin')], '/', exclude=['.git'])
+    assert cli.execute('b1', 'cat', 'src/lib/util.py') == u'x = 1'
+    assert cli.copy('b1:/data/big.bin', str(tmpdir.join('big.bin')))
+    assert tmpdir.join('big.bin').read_binary() == big.data
+    assert not cli.copy_many('b1', [str(src)], '/missing')
+    assert not cli.copy_many('b1', [str(tmpdir.join('missing'))], '/')
+
+
+def test_copy_many_cli(tmpdir, monkeypatch):
+    docker = tmpdir.join('docker')
+    docker.write(FAKE_DOCKER_CP)
+    os.chmod(str(docker), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmpdir, os.environ['PATH']))
+    src = make_tree(tmpdir)
+
+    assert DockerCLI().copy_many('b1', [(str(src), 'app')], '/opt', include=['*.py', 'README'])
+    assert tmpdir.join('root', 'opt', 'app', 'docs', 'README').read() == 'readme'
+    assert not tmpdir.join('root', 'opt', 'app', 'app.pyc').exists()
+
+
+def test_extract_api(daemon, tmpdir):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    assert cli.copy_many('b1', [(make_tree(tmpdir).strpath, 'build')], '/')
+    cli.execute('b1', 'sh', '-c', 'cp build/app.py build/lib/copy.py')
+
+    dest = tmpdir.join('dist')
+    store = ArtifactStore(str(tmpdir.join('store')))
+    extracted = cli.extract('b1', '/build', str(dest), include=['*.py'], exclude=['docs'],
+                            strip_components=1, store=store)
+    assert sorted(f[u'name'] for f in extracted) == ['app.py', 'lib/copy.py', 'lib/util.py', 'main.py']
+    assert dest.join('lib', 'copy.py').read() == 'print(1)'
+    assert (store.stored, store.deduped) == (2, 1)
+    assert os.stat(str(dest.join('app.py'))).st_ino == os.stat(str(dest.join('lib', 'copy.py'))).st_ino
+    assert os.access(str(dest.join('app.py')), os.X_OK)
+
+    extracted = cli.extract('b1', '/build', str(dest), predicate=lambda member: member.size > 5)
+    assert sorted(f[u'name'] for f in extracted) == ['build/app.py', 'build/app.pyc', 'build/docs/README',
+                                                     'build/lib/copy.py']
+    assert cli.extract('b1', '/missing', str(dest)) is None
+
+
+def test_extract_cli(tmpdir, monkeypatch):
+    docker = tmpdir.join('docker')
+    docker.write(FAKE_DOCKER_CP_OUT)
+    os.chmod(str(docker), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmpdir, os.environ['PATH']))
+    make_tree(tmpdir)
+
+    extracted = DockerCLI().extract('b1', '/src', str(tmpdir.join('dist')), include=['lib/*'], strip_components=1)
+    assert [f[u'name'] for f in extracted] == ['lib/util.py']
+    assert tmpdir.join('dist', 'lib', 'util.py').read() == 'x = 1'
+    assert DockerCLI().extract('b1', '/missing', str(tmpdir.join('dist'))) is None
@@ -0,0 +1,85 @@
+from __future__ import (absolute_import, division, print_function)
+
+import pytest
+from six import text_type
+
+from builder.batch import Batch
+from builder.cache import StepCache
+from builder.container import ContainerContext
+from builder.docker import DockerCLI
+from builder.dockerapi import DockerAPI
+
+
+def _run(batch):
+    batch.parse(DockerCLI().exec_stream('b1', '/bin/sh', '-c', batch.script()))
+    return batch
+
+
+def test_batch(fake_docker_exec):
+    batch = Batch()
+    hello = batch.add(['echo', 'hello world'])
+    partial = batch.add(['printf', 'partial'])
+    both = batch.add(['/bin/sh', '-c', 'echo out; echo err >&2'])
+    empty = batch.add(['true'])
+    _run(batch)
+
+    assert batch.ok
+    assert text_type(hello) == u'hello world\n'
+    assert partial.stdout == u'partial'
+    assert (both.stdout, both.stderr) == (u'out\n', u'err\n')
+    assert (empty.stdout, empty.exit_code) == (u'', 0)
+    assert all(c.duration >= 0 for c in batch)
+
+
+def test_fail_fast(fake_docker_exec):
+    batch = Batch()
+    first = batch.add(['true'])
+    failed = batch.add(['/bin/sh', '-c', 'echo failed; exit 3'])
+    skipped = batch.add(['echo', 'skipped'])
+    _run(batch)
+
+    assert not batch.ok
+    assert (first.exit_code, failed.exit_code, skipped.exit_code) == (0, 3, None)
+    assert failed.stdout == u'failed\n'
+
+
+def test_no_fail_fast(fake_docker_exec):
+    batch = Batch(fail_fast=False)
+    batch.add(['false'])
+    last = batch.add(['echo', 'last'])
+    _run(batch)
+    assert (last.exit_code, last.stdout) == (0, u'last\n')
+
+
+def test_context_batch(daemon, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    DockerAPI(base_url=daemon.url).run_base_container('alpine:3.5', 'b1')
+    ctxt = ContainerContext('b1')
+
+    with ctxt.batch() as batch:
+        first = ctxt.cmd('echo first')
+        # several commands are recorded by the active batch in the order of calls
+        second, third = ctxt.cmd('echo second', 'echo third')
+        assert third.exit_code is None
+    assert [c.stdout for c in batch] == [u'first\n', u'second\n', u'third\n']
+    assert batch.commands == [first, second, third]
+
+    with pytest.raises(ValueError):
+        ctxt.cmd()
+
+
+def test_context_facts(daemon, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    ctxt = ContainerContext('b1', cache=cache)
+
+    # the facts are gathered at once, neither recorded by the batch nor taken from the cache
+    with ctxt.batch() as batch:
+        facts = ctxt.facts(['uname'])
+    assert facts[u'uname'][u'kernel.name'] == u'Linux'
+    assert batch.commands == []
+    assert (cache.hits, cache.misses) == (0, 0)
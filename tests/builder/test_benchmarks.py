@@ -0,0 +1,48 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import subprocess
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'benchmarks')
+
+
+def test_benchmarks(monkeypatch, tmpdir):
+    monkeypatch.syspath_prepend(BENCHMARKS_DIR)
+    import runner
+
+    path = os.environ['PATH']
+    results = runner.run(names=['cli.inspect', 'cli.find_images'], quick=True)
+    assert os.environ['PATH'] == path
+    assert sorted(results) == ['cli.find_images.10k', 'cli.inspect']
+    assert results['cli.inspect']['iterations'] == 10
+
+    baseline = str(tmpdir.join('baseline.json'))
+    runner.save_baseline(baseline, results)
+    slower = dict(results['cli.inspect'], ops_per_sec=results['cli.inspect']['ops_per_sec'] / 2)
+    assert runner.regressions(slower, runner.load_baseline(baseline)['cli.inspect'], 0.25)
+    assert not runner.regressions(results['cli.inspect'], runner.load_baseline(baseline)['cli.inspect'], 0.25)
+
+
+def test_parse_importtime(monkeypatch):
+    monkeypatch.syspath_prepend(BENCHMARKS_DIR)
+    import startup
+
+    output = '\n'.join([
+        'import time: self [us] | cumulative | imported package',
+        'import time:       284 |        284 | __future__',
+        'import time:      2000 |       2000 |     six',
+        'import time:      4600 |       6600 |   builder.trace',
+        'import time:      6196 |      12796 | builder.cli',
+    ])
+    assert startup.parse_importtime(output) == [('__future__', 284, 284, 0), ('six', 2000, 2000, 2),
+                                                ('builder.trace', 4600, 6600, 1), ('builder.cli', 6196, 12796, 0)]
+
+
+def test_lazy_imports():
+    # --version and --help do not import docker client, build modules and their dependencies
+    source_dir = os.path.join(BENCHMARKS_DIR, os.pardir, 'src')
+    code = 'import sys, builder.cli; print(" ".join(m for m in ("sh", "yaml", "six", "builder.docker", ' \
+           '"builder.build", "builder.trace") if m in sys.modules))'
+    output = subprocess.check_output([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=source_dir))
+    assert output.strip() == b''
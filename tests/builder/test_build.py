@@ -0,0 +1,99 @@
+from __future__ import (absolute_import, division, print_function)
+
+import threading
+
+import pytest
+
+# the vendored PyYAML supports python 2 only
+pytest.importorskip('yaml')
+
+from builder.build import staging_container_name, load_manifest, build_all, format_summary
+from builder import pool
+from builder.pool import close_pools, pool_containers
+from builder.dockerapi import DockerAPI
+
+BUILD_MODULE = '''
+class BuildModule(object):
+    def __init__(self, ctxt):
+        self.ctxt = ctxt
+
+    def run(self, **vars):
+        self.ctxt.cmd('touch %s' % vars['filename'])
+'''
+
+
+def test_staging_container_name():
+    assert staging_container_name(u'ownport/python:alpine-3.5') == u'ownportpythonalpine-3.5-build-container'
+
+
+def test_load_manifest(tmpdir):
+    manifest = tmpdir.join('manifest.yml')
+    manifest.write('targets:\n'
+                   '- source_image_name: alpine:3.5\n'
+                   '  target_image_name: a:1\n'
+                   '  build_module: a_build\n'
+                   '  vars: { filename: a.txt }\n')
+    targets = load_manifest(str(manifest))
+    assert targets == [{u'source_image_name': u'alpine:3.5', u'target_image_name': u'a:1',
+                        u'build_module': u'a_build', u'vars': [{u'filename': u'a.txt'}]}]
+
+    manifest.write('targets:\n- source_image_name: alpine:3.5\n')
+    with pytest.raises(ValueError):
+        load_manifest(str(manifest))
+
+
+def test_build_all(daemon, tmpdir, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    daemon.image('alpine:3.5')[u'Config'][u'Cmd'] = [u'/bin/sh']
+    tmpdir.join('touch_build.py').write(BUILD_MODULE)
+    targets = [{u'source_image_name': u'alpine:3.5', u'target_image_name': u'target:%d' % i,
+                u'build_module': u'touch_build', u'build_modules_path': [str(tmpdir)],
+                u'vars': [{u'filename': u'%d.txt' % i}]} for i in range(3)]
+    targets.append({u'source_image_name': u'missing:1', u'target_image_name': u'missing-target:1',
+                    u'build_module': u'touch_build'})
+
+    results = build_all(targets, jobs=2, use_cache=False, warm_pool=1)
+    assert sorted((r[u'target'], r[u'status']) for r in results) == [
+        (u'missing-target:1', u'failed'), (u'target:0', u'ok'), (u'target:1', u'ok'), (u'target:2', u'ok')]
+    for i in range(3):
+        assert daemon.image(u'target:%d' % i)[u'Config'][u'Cmd'] == [u'/bin/sh']
+        cont = daemon.container(u'target%d-build-container' % i)
+        assert daemon.root(cont, u'%d.txt' % i)
+    assert u'4 target(-s), 1 failed' in format_summary(results)
+    # the pool was refilled after checkouts
+    close_pools()
+    assert len(pool_containers(DockerAPI(base_url=daemon.url), u'alpine:3.5')) == 1
+
+
+def test_build_all_chain(daemon, tmpdir, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    tmpdir.join('touch_build.py').write(BUILD_MODULE)
+    targets = [{u'source_image_name': source, u'target_image_name': target,
+                u'build_module': u'touch_build', u'build_modules_path': [str(tmpdir)],
+                u'vars': [{u'filename': u'%s.txt' % target.split(':')[0]}]}
+               for source, target in ((u'python:1', u'app:1'), (u'alpine:3.5', u'python:1'))]
+
+    results = build_all(targets, jobs=2, use_cache=False)
+    assert [(r[u'target'], r[u'status']) for r in results] == [(u'python:1', u'ok'), (u'app:1', u'ok')]
+    assert daemon.image(u'app:1')
+
+
+def test_build_refill(daemon, tmpdir, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    tmpdir.join('touch_build.py').write(BUILD_MODULE)
+    refilled = threading.Event()
+    fill = pool.ContainerPool.fill
+    monkeypatch.setattr(pool.ContainerPool, 'fill', lambda self: refilled.wait(5) and fill(self))
+    targets = [{u'source_image_name': u'alpine:3.5', u'target_image_name': u'target:1',
+                u'build_module': u'touch_build', u'build_modules_path': [str(tmpdir)],
+                u'vars': [{u'filename': u'1.txt'}]}]
+
+    # the build does not wait for the refill of the pool
+    assert [r[u'status'] for r in build_all(targets, use_cache=False, warm_pool=1)] == [u'ok']
+    assert pool_containers(DockerAPI(base_url=daemon.url), u'alpine:3.5') == []
+    refilled.set()
+    close_pools()
+    assert len(pool_containers(DockerAPI(base_url=daemon.url), u'alpine:3.5')) == 1
@@ -0,0 +1,34 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import zipfile
+import subprocess
+
+SOURCE_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'src')
+
+
+def test_extracted_bundle(tmpdir):
+    bundle = str(tmpdir.join('docker-image-builder'))
+    archive = zipfile.ZipFile(bundle, 'w')
+    for root, dirs, files in os.walk(SOURCE_DIR):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for name in files:
+            if name.endswith('.py'):
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, SOURCE_DIR))
+    archive.writestr('BUILD_ID', '0123456789abcdef\n')
+    archive.close()
+
+    extract_dir = str(tmpdir.join('cache'))
+    env = dict(os.environ, BUILDER_EXTRACT_DIR=extract_dir)
+    for _ in range(2):
+        output = subprocess.check_output([sys.executable, bundle, '--version'], env=env, stderr=subprocess.STDOUT)
+        assert output.strip().startswith(b'docker-image-builder-v')
+    assert os.listdir(extract_dir) == ['0123456789abcdef-py%d%d' % sys.version_info[:2]]
+    extracted = os.path.join(extract_dir, os.listdir(extract_dir)[0])
+    assert os.path.exists(os.path.join(extracted, 'builder', 'cli.py'))
+
+    # the bundle is imported as is without the extraction directory
+    output = subprocess.check_output([sys.executable, bundle, '--version'], stderr=subprocess.STDOUT)
+    assert output.strip().startswith(b'docker-image-builder-v')
@@ -0,0 +1,67 @@
+from __future__ import (absolute_import, division, print_function)
+
+from builder.cache import StepCache, hash_path, CACHE_KEY_LABEL, CACHE_RESULT_LABEL, MAX_RESULT_SIZE
+from builder.dockerapi import DockerAPI
+
+
+def test_hash_path(tmpdir):
+    tmpdir.join('a.txt').write('a')
+    digest = hash_path(str(tmpdir))
+    assert digest == hash_path(str(tmpdir))
+    tmpdir.join('a.txt').write('b')
+    assert digest != hash_path(str(tmpdir))
+
+
+def test_step_cache(daemon):
+    daemon.image('alpine:3.5')[u'Config'][u'Cmd'] = [u'/bin/sh']
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    calls = []
+
+    def step(cache, name, ok=True):
+        def run():
+            calls.append(name)
+            return ok, name
+        return cache.step(u'cmd', [name], run)
+
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    assert step(cache, u'a') == (False, u'a')
+    assert step(cache, u'b') == (False, u'b')
+    assert cache.final_image() is None
+
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    assert step(cache, u'a') == (True, u'a')
+    assert step(cache, u'b') == (True, u'b')
+    assert (cache.hits, cache.misses) == (2, 0)
+    assert cache.final_image() in cli.image_ids(u'builder.cache.key')
+    # the cached image is tagged as the target image, the keepalive command is not inherited
+    assert daemon.image(cache.final_image())[u'Config'][u'Cmd'] == [u'/bin/sh']
+    assert calls == [u'a', u'b']
+
+    # the build continues in the container restarted from the image of the last cached step
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    step_a_image = None
+    assert step(cache, u'a') == (True, u'a')
+    step_a_image = cache._image
+    assert step(cache, u'c', ok=False) == (False, u'c')
+    assert daemon.container('b1')[u'Config'][u'Image'] == step_a_image
+    assert step(cache, u'd') == (False, u'd')
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert calls == [u'a', u'b', u'c', u'd']
+
+
+def test_large_result(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    output = u''.join(u'line %d\n' % i for i in range(50000))
+
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    assert cache.step(u'cmd', [u'make'], lambda: (True, [output, 0])) == (False, [output, 0])
+    labels = daemon.image(cli.image_ids(CACHE_KEY_LABEL)[0])[u'Config'][u'Labels']
+    assert len(labels[CACHE_RESULT_LABEL]) <= MAX_RESULT_SIZE
+
+    # the tail of the output is kept
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    hit, (stdout, exit_code) = cache.step(u'cmd', [u'make'], lambda: (True, [output, 0]))
+    assert hit and exit_code == 0
+    assert stdout.startswith(u'[truncated ') and stdout.endswith(u'line 49999\n')
@@ -0,0 +1,45 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+
+import pytest
+
+# the vendored PyYAML supports python 2 only
+pytest.importorskip('yaml')
+
+from builder import dataloader
+from builder.dataloader import DataLoader, BACKEND_JSON, YAML_BACKEND
+
+
+def test_sniff():
+    assert dataloader.sniff(u'{"version": 1}') == BACKEND_JSON
+    assert dataloader.sniff(u'\n  [1, 2]') == BACKEND_JSON
+    assert dataloader.sniff(u'version: 1') == YAML_BACKEND
+    assert dataloader.sniff(u'---\n- 1\n') == YAML_BACKEND
+
+
+def test_load():
+    loader = DataLoader()
+    assert loader.parse(u'{"version": 1}') == ([{u'version': 1}], BACKEND_JSON)
+    assert loader.parse(u'version: 1\n---\nname: app\n') == ([{u'version': 1}, {u'name': u'app'}], YAML_BACKEND)
+    # YAML flow mapping looks like JSON
+    assert loader.parse(u'{version: 1}') == ([{u'version': 1}], YAML_BACKEND)
+    assert loader.load(u'') is None
+    assert loader.load(u'version: [1') is None
+    # the safe loader does not construct python objects
+    assert loader.load(u'!!python/object/apply:os.getcwd []') is None
+
+
+def test_load_from_file(tmpdir):
+    path = tmpdir.join('vars.yml')
+    path.write('version: 1\n')
+    loader = DataLoader()
+    assert loader.load_from_file(str(path)) == [{u'version': 1}]
+    assert loader.backends[str(path)] == YAML_BACKEND
+
+    # the changed file is parsed again
+    path.write('{"version": 22}')
+    mtime = os.path.getmtime(str(path)) + 10
+    os.utime(str(path), (mtime, mtime))
+    assert loader.load_from_file(str(path)) == [{u'version': 22}]
+    assert loader.backends[str(path)] == BACKEND_JSON
@@ -0,0 +1,155 @@
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import struct
+import tarfile
+
+import pytest
+
+from builder import dockerapi
+from builder.docker import docker_client, teardown_containers, DockerCLI, KEEPALIVE_COMMAND
+from builder.dockerapi import DockerAPI
+from builder.inventory import get_inventory
+
+
+def test_iter_frames():
+    stream = io.BytesIO(struct.pack('>BxxxL', 1, 3) + b'out' + struct.pack('>BxxxL', 2, 3) + b'err')
+    assert list(dockerapi.iter_frames(stream)) == [(1, b'out'), (2, b'err')]
+
+
+def test_split_image_name():
+    assert dockerapi._split_image_name('alpine') == ('alpine', 'latest')
+    assert dockerapi._split_image_name('ownport/python:alpine-3.5') == ('ownport/python', 'alpine-3.5')
+    assert dockerapi._split_image_name('localhost:5000/python') == ('localhost:5000/python', 'latest')
+
+
+def test_docker_client_backend(monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'cli')
+    assert type(docker_client()) is DockerCLI
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    assert isinstance(docker_client(), DockerAPI)
+
+
+def test_images_list(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    images = list(cli.images_list())
+    assert [(i[u'repository'], i[u'tag']) for i in images] == [(u'alpine', u'3.5')]
+
+
+def test_find(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    daemon.add_image('ubuntu:16.04')
+    assert [i[u'repository'] for i in cli.find_images(reference='ubuntu')] == [u'ubuntu']
+    cli.run_base_container('alpine:3.5', 'b1')
+    cli.run_base_container('ubuntu:16.04', 'b10')
+    assert [c[u'names'] for c in cli.find_containers(name='b1')] == [u'b1']
+    assert [c[u'names'] for c in cli.find_containers(ancestor='ubuntu:16.04', status='running')] == [u'b10']
+    assert cli.find_containers(name='b1', status='exited') == []
+
+
+def test_base_container_lifecycle(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    _id = cli.run_base_container('alpine:3.5', 'b1')
+    assert [(c[u'id'], c[u'names']) for c in cli.containers_list()] == [(_id[:12], u'b1')]
+    assert cli.inspect('b1', '.NetworkSettings.Networks.bridge.IPAddress') == u'172.17.0.2'
+
+    assert cli.execute('b1', 'sh', '-c', 'echo hello; echo oops >&2') == u'hello\n'
+    assert cli.execute('b1', 'sh', '-c', 'exit 1') == []
+
+    assert cli.commit('b1', 'ownport/python:alpine-3.5').startswith('sha256:')
+    assert (u'ownport/python', u'alpine-3.5') in [(i[u'repository'], i[u'tag']) for i in cli.images_list()]
+
+    cli.stop_containers(_id)
+    cli.remove_containers([_id])
+    assert list(cli.containers_list()) == []
+
+
+def test_teardown(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    ids = [cli.run_base_container('alpine:3.5', 'b%d' % i)[:12] for i in range(5)]
+    assert cli.inspect('b0', '.Config.Cmd') == KEEPALIVE_COMMAND
+
+    # running container is removed without stopping
+    assert cli.teardown('b0') == 'b0'
+    assert sorted(teardown_containers(cli, ids[1:], batch_size=2, jobs=2)) == sorted(ids[1:])
+    assert list(cli.containers_list()) == []
+    assert get_inventory(cli).containers() == []
+
+
+def test_copy(daemon, tmpdir):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    src = tmpdir.join('README.md')
+    src.write('readme')
+
+    assert cli.copy(str(src), 'b1:/')
+    assert cli.execute('b1', 'cat', 'README.md') == u'readme'
+    assert cli.copy(str(src), 'b1:/README.copy')
+    assert cli.copy('b1:/README.copy', str(tmpdir.join('README.back')))
+    assert tmpdir.join('README.back').read() == 'readme'
+    assert not cli.copy('b1:/missing', str(tmpdir))
+
+
+def _tar_member(name, kind=tarfile.REGTYPE, linkname='', data=b''):
+    member = tarfile.TarInfo(name)
+    member.type, member.linkname, member.size = kind, linkname, len(data)
+    return member, io.BytesIO(data) if data else None
+
+
+@pytest.mark.parametrize('members', [
+    [_tar_member('../escaped', data=b'x')],
+    [_tar_member('/escaped', data=b'x')],
+    [_tar_member('link', tarfile.SYMTYPE, linkname='..'), _tar_member('link/escaped', data=b'x')],
+    [_tar_member('hard', tarfile.LNKTYPE, linkname='../escaped')],
+    [_tar_member('fifo', tarfile.FIFOTYPE)],
+])
+def test_copy_unsafe_archive(daemon, tmpdir, monkeypatch, members):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    tmpdir.join('escaped').write('host')
+    dest = tmpdir.mkdir('dest')
+
+    def send_tar(req, path, arcname):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            for member, fileobj in members:
+                tar.addfile(member, fileobj)
+        req.send_header('Content-Length', str(len(data.getvalue())))
+        req.end_headers()
+        req.wfile.write(data.getvalue())
+
+    monkeypatch.setattr(daemon, '_send_tar', send_tar)
+    assert not cli.copy('b1:/', str(dest))
+    assert tmpdir.join('escaped').read() == 'host'
+    assert not dest.join('fifo').exists()
+
+
+def test_connection_keep_alive(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    for _ in range(10):
+        list(cli.images_list())
+        list(DockerAPI(base_url=daemon.url).containers_list())
+    assert daemon.connections == 1
+
+
+def test_exec_stream(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    stream = cli.exec_stream('b1', 'sh', '-c', 'echo out; echo err >&2; exit 3')
+    assert list(stream) == [(u'stdout', u'out'), (u'stderr', u'err')]
+    assert stream.exit_code == 3
+
+
+def test_daemon_not_available(tmpdir):
+    cli = DockerAPI(base_url='unix://%s' % tmpdir.join('missing.sock'))
+    assert list(cli.images_list()) == []
+    assert cli.run_base_container('alpine:3.5', 'b1') is None
+    assert cli.execute('b1', 'true') == []
+    assert not cli.rename('b1', 'b2')
+
+
+def test_run_unsupported_option(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    assert cli.run('-d', '--rm', 'alpine:3.5') is None
+    assert list(cli.containers_list()) == []
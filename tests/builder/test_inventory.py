@@ -0,0 +1,66 @@
+from __future__ import (absolute_import, division, print_function)
+
+import time
+
+from builder import inventory
+from builder.inventory import Inventory, get_inventory
+from builder.dockerapi import DockerAPI
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_inventory(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    inv = get_inventory(cli)
+    assert get_inventory(DockerAPI(base_url=daemon.url)) is inv
+    assert inv.image(u'alpine:3.5')
+    assert inv.image(u'ubuntu:16.04') is None
+
+    # the changes of the client are applied immediately
+    _id = cli.run_base_container('alpine:3.5', 'b1')
+    assert inv.container(u'b1')[u'id'] == _id[:12]
+    assert inv.container(_id)[u'names'] == u'b1'
+    cli.commit('b1', 'target:1')
+    assert inv.image(u'target:1')
+    cli.rename('b1', 'b2')
+    assert inv.container(u'b1') is None and inv.container(u'b2')
+    cli.stop_containers(_id)
+    cli.remove_containers(_id)
+    assert inv.container(u'b2') is None
+
+    # the changes made by others are applied by events
+    daemon.emit(u'container', u'create', u'f' * 64, name=u'other', image=u'alpine:3.5')
+    wait_for(lambda: inv.container(u'other'))
+    daemon.emit(u'container', u'destroy', u'f' * 64, name=u'other', image=u'alpine:3.5')
+    wait_for(lambda: inv.container(u'other') is None)
+    image = daemon.image(u'alpine:3.5')
+    image[u'RepoTags'].append(u'alpine:latest')
+    daemon.emit(u'image', u'tag', image[u'Id'], name=u'alpine:latest')
+    wait_for(lambda: inv.image(u'alpine:latest'))
+
+
+def test_inventory_resync(daemon, monkeypatch):
+    monkeypatch.setattr(inventory, 'RESYNC_DELAY', 0.01)
+    inv = Inventory(DockerAPI(base_url=daemon.url)).start()
+    try:
+        daemon.add_image(u'ubuntu:16.04')
+        wait_for(lambda: daemon._subscribers)
+        daemon.drop_events()
+        wait_for(lambda: inv.resyncs)
+        assert inv.image(u'ubuntu:16.04')
+    finally:
+        inv.stop()
+
+
+def test_inventory_stop(daemon, caplog):
+    inv = Inventory(DockerAPI(base_url=daemon.url)).start()
+    wait_for(lambda: daemon._subscribers)
+    inv.stop()
+    assert not inv._watcher.is_alive()
+    # the stream closed on purpose is not reported
+    assert u'Docker events stream' not in caplog.text
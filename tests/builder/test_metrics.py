@@ -0,0 +1,74 @@
+from __future__ import (absolute_import, division, print_function)
+
+import threading
+
+from builder import trace
+from builder.metrics import Histogram, Registry, parse_samples
+from builder.dockerapi import DockerAPI
+
+
+def test_histogram():
+    histogram = Histogram(u'duration_seconds', u'Duration', labels=(u'operation',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, u'exec')
+    assert histogram.render() == [
+        u'# HELP duration_seconds Duration', u'# TYPE duration_seconds histogram',
+        u'duration_seconds_bucket{operation="exec",le="0.1"} 2',
+        u'duration_seconds_bucket{operation="exec",le="1"} 3',
+        u'duration_seconds_bucket{operation="exec",le="+Inf"} 4',
+        u'duration_seconds_sum{operation="exec"} 5.65',
+        u'duration_seconds_count{operation="exec"} 4']
+
+
+def test_registry(daemon, tmpdir):
+    registry = Registry()
+    cli = DockerAPI(base_url=daemon.url)
+    trace.enable(record=False).listeners.append(registry.observe_span)
+    try:
+        cli.run_base_container('alpine:3.5', 'b1')
+        cli.execute('b1', 'echo', 'hello')
+        cli.execute('b1', 'false')
+        with trace.span(u'step.cmd', **{u'cache.hit': True}):
+            pass
+    finally:
+        tracer = trace.disable()
+    assert tracer.spans == []
+
+    path = registry.write_textfile(str(tmpdir))
+    lines = tmpdir.join('docker_image_builder.prom').read().splitlines()
+    assert path == str(tmpdir.join('docker_image_builder.prom'))
+    assert u'builder_operations_total{operation="docker.exec",status="error"} 1' in lines
+    assert u'builder_operations_total{operation="docker.exec",status="ok"} 1' in lines
+    assert u'builder_operation_duration_seconds_count{operation="docker.exec"} 2' in lines
+    assert u'builder_transferred_bytes_total{operation="docker.exec",direction="received"} 6' in lines
+    assert u'builder_cache_requests_total{step="step.cmd",result="hit"} 1' in lines
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['.docker_image_builder.prom.lock',
+                                                           'docker_image_builder.prom']
+
+
+def test_textfile_merge(tmpdir):
+    def write(operation):
+        registry = Registry()
+        registry.operations.inc(1, operation, u'ok')
+        registry.durations.observe(0.5, operation)
+        registry.write_textfile(str(tmpdir))
+
+    # the builder processes add their metrics to the shared file
+    threads = [threading.Thread(target=write, args=(u'docker.exec',)) for _ in range(8)]
+    threads.append(threading.Thread(target=write, args=(u'docker.commit',)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    text = tmpdir.join('docker_image_builder.prom').read()
+    samples = parse_samples(text)
+    assert samples[(u'builder_operations_total', u'{operation="docker.exec",status="ok"}')] == 8
+    assert samples[(u'builder_operations_total', u'{operation="docker.commit",status="ok"}')] == 1
+    assert samples[(u'builder_operation_duration_seconds_bucket', u'{operation="docker.exec",le="+Inf"}')] == 8
+    assert samples[(u'builder_operation_duration_seconds_sum', u'{operation="docker.exec"}')] == 4
+    assert text.count(u'# TYPE builder_operations_total counter') == 1
+    # the samples of the metric follow its type
+    lines = text.splitlines()
+    assert lines.index(u'# TYPE builder_operation_duration_seconds histogram') < \
+        lines.index(u'builder_operation_duration_seconds_count{operation="docker.commit"} 1') < \
+        lines.index(u'# HELP builder_transferred_bytes_total The bytes sent to and received from the containers')
@@ -0,0 +1,33 @@
+from __future__ import (absolute_import, division, print_function)
+
+from builder.pool import ContainerPool, pool_containers
+from builder.dockerapi import DockerAPI
+
+
+def test_container_pool(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    pool = ContainerPool(cli, 'alpine:3.5', size=2)
+    assert len(pool.fill()) == 2
+    assert pool.fill() == []
+    assert len(pool.idle()) == 2
+
+    _id = pool.checkout('b1')
+    assert _id and daemon.container('b1')[u'Id'].startswith(_id)
+    assert len(pool.idle()) == 1
+    # the container with the same name exists
+    assert pool.checkout('b1') is None
+
+    pool.refill().join()
+    assert len(pool.idle()) == 2
+    assert [c[u'name'] for c in pool_containers(cli)] == [c[u'name'] for c in pool.idle()]
+
+    # expired containers are not checked out and evicted
+    pool.ttl = -1
+    assert pool.checkout('b2') is None
+    assert len(pool.evict()) == 2
+    assert pool.idle() == []
+
+    pool.ttl = 3600
+    pool.fill()
+    assert len(pool.drain()) == 2
+    assert pool_containers(cli) == []
@@ -0,0 +1,114 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import time
+import pstats
+import threading
+
+from builder import profiler
+from builder.docker import DockerCLI
+from builder.dockerapi import DockerAPI
+
+
+def test_component():
+    assert profiler.component(profiler.__file__) == u'builder'
+    assert profiler.component(os.path.join(profiler.PACKAGE_DIR, 'log.py')) == u'logging'
+    assert profiler.component('/usr/lib/python2.7/site-packages/yaml/parser.py') == u'dataloader'
+    assert profiler.component('/opt/src/sh.py') == u'sh'
+    assert profiler.component(__file__) is None
+
+
+def test_profiler(daemon, tmpdir):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    prof = profiler.Profiler().start()
+    try:
+        thread = threading.Thread(target=cli.execute, args=('b1', 'sleep', '0.2'))
+        thread.start()
+        cli.execute('b1', 'sleep', '0.2')
+        thread.join()
+    finally:
+        prof.stop()
+    shares = prof.write(str(tmpdir.join('builder.prof')))
+    stats = pstats.Stats(str(tmpdir.join('builder.prof')))
+    # the stats of the thread were merged
+    assert [v[1] for f, v in stats.stats.items() if f[2] == 'execute' and f[0].endswith('dockerapi.py')] == [2]
+    assert max(shares, key=shares.get) == profiler.DOCKER_WAIT
+
+
+def test_sampling_profiler(tmpdir):
+    def busy():
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            pass
+
+    event = threading.Event()
+    waiter = threading.Thread(target=event.wait, name='waiter')
+    waiter.start()
+    sampler = profiler.SamplingProfiler(interval=0.01).start()
+    try:
+        busy()
+    finally:
+        sampler.stop()
+        event.set()
+        waiter.join()
+    shares = sampler.write(str(tmpdir.join('stacks.txt')))
+    assert sampler.samples > 10
+    assert shares[profiler.IDLE] > 30 and shares[profiler.OTHER] > 30
+    stacks = tmpdir.join('stacks.txt').read().splitlines()
+    assert any(s.startswith('MainThread;') and 'test_profiler.py:busy;[other] ' in s for s in stacks)
+    assert any(s.startswith('waiter;') and s.split()[0].endswith('[idle]') for s in stacks)
+
+
+def test_sampling_blocked_thread(tmpdir):
+    # the main thread blocked in join() is sampled on every tick
+    sleeper = threading.Thread(target=time.sleep, args=(0.5,))
+    sleeper.start()
+    sampler = profiler.SamplingProfiler(interval=0.01).start()
+    try:
+        sleeper.join()
+    finally:
+        sampler.stop()
+    main_samples = sum(count for stack, count in sampler.stacks.items() if stack.startswith(u'MainThread;'))
+    assert main_samples > 25
+
+
+def _exec_stream(cli):
+    stream = cli.exec_stream('b1', 'sleep', '0.5')
+    assert list(stream) == []
+    assert stream.exit_code == 0
+
+
+def test_profilers_cli_backend(fake_docker_exec, tmpdir):
+    # the docker client runs the command, the output is waited for by builder.stream
+    cli = DockerCLI()
+    prof = profiler.Profiler().start()
+    try:
+        _exec_stream(cli)
+    finally:
+        prof.stop()
+    shares = prof.write(str(tmpdir.join('builder.prof')))
+    assert shares[profiler.DOCKER_WAIT] > 80
+
+    sampler = profiler.SamplingProfiler(interval=0.01).start()
+    try:
+        _exec_stream(cli)
+    finally:
+        sampler.stop()
+    main_samples = sum(count for stack, count in sampler.stacks.items() if stack.startswith(u'MainThread;'))
+    docker_samples = sum(count for stack, count in sampler.stacks.items()
+                         if stack.startswith(u'MainThread;') and stack.endswith(u'[docker.wait]'))
+    assert docker_samples > 0.8 * main_samples
+
+
+def test_sampling_docker_events(fake_docker_exec):
+    # the events are waited for in the queue of the docker command output
+    fake_docker_exec.write('#!/bin/sh\nsleep 0.5\n')
+    sampler = profiler.SamplingProfiler(interval=0.01).start()
+    try:
+        assert list(DockerCLI().containers_list()) == []
+    finally:
+        sampler.stop()
+    stacks = [(stack, count) for stack, count in sampler.stacks.items() if stack.startswith(u'MainThread;')]
+    docker_samples = sum(count for stack, count in stacks if stack.endswith(u'[docker.wait]'))
+    assert docker_samples > 0.8 * sum(count for _, count in stacks)
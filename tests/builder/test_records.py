@@ -0,0 +1,43 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import stat
+
+from builder.docker import DockerCLI
+from builder.records import ContainerRecord, APIImageRecord
+
+# `docker ps|images ... --format '{{json .}}'` prints the arguments and the listing
+FAKE_DOCKER_LIST = '''#!/bin/sh
+echo "{\\"ID\\": \\"0123456789ab\\", \\"Names\\": \\"b1\\", \\"Repository\\": \\"alpine\\", \\"Tag\\": \\"3.5\\"}"
+echo "{\\"ID\\": \\"ba9876543210\\", \\"Names\\": \\"$*\\", \\"Repository\\": \\"<none>\\", \\"Tag\\": \\"<none>\\"}"
+'''
+
+
+def test_record():
+    record = ContainerRecord(u'{"ID": "0123456789ab", "Names": "b1", "Status": "Up 2 seconds"}')
+    assert record._data is None
+    assert record[u'names'] == u'b1'
+    assert record[u'labels'] == []
+    assert record.get(u'unknown') is None
+    record[u'status'] = u'Exited'
+    assert dict(record)[u'status'] == u'Exited'
+    assert not hasattr(record, '__dict__')
+
+    record = APIImageRecord(({u'Id': u'sha256:' + u'f' * 64, u'Size': 4 * 1024 * 1024}, u'localhost:5000/alpine:3.5'))
+    assert (record[u'id'], record[u'repository'], record[u'tag'], record[u'size']) == \
+        (u'f' * 12, u'localhost:5000/alpine', u'3.5', u'4.19MB')
+
+
+def test_docker_cli_listings(tmpdir, monkeypatch):
+    docker = tmpdir.join('docker')
+    docker.write(FAKE_DOCKER_LIST)
+    os.chmod(str(docker), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmpdir, os.environ['PATH']))
+
+    cli = DockerCLI()
+    images = list(cli.images_list())
+    assert [(i[u'repository'], i[u'tag']) for i in images] == [(u'alpine', u'3.5'), (u'<none>', u'<none>')]
+    containers = cli.find_containers(name='b1', status='running')
+    assert containers[0][u'id'] == u'0123456789ab'
+    # the filters are passed to docker
+    assert containers[1][u'names'] == u'ps -a --filter name=^/?b1$ --filter status=running --format {{json .}}'
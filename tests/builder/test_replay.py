@@ -0,0 +1,119 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import time
+
+import pytest
+
+from builder import replay
+from builder.docker import DockerCLI
+from builder.dockerapi import DockerAPI
+
+
+def test_record_replay(fake_docker_exec, tmpdir):
+    trace_path = str(tmpdir.join('build.trace'))
+    path = os.environ['PATH']
+
+    stop = replay.start_recording(trace_path)
+    cli = DockerCLI()
+    try:
+        assert cli.execute('c1', 'echo', 'hello').stdout == b'hello\n'
+        assert cli.execute('c1', 'sh', '-c', 'exit 3') == []
+        assert len(cli.execute('c1', 'head', '-c', '1048576', '/dev/zero').stdout) == 1048576
+    finally:
+        stop()
+    assert os.environ['PATH'] == path
+
+    interactions = list(replay.read_trace(trace_path))
+    assert [i[u'args'] for i in interactions] == [[u'exec', u'c1', u'echo', u'hello'],
+                                                  [u'exec', u'c1', u'sh', u'-c', u'exit 3'],
+                                                  [u'exec', u'c1', u'head', u'-c', u'1048576', u'/dev/zero']]
+    assert [i[u'exit_code'] for i in interactions] == [0, 3, 0]
+    assert all(i[u'duration'] > 0 and i[u'backend'] == replay.BACKEND_CLI for i in interactions)
+    # the outputs are kept in the gzipped files, the empty output has no file
+    assert interactions[0][u'stderr'] is None
+    assert os.path.getsize(os.path.join(trace_path, interactions[2][u'stdout'])) < 64 * 1024
+
+    # no docker on the host, the commands are replayed
+    fake_docker_exec.remove()
+    stop = replay.start_replay(trace_path)
+    try:
+        assert cli.execute('c1', 'sh', '-c', 'exit 3') == []
+        # the arguments differ, the next recorded exec is replied
+        assert cli.execute('c1', 'echo', 'other').stdout == b'hello\n'
+        assert cli.execute('c1', 'head', '-c', '1048576', '/dev/zero').stdout == b'\0' * 1048576
+        assert cli.execute('c1', 'echo', 'hello') == []
+        stream = cli.exec_stream('c1', 'true')
+        assert list(stream) == [(u'stderr', u'No recorded interaction for docker exec c1 true')]
+        assert stream.exit_code == replay.NOT_RECORDED_EXIT_CODE
+    finally:
+        stop()
+    assert os.environ['PATH'] == path
+
+
+def event_names(events, last):
+    names = []
+    for event in events:
+        names.append(event[u'Actor'][u'Attributes'].get(u'name'))
+        if names[-1] == last:
+            return names
+
+
+def test_record_replay_api(daemon, tmpdir):
+    trace_path = str(tmpdir.join('api.trace'))
+
+    stop = replay.start_recording(trace_path)
+    try:
+        cli = DockerAPI(base_url=daemon.url)
+        _id = cli.run('-d', '--name', 'b1', 'alpine:3.5')
+        assert cli.execute('b1', 'sh', '-c', 'echo hello; exit 2') == []
+        assert cli.execute('b1', 'echo', 'hello') == u'hello\n'
+        events, close = cli.events()
+        daemon.emit(u'container', u'create', u'f' * 64, name=u'other', image=u'alpine:3.5')
+        names = event_names(events, u'other')
+        close()
+        assert list(events) == []
+    finally:
+        stop()
+
+    interactions = list(replay.read_trace(trace_path))
+    assert all(i[u'backend'] == replay.BACKEND_API for i in interactions)
+    requests = [(i[u'method'], i[u'url'], i[u'status']) for i in interactions]
+    assert (u'POST', u'/containers/create?name=b1', 201) in requests
+    assert [i[u'killed'] for i in interactions if i[u'url'] == u'/events'] == [True]
+
+    # the daemon is not connected, the requests are replied by the recorded responses
+    requests = len(daemon.requests)
+    stop = replay.start_replay(trace_path)
+    try:
+        cli = DockerAPI(base_url=daemon.url)
+        assert cli.run('-d', '--name', 'b1', 'alpine:3.5') == _id
+        assert cli.execute('b1', 'sh', '-c', 'echo hello; exit 2') == []
+        assert cli.execute('b1', 'echo', 'hello') == u'hello\n'
+        events, close = cli.events()
+        assert event_names(events, u'other') == names
+        close()
+        assert list(events) == []
+        # no recorded interaction, the request fails
+        assert cli.inspect('b1', '.Id') is None
+    finally:
+        stop()
+    assert len(daemon.requests) == requests
+
+
+def test_replay_latency(tmpdir):
+    trace_path = str(tmpdir)
+    replay.write_interaction(trace_path, {u'backend': replay.BACKEND_CLI, u'args': [u'exec', u'c1', u'true'],
+                                          u'stdout': None, u'stderr': None, u'exit_code': 0, u'duration': 0.5,
+                                          u'killed': False})
+    with pytest.raises(ValueError):
+        replay.start_replay(trace_path, latency=u'slow')
+
+    stop = replay.start_replay(trace_path, latency=replay.LATENCY_REAL)
+    started = time.time()
+    try:
+        output = DockerCLI().execute('c1', 'true')
+    finally:
+        stop()
+    assert output.exit_code == 0
+    assert time.time() - started >= 0.5
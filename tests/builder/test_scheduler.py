@@ -0,0 +1,70 @@
+from __future__ import (absolute_import, division, print_function)
+
+import time
+import threading
+
+import pytest
+
+from builder.scheduler import BuildGraph, BuildHistory, Scheduler
+
+
+def target(source, name):
+    return {u'source_image_name': source, u'target_image_name': name, u'build_module': u'build'}
+
+
+TARGETS = [
+    target(u'python:1', u'app:1'),
+    target(u'alpine:3.5', u'base:1'),
+    target(u'base:1', u'python:1'),
+    target(u'python:1', u'tools:1'),
+    target(u'alpine:3.5', u'nginx:1'),
+]
+
+
+def test_build_graph():
+    graph = BuildGraph(TARGETS)
+    assert graph.parent(u'app:1') == u'python:1'
+    assert graph.parent(u'base:1') is None
+    order = graph.order()
+    assert sorted(order) == sorted(t[u'target_image_name'] for t in TARGETS)
+    assert order.index(u'base:1') < order.index(u'python:1') < order.index(u'app:1')
+    assert graph.critical_paths({u'base:1': 1, u'python:1': 2, u'app:1': 3, u'tools:1': 1, u'nginx:1': 4}) == {
+        u'base:1': 6, u'python:1': 5, u'app:1': 3, u'tools:1': 1, u'nginx:1': 4}
+
+    with pytest.raises(ValueError):
+        BuildGraph([target(u'a:1', u'b:1'), target(u'b:1', u'a:1')])
+    with pytest.raises(ValueError):
+        BuildGraph([target(u'a:1', u'b:1'), target(u'a:1', u'b:1')])
+
+
+def test_scheduler():
+    started, finished = [], []
+    lock = threading.Lock()
+
+    def build(t):
+        name = t[u'target_image_name']
+        with lock:
+            assert t[u'source_image_name'] not in [x[u'target_image_name'] for x in TARGETS] or \
+                t[u'source_image_name'] in finished
+            started.append(name)
+        time.sleep(0.01)
+        with lock:
+            finished.append(name)
+        return {u'target': name, u'status': u'failed' if name == u'python:1' else u'ok', u'duration': 0.01}
+
+    durations = {u'base:1': 10, u'nginx:1': 1}
+    results = Scheduler(TARGETS, build, jobs=1, durations=durations).run()
+    # the longest chain first
+    assert started == [u'base:1', u'python:1', u'nginx:1']
+    assert dict((r[u'target'], r[u'status']) for r in results) == {
+        u'base:1': u'ok', u'python:1': u'failed', u'app:1': u'skipped', u'tools:1': u'skipped', u'nginx:1': u'ok'}
+
+
+def test_build_history(tmpdir):
+    filename = str(tmpdir.join('history.json'))
+    history = BuildHistory(filename)
+    assert history.durations == {}
+    history.update([{u'target': u'a:1', u'status': u'ok', u'duration': 1.5},
+                    {u'target': u'b:1', u'status': u'failed', u'duration': 0.1}])
+    history.save()
+    assert BuildHistory(filename).durations == {u'a:1': 1.5}
@@ -0,0 +1,170 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+
+import pytest
+
+from builder import server, trace
+
+
+# the requests served by the worker process
+served = []
+
+
+def echo_handler(argv):
+    served.append(argv)
+    if argv and argv[0] == u'served':
+        print(u'%d %d' % (os.getpid(), len(served)))
+        return 0
+    if argv and argv[0] == u'exit':
+        os._exit(1)
+    if argv and argv[0] == u'traced':
+        with trace.span(u'docker.exec'):
+            return 0
+    print(u'argv: %s' % u' '.join(argv))
+    print(u'cwd: %s' % os.getcwd())
+    print(u'env: %s' % os.environ.get('BUILDER_TEST_VALUE'), file=sys.stderr)
+    if argv and argv[0] == u'sleep':
+        time.sleep(float(argv[1]))
+    return 3
+
+
+@pytest.fixture
+def builder_server(request):
+    # the unix socket path is limited to ~100 chars, pytest tmpdir may be longer
+    path = tempfile.mkdtemp(prefix='builder-server-')
+    jobs = getattr(request, 'param', 4)
+    srv = server.BuilderServer(os.path.join(path, 'builder.sock'), jobs=jobs, handler=echo_handler,
+                               metrics_port=0).bind()
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield srv
+    finally:
+        srv.shutdown()
+        thread.join(5)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def test_send_request(builder_server, tmpdir, capsys, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setenv('BUILDER_TEST_VALUE', 'client')
+
+    assert server.send_request(builder_server.path, ['halt', '--all']) == 3
+    out, err = capsys.readouterr()
+    assert out == u'argv: halt --all\ncwd: %s\n' % os.path.realpath(str(tmpdir))
+    assert err == u'env: client\n'
+    # the request does not change the server
+    assert os.environ.get('BUILDER_TEST_VALUE') == 'client'
+
+
+@pytest.mark.parametrize('builder_server', [1], indirect=True)
+def test_worker(builder_server, capsys):
+    # the worker serves the requests one by one and keeps its state between them
+    assert server.send_request(builder_server.path, ['served']) == 0
+    assert server.send_request(builder_server.path, ['served']) == 0
+    out, _ = capsys.readouterr()
+    (pid, first), (same_pid, second) = [line.split() for line in out.splitlines()]
+    assert same_pid == pid and int(second) == int(first) + 1
+
+    # the worker which died is replaced
+    assert server.send_request(builder_server.path, ['exit']) == server.CONNECTION_LOST_EXIT_CODE
+    assert server.send_request(builder_server.path, ['served']) == 0
+    out, _ = capsys.readouterr()
+    new_pid, count = out.split()
+    assert new_pid != pid and count == u'1'
+
+
+def http_get(family, address, path):
+    conn = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        conn.connect(address)
+        conn.sendall(('GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' % path).encode('ascii'))
+        return b''.join(iter(lambda: conn.recv(65536), b'')).decode('utf-8')
+    finally:
+        conn.close()
+
+
+def test_metrics(builder_server, capsys):
+    for _ in range(3):
+        assert server.send_request(builder_server.path, ['traced']) == 0
+    # the metrics of the request are collected by the server
+    assert server.send_request(builder_server.path, ['halt', '--metrics-dir', '/tmp']) == 3
+    assert capsys.readouterr()[0].splitlines()[0] == u'argv: halt'
+
+    for family, address in ((socket.AF_UNIX, builder_server.path),
+                            (socket.AF_INET, ('127.0.0.1', builder_server.metrics_port))):
+        reply = http_get(family, address, '/metrics')
+        assert reply.startswith(u'HTTP/1.0 200 OK\r\n')
+        assert u'\nbuilder_operations_total{operation="docker.exec",status="ok"} 3\n' in reply
+        assert http_get(family, address, '/').startswith(u'HTTP/1.0 404 Not Found\r\n')
+    # only the metrics are served on the port
+    conn = socket.create_connection(('127.0.0.1', builder_server.metrics_port))
+    try:
+        conn.sendall(b'{"argv": ["halt"]}\n\n')
+        assert conn.makefile('rb').readline() == b'HTTP/1.0 404 Not Found\r\n'
+    finally:
+        conn.close()
+    assert capsys.readouterr()[0] == u''
+
+
+def test_concurrent_requests(builder_server):
+    codes = []
+
+    def request():
+        codes.append(server.send_request(builder_server.path, ['sleep', '0.5']))
+
+    started = time.time()
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert codes == [3] * 4
+    assert time.time() - started < 2
+
+
+def test_stale_socket(tmpdir):
+    path = tempfile.mkdtemp(prefix='builder-server-')
+    try:
+        socket_path = os.path.join(path, 'builder.sock')
+        srv = server.BuilderServer(socket_path).bind()
+        with pytest.raises(RuntimeError):
+            server.BuilderServer(socket_path).bind()
+        # the socket of the killed server is left behind
+        srv._socket.close()
+        srv._socket = None
+        server.BuilderServer(socket_path).bind().close()
+        assert not os.path.exists(socket_path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def test_strip_option():
+    assert server.strip_option(['--server', 's.sock', 'build', '-s', 'a'], '--server') == ['build', '-s', 'a']
+    assert server.strip_option(['--server=s.sock', 'halt'], '--server') == ['halt']
+
+
+def test_build_modules_reload(tmpdir, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmpdir))
+    module_path = tmpdir.join('server_build_module.py')
+    module_path.write('VERSION = 1\n')
+    modules = server.BuildModules()
+    try:
+        assert modules.load('server_build_module').VERSION == 1
+        assert modules.load('server_build_module').VERSION == 1
+
+        module_path.write('VERSION = 2\n')
+        mtime = os.path.getmtime(str(module_path)) + 10
+        os.utime(str(module_path), (mtime, mtime))
+        assert modules.load('server_build_module').VERSION == 2
+        assert modules.load('missing_build_module') is None
+    finally:
+        sys.modules.pop('server_build_module', None)
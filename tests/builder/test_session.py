@@ -0,0 +1,77 @@
+from __future__ import (absolute_import, division, print_function)
+
+import threading
+
+from six import text_type
+
+from builder.cache import StepCache
+from builder.container import ContainerContext
+from builder.dockerapi import DockerAPI
+from builder.session import ShellSession
+
+
+def test_run(fake_docker_exec):
+    session = ShellSession('b1')
+    try:
+        assert session.run('echo', 'hello world') == (0, u'hello world\n', u'')
+        assert session.run('printf', 'partial') == (0, u'partial', u'')
+        assert session.run('/bin/sh', '-c', 'echo out; echo err >&2; exit 3') == (3, u'out\n', u'err\n')
+        # the command does not change the state of the session
+        assert session.run('/bin/sh', '-c', 'cd /tmp; exit 0') == (0, u'', u'')
+        assert session.execute('cat') == u''
+        assert session.execute('false') == []
+    finally:
+        session.close()
+
+
+def test_recovery(fake_docker_exec):
+    session = ShellSession('b1')
+    try:
+        assert session.execute('true') == u''
+        session._proc.kill()
+        session._proc.process.wait()
+        assert session.execute('echo', 'restarted') == u'restarted\n'
+    finally:
+        session.close()
+
+
+def test_died_while_running(fake_docker_exec, tmpdir):
+    session = ShellSession('b1')
+    marker = tmpdir.join('runs')
+    try:
+        assert session.execute('true') == u''
+        killer = threading.Timer(0.5, session._proc.kill)
+        killer.start()
+        # the command may have run, it's not sent again
+        assert session.run('/bin/sh', '-c', 'echo x >> %s; sleep 2' % marker)[0] is None
+        killer.join()
+        assert marker.read() == 'x\n'
+        assert session.execute('echo', 'restarted') == u'restarted\n'
+    finally:
+        session.close()
+
+
+def test_context_output(daemon, fake_docker_exec, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+
+    def check(output):
+        # the same attributes as the output of DockerCLI.execute()
+        assert (output.exit_code, output.stdout, output.stderr) == (0, b'out\n', b'err\n')
+        assert text_type(output) == u'out\n'
+
+    ctxt = ContainerContext('b1', session=True, cache=StepCache(cli, 'alpine:3.5', 'b1'))
+    try:
+        check(ctxt.shell('echo out; echo err >&2'))
+        assert ctxt.shell('exit 1') == []
+    finally:
+        ctxt.close()
+    cache = StepCache(cli, 'alpine:3.5', 'b1')
+    ctxt = ContainerContext('b1', session=True, cache=cache)
+    try:
+        check(ctxt.shell('echo out; echo err >&2'))
+        assert cache.hits == 1
+    finally:
+        ctxt.close()
@@ -0,0 +1,39 @@
+from __future__ import (absolute_import, division, print_function)
+
+from builder.squash import config_changes, squash_container, SQUASH_BUILD
+from builder.dockerapi import DockerAPI
+
+
+def test_config_changes():
+    container_config = {u'Env': [u'PATH=/usr/bin', u'LANG=C.UTF-8'], u'WorkingDir': u'/app',
+                        u'Labels': {u'builder.step': u'a b'}, u'ExposedPorts': {u'80/tcp': {}},
+                        u'Cmd': [u'/bin/sh', u'-c', u'tail -f /dev/null']}
+    assert config_changes(container_config, {u'Cmd': [u'python', u'app.py']}) == [
+        u'ENV PATH="/usr/bin"', u'ENV LANG="C.UTF-8"', u'WORKDIR /app', u'EXPOSE 80/tcp',
+        u'LABEL "builder.step"="a b"', u'CMD ["python", "app.py"]']
+    assert config_changes({}, {}) == [u'CMD []']
+    # the value with spaces, quotes, `=` and `$` is quoted
+    assert config_changes({u'Env': [u'MSG=say "hi" to a=b $HOME']}, {})[0] == \
+        u'ENV MSG="say \\"hi\\" to a=b \\$HOME"'
+
+
+def test_squash_container(daemon):
+    daemon.image('alpine:3.5')[u'Config'][u'Cmd'] = [u'python', u'app.py']
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    cli.execute('b1', 'sh', '-c', 'mkdir app && echo 1 > app/app.py && head -c 65536 /dev/zero > app/tmp.bin')
+    env = [u'PATH=/usr/bin', u'MSG=say "hi" to a=b']
+    daemon.container('b1')[u'Config'][u'Env'] = env
+
+    squashed = squash_container(cli, 'b1', 'alpine:3.5', 'app:squashed')
+    assert cli.inspect_image('app:squashed', '.Config.Env') == env
+    assert squashed[u'image.id'] == cli.inspect_image('app:squashed', '.Id')
+    assert squashed[u'size.after'] < squashed[u'size.before']
+    assert cli.inspect_image('app:squashed', '.Config.Cmd') == [u'python', u'app.py']
+
+    squashed = squash_container(cli, 'b1', 'alpine:3.5', 'app:build', mode=SQUASH_BUILD)
+    assert cli.inspect_image('app:build', '.Config.Cmd') == [u'python', u'app.py']
+    # the changes were applied to the container from the source image, it's removed after commit
+    assert cli.inspect('b1-squash', '.Id') is None
+    assert [r for r in daemon.requests if r == ('PUT', '/containers/b1-squash/archive')]
+    assert squash_container(cli, 'missing', 'alpine:3.5', 'app:missing') is None
@@ -0,0 +1,63 @@
+from __future__ import (absolute_import, division, print_function)
+
+import time
+
+from builder.docker import DockerCLI
+from builder.stream import ExecStream, STREAM_STDOUT, STREAM_STDERR
+
+
+def _stream(frames, exit_code=0, **kwargs):
+    return ExecStream(iter(frames), lambda: exit_code, **kwargs)
+
+
+def test_lines():
+    stream = _stream([(STREAM_STDOUT, b'line 1\nli'), (STREAM_STDERR, b'error\n'),
+                      (STREAM_STDOUT, b'ne 2\npartial')])
+    assert list(stream) == [(u'stdout', u'line 1'), (u'stderr', u'error'),
+                            (u'stdout', u'line 2'), (u'stdout', u'partial')]
+    assert stream.exit_code == 0
+    assert stream.ok
+    assert stream.bytes == {u'stdout': 21, u'stderr': 6}
+
+
+def test_raw_chunks():
+    stream = _stream([(STREAM_STDOUT, b'\x00\x01'), (STREAM_STDERR, b'err')], raw=True)
+    assert [(name, chunk.tobytes()) for name, chunk in stream] == [(u'stdout', b'\x00\x01'), (u'stderr', b'err')]
+
+
+def test_tail():
+    stream = _stream([(STREAM_STDOUT, b'%d\n' % i) for i in range(1000)], exit_code=2, tail_size=3)
+    assert stream.wait() == 2
+    assert not stream.ok
+    assert list(stream.tail) == [(u'stdout', u'997'), (u'stdout', u'998'), (u'stdout', u'999')]
+
+
+def test_docker_cli_exec_stream(fake_docker_exec):
+    stream = DockerCLI().exec_stream('b1', 'sh', '-c', 'echo out; echo err >&2; exit 3')
+    assert sorted(stream) == [(u'stderr', u'err'), (u'stdout', u'out')]
+    assert stream.exit_code == 3
+
+
+def test_docker_cli_exec_stream_large_output(fake_docker_exec, tmpdir):
+    path = tmpdir.join('large')
+    path.write_binary(b'%063d\n' * (256 * 1024) % tuple(range(256 * 1024)))
+    cli = DockerCLI()
+
+    started = time.time()
+    assert len(cli.execute('b1', 'cat', str(path)).stdout) == 16 * 1024 * 1024
+    buffered = time.time() - started
+
+    started = time.time()
+    stream = cli.exec_stream('b1', 'cat', str(path), raw=True)
+    assert sum(len(chunk) for _, chunk in stream) == 16 * 1024 * 1024
+    assert stream.exit_code == 0
+    # the streamed output is not slower than the buffered one
+    assert time.time() - started < max(buffered, 0.5)
+
+    # no polling delay at the end of the command
+    started = time.time()
+    cli.execute('b1', 'true')
+    buffered = time.time() - started
+    started = time.time()
+    assert cli.exec_stream('b1', 'true').wait() == 0
+    assert time.time() - started < buffered + 0.05
@@ -0,0 +1,79 @@
+from __future__ import (absolute_import, division, print_function)
+
+import os
+
+from builder import cache, sync
+from builder.cache import StepCache
+from builder.container import ContainerContext
+from builder.dockerapi import DockerAPI
+
+
+def test_plan():
+    host = {u'a': (u'd', 0, 0, None), u'a/x': (u'f', 1, 0, u'1'), u'b': (u'f', 1, 0, u'2'),
+            u'c': (u'd', 0, 0, None), u'c/y': (u'f', 1, 0, u'3'), u'l': (u'l', 0, 0, u'b')}
+    container = {u'b': (u'd', None), u'b/z': (u'f', u'4'), u'c': (u'd', None), u'c/y': (u'f', u'3'),
+                 u'l': (u'l', u'a'), u'old': (u'd', None), u'old/w': (u'f', u'5'), u'cache.pyc': (u'f', u'6')}
+    assert sync.plan(host, container, exclude=['*.pyc']) == ([u'a', u'b', u'l'], [u'b', u'old'])
+
+
+def test_sync_directory(daemon, tmpdir, monkeypatch):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    src = tmpdir.mkdir('src')
+    src.join('app.py').write('print(1)')
+    src.join('big.bin').write_binary(os.urandom(sync.MMAP_THRESHOLD + 1))
+    src.mkdir('lib').join('util.py').write('x = 1')
+    src.mkdir('docs').join('README').write('readme')
+
+    result, manifest = sync.sync_directory(cli, 'b1', str(src), 'app')
+    assert result == {u'uploaded': 4, u'deleted': 0, u'unchanged': 0}
+    assert cli.execute('b1', 'cat', 'app/lib/util.py') == u'x = 1'
+    assert manifest[u'big.bin'][3] == sync.hash_file(str(src.join('big.bin')))
+
+    hashed = []
+    monkeypatch.setattr(sync, 'hash_file', lambda path, size=None: hashed.append(path) or u'')
+    result, manifest = sync.sync_directory(cli, 'b1', str(src), 'app', previous=manifest)
+    assert (result, hashed) == ({u'uploaded': 0, u'deleted': 0, u'unchanged': 6}, [])
+    monkeypatch.undo()
+
+    src.join('app.py').write('print(2)')
+    src.join('docs').remove()
+    src.mkdir('conf').join('app.yml').write('debug: false')
+    cli.execute('b1', 'sh', '-c', 'echo cached > app/lib/util.pyc')
+    result, manifest = sync.sync_directory(cli, 'b1', str(src), 'app', exclude=['*.pyc'], previous=manifest)
+    assert result == {u'uploaded': 2, u'deleted': 1, u'unchanged': 3}
+    assert cli.execute('b1', 'cat', 'app/app.py') == u'print(2)'
+    assert cli.execute('b1', 'cat', 'app/conf/app.yml') == u'debug: false'
+    assert cli.execute('b1', 'ls', 'app') == u'app.py\nbig.bin\nconf\nlib\n'
+    assert cli.execute('b1', 'cat', 'app/lib/util.pyc') == u'cached\n'
+
+
+def test_context_sync_cache(daemon, tmpdir, monkeypatch):
+    monkeypatch.setenv('BUILDER_DOCKER_BACKEND', 'api')
+    monkeypatch.setenv('DOCKER_HOST', daemon.url)
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    src = tmpdir.mkdir('src')
+    src.join('app.py').write('print(1)')
+    src.join('conf').mkdir().join('app.yml').write('debug: true')
+
+    # the cache key is the host manifest, the source tree is not hashed by the cache
+    monkeypatch.setattr(cache, 'hash_path', None)
+    ctxt = ContainerContext('b1', cache=StepCache(cli, 'alpine:3.5', 'b1'))
+    result = ctxt.sync(str(src), 'app')
+    assert result[u'uploaded'] > 0
+
+    hashed = []
+    hash_file = sync.hash_file
+    monkeypatch.setattr(sync, 'hash_file', lambda path, size=None: hashed.append(path) or hash_file(path, size))
+    step_cache = StepCache(cli, 'alpine:3.5', 'b1')
+    ctxt._cache = step_cache
+    assert ctxt.sync(str(src), 'app') == result
+    assert (step_cache.hits, hashed) == (1, [])
+
+    src.join('app.py').write('print(2)')
+    step_cache = StepCache(cli, 'alpine:3.5', 'b1')
+    ctxt._cache = step_cache
+    assert ctxt.sync(str(src), 'app')[u'uploaded'] == 1
+    assert cli.execute('b1', 'cat', 'app/app.py') == u'print(2)'
+    assert (step_cache.misses, hashed) == (1, [str(src.join('app.py'))])
@@ -0,0 +1,69 @@
+from __future__ import (absolute_import, division, print_function)
+
+import json
+
+from builder import trace
+from builder.archive import Content
+from builder.dockerapi import DockerAPI
+
+
+def test_trace(daemon, tmpdir):
+    cli = DockerAPI(base_url=daemon.url)
+    tracer = trace.enable()
+    try:
+        with trace.span(u'build', target=u'app:1'):
+            cli.run_base_container('alpine:3.5', 'b1')
+            cli.execute('b1', 'echo', 'hello')
+            cli.execute('b1', 'false')
+            cli.copy_many('b1', [(Content(b'x' * 1000), 'data.bin')], '/')
+    finally:
+        assert trace.disable() is tracer
+    # tracing is disabled
+    cli.execute('b1', 'true')
+
+    spans = dict((s.name, s) for s in tracer.spans)
+    # the inventory is loaded by the listings
+    assert sorted(spans) == ['build', 'docker.copy_many', 'docker.exec', 'docker.images', 'docker.ps',
+                             'docker.put_archive', 'docker.run']
+    execs = [s for s in tracer.spans if s.name == 'docker.exec']
+    assert [(s.attributes[u'command'], s.attributes[u'exit.code']) for s in execs] == [
+        (['echo', 'hello'], 0), (['false'], 1)]
+    assert execs[0].attributes[u'bytes.received'] == 6
+    assert spans['docker.put_archive'].attributes[u'bytes.sent'] > 1000
+    assert spans['docker.put_archive'].parent_id == spans['docker.copy_many'].span_id
+    assert spans['docker.copy_many'].parent_id == spans['build'].span_id
+
+    tracer.write(str(tmpdir.join('trace.json')))
+    events = json.loads(tmpdir.join('trace.json').read())[u'traceEvents']
+    assert [e[u'ph'] for e in events].count(u'X') == 8
+    assert [e for e in events if e[u'name'] == u'build'][0][u'args'] == {u'target': u'app:1'}
+
+    tracer.write(str(tmpdir.join('trace.otlp.json')), trace.TRACE_OTLP)
+    otlp = json.loads(tmpdir.join('trace.otlp.json').read())[u'resourceSpans'][0][u'scopeSpans'][0][u'spans']
+    assert len(otlp) == 8 and all(s[u'traceId'] == tracer.trace_id for s in otlp)
+    failed = [s for s in otlp if {u'key': u'exit.code', u'value': {u'intValue': u'1'}} in s[u'attributes']]
+    assert failed[0][u'parentSpanId'] == spans['build'].span_id
+
+
+def test_trace_streams(daemon):
+    cli = DockerAPI(base_url=daemon.url)
+    cli.run_base_container('alpine:3.5', 'b1')
+    tracer = trace.enable()
+    try:
+        with trace.span(u'build'):
+            stream = cli.exec_stream('b1', 'sh', '-c', 'echo out; exit 2')
+            with trace.span(u'consumer'):
+                assert stream.wait() == 2
+            archive = b''.join(cli.get_archive('b1', '/'))
+            cli.image_ids(u'builder.cache.key')
+    finally:
+        trace.disable()
+
+    spans = dict((s.name, s) for s in tracer.spans)
+    assert spans['docker.exec_stream'].attributes == {u'container': 'b1', u'command': ['sh', '-c', 'echo out; exit 2'],
+                                                      u'bytes.received': 4, u'exit.code': 2}
+    # the span of the stream lasts until the output was consumed, it's not the parent of the consumer spans
+    assert spans['docker.exec_stream'].end >= spans['consumer'].start
+    assert spans['consumer'].parent_id == spans['build'].span_id
+    assert archive and spans['docker.get_archive'].attributes == {u'container': 'b1', u'path': '/'}
+    assert spans['docker.image_ids'].parent_id == spans['build'].span_id
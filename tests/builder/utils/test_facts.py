@@ -51,3 +51,39 @@ def test_parse_ifconfig():
             'inet': [{'address': '127.0.0.1', 'netmask': '255.0.0.0'}],
             'up': False}
     }
+
+
+def test_facts_script():
+    script = facts.facts_script(categories=('uname',))
+    assert u'uname -m' in script
+    assert u'/proc/cpuinfo' not in script
+
+
+def test_parse_facts():
+    output = textwrap.dedent('''\
+    __builder_facts_section__ hw.cpuinfo
+    processor	: 0
+    model name	: Intel(R) Xeon(R) CPU
+    __builder_facts_section__ hw.meminfo
+    MemTotal:        2048000 kB
+    MemFree:         1024000 kB
+    __builder_facts_section__ env.env
+    PATH=/usr/bin:/bin
+    __builder_facts_section__ uname.machine.type
+    x86_64
+    __builder_facts_section__ uname.kernel.name
+    Linux
+    __builder_facts_section__ net.hostname
+    b1
+    __builder_facts_section__ net.resolv
+    nameserver 8.8.8.8
+    __builder_facts_section__ net.ifconfig
+    ''')
+    result = facts.parse_facts(output)
+    assert result[u'num_cpus'] == 1
+    assert result[u'mem_total'] == 2000
+    assert result[u'env'] == {u'PATH': u'/usr/bin:/bin'}
+    assert result[u'uname'] == {u'machine.type': u'x86_64', u'kernel.name': u'Linux'}
+    assert result[u'net'][u'hostname'] == u'b1'
+    assert result[u'net'][u'nameservers'] == [u'8.8.8.8']
+    assert u'release' not in result